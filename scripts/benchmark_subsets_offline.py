@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+"""
+Offline end-to-end benchmark of the OSM subset pipeline.
+
+Drives workflows.utils.osm_subsets.process_subset_batch over synthetic
+boundaries and synthetic planet inputs, without Docker, R2 or a real planet.
+Every container goes through a pluggable runner (osm_subsets.container_runner):
+
+    sim     simulated tools: each gol/osmium/DuckDB step sleeps a configurable
+            latency (base + bytes / throughput, scaled by --time-scale) and
+            writes placeholder outputs sized from the subset's area
+    local   local gol, osmium and duckdb binaries where available (PATH, or
+            --duckdb), the simulator for the others
+
+Uploads go to simulated hooks with their own latency, each of which fails
+when used from a thread other than the one that created it. Batches are estimated and packed
+like the subset DAGs do, then processed one after another.
+
+Reports throughput (codes per minute), orchestration overhead (wall time
+during which no tool or upload was running, i.e. spent in the pipeline's own
+Python), peak disk footprint of the subset outputs (placeholders count at
+their apparent size) and peak memory of this process (max RSS, plus the
+Python heap peak with --tracemalloc, which slows allocation-heavy code down).
+
+Requires the packages the DAGs import (airflow, openplanetdata, docker SDK,
+shapely, numpy) - not Docker itself.
+
+Usage: benchmark_subsets_offline.py [--codes 200] [--runner sim] [--time-scale 0.01] ...
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Simulated tool model: (base seconds, bytes per second) per step, before
+# --time-scale, and output size relative to the step's input.
+STEP_LATENCY = {
+    "gol query": (2.0, 400e6),
+    "osmium extract": (1.0, 300e6),
+    "gol build": (3.0, 150e6),
+    "gol save": (1.0, 400e6),
+    "duckdb": (0.5, 500e6),
+    "upload": (0.5, 100e6),
+}
+GOL_BYTES_PER_PBF_BYTE = 1.6
+GOB_BYTES_PER_GOL_BYTE = 0.5
+PARQUET_BYTES_PER_PBF_BYTE = 1.3
+# Peak memory of a simulated container per byte it reads (reported through
+# the stats stream, so admission and telemetry see realistic numbers).
+MEMORY_PER_INPUT_BYTE = 3.0
+# Land area of the planet, to spread --planet-gb over the boundaries.
+LAND_AREA_KM2 = 149e6
+# Placeholder outputs never go below this, so no subset reads as empty.
+MIN_OUTPUT_BYTES = 64 * 1024
+
+
+class BusyLog:
+    """Intervals during which a simulated or local tool (or upload) ran."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.intervals = []
+        self.tool_seconds = 0.0
+
+    def add(self, start, end):
+        with self._lock:
+            self.intervals.append((start, end))
+            self.tool_seconds += end - start
+
+    def covered(self, start, end):
+        """Length of the union of the intervals within [start, end]."""
+        total, cursor = 0.0, start
+        for lo, hi in sorted(self.intervals):
+            lo, hi = max(lo, cursor), min(hi, end)
+            if hi > lo:
+                total += hi - lo
+                cursor = hi
+        return total
+
+
+class DiskSampler:
+    """Peak apparent size of the files under a directory, sampled in a thread."""
+
+    INTERVAL = 0.02
+
+    def __init__(self, path):
+        self.path = path
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.INTERVAL):
+            total = 0
+            for root, _dirs, files in os.walk(self.path):
+                total += sum(_size(os.path.join(root, name)) for name in files)
+            self.peak = max(self.peak, total)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _write_placeholder(path, size):
+    # Sparse files: sized like real outputs without writing the bytes.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.truncate(max(int(size), MIN_OUTPUT_BYTES))
+
+
+class SimulatedContainer:
+    """A docker-py-like container whose work is a sleep plus placeholder files."""
+
+    def __init__(self, runner, work, memory):
+        self.runner = runner
+        self.status = "running"
+        self.exit_code = None
+        self.memory = memory
+        self._output = []
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(work,), daemon=True)
+        self._thread.start()
+
+    def _run(self, work):
+        start = time.monotonic()
+        try:
+            work(self._output)
+            self.exit_code = 0
+        except Exception as e:
+            self._output.append(f"simulated tool failed: {e}")
+            self.exit_code = 1
+        self.runner.busy.add(start, time.monotonic())
+        self.status = "exited"
+        self._done.set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("container still running")
+        return {"StatusCode": self.exit_code}
+
+    def logs(self, stdout=True, stderr=True, tail=None):
+        lines = self._output[-tail:] if tail else self._output
+        return "\n".join(lines).encode()
+
+    def reload(self):
+        pass
+
+    def stats(self, decode=True, stream=True):
+        while not self._done.is_set():
+            yield {"memory_stats": {"usage": int(self.memory), "stats": {}}}
+            self._done.wait(0.1)
+
+    def remove(self, force=False):
+        # Nothing to kill: a simulated step always ends on its own.
+        self._done.wait(60)
+
+
+class SimulatedRunner:
+    """Container runner simulating gol, osmium and the DuckDB CLI."""
+
+    def __init__(self, time_scale, bytes_per_km2):
+        self.time_scale = time_scale
+        self.bytes_per_km2 = bytes_per_km2
+        self.busy = BusyLog()
+        self._areas = {}
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def _sleep(self, step, input_bytes):
+        base, throughput = STEP_LATENCY[step]
+        time.sleep((base + input_bytes / throughput) * self.time_scale)
+
+    def _area(self, boundary_path):
+        from workflows.utils import osm_subsets
+
+        with self._lock:
+            if boundary_path not in self._areas:
+                with open(boundary_path, encoding="utf-8") as fh:
+                    geometry = json.load(fh)
+                geometry = geometry.get("geometry", geometry)
+                self._areas[boundary_path] = osm_subsets._boundary_area_km2(geometry)
+            return self._areas[boundary_path]
+
+    def memory_in_use(self):
+        with self._lock:
+            return sum(container.memory for container in self._running if container.status == "running")
+
+    def start(self, cmd, image, env, mem_limit, shell):
+        from workflows.utils import osm_subsets
+
+        args = shlex.split(cmd) if shell else ["osmium", *cmd] if image == osm_subsets.OSMIUM_IMAGE else cmd
+        work, memory = self._plan(cmd if shell else shlex.join(args), args)
+        container = SimulatedContainer(self, work, memory)
+        with self._lock:
+            self._running = {c for c in self._running if c.status == "running"} | {container}
+        return container
+
+    def _plan(self, cmd, args):
+        """Return (work(output_lines), simulated memory) for one command."""
+        if "duckdb" in cmd and "-bail" in args:
+            return self._duckdb_session(args[args.index("<") + 1]), 2 * 1024**3
+        if args[:2] == ["gol", "query"]:
+            boundary = args[args.index("--area") + 1]
+            output = args[args.index(">") + 1]
+            size = self._area(boundary) * self.bytes_per_km2
+
+            def work(out):
+                self._sleep("gol query", size)
+                _write_placeholder(output, size)
+            return work, size * MEMORY_PER_INPUT_BYTE
+        if args[:2] == ["gol", "build"]:
+            gol, pbf = args[-2:]
+            size = _size(pbf)
+
+            def work(out):
+                self._sleep("gol build", size)
+                _write_placeholder(gol, size * GOL_BYTES_PER_PBF_BYTE)
+            return work, size * MEMORY_PER_INPUT_BYTE
+        if args[:2] == ["gol", "save"]:
+            gol, gob = args[-2:]
+            size = _size(gol)
+
+            def work(out):
+                self._sleep("gol save", size)
+                _write_placeholder(gob, size * GOB_BYTES_PER_GOL_BYTE)
+            return work, size
+        if args[:2] == ["osmium", "extract"] and "--config" in args:
+            with open(args[args.index("--config") + 1], encoding="utf-8") as fh:
+                extracts = json.load(fh)["extracts"]
+            sizes = {e["output"]: self._area(e["polygon"]["file_name"]) * self.bytes_per_km2 for e in extracts}
+
+            def work(out):
+                self._sleep("osmium extract", sum(sizes.values()))
+                for output, size in sizes.items():
+                    _write_placeholder(output, size)
+            return work, 1024**3
+        if args[:2] == ["osmium", "extract"]:
+            output = args[args.index("--output") + 1]
+            size = self._area(args[args.index("--polygon") + 1]) * self.bytes_per_km2
+
+            def work(out):
+                self._sleep("osmium extract", size)
+                _write_placeholder(output, size)
+            return work, 1024**3
+
+        def work(out):
+            out.append(f"simulated: {cmd}")
+        return work, 0
+
+    def _duckdb_session(self, fifo_path):
+        """One CLI session reading `.read` lines from the worker's FIFO."""
+
+        def work(out):
+            with open(fifo_path, encoding="utf-8") as fifo:
+                for line in fifo:
+                    match = re.match(r"\.read '(.+)'", line.strip())
+                    if not match:
+                        continue
+                    with open(match.group(1), encoding="utf-8") as fh:
+                        targets = re.findall(r"\) TO '([^']+)'", fh.read())
+                    *outputs, status = targets
+                    sizes = {}
+                    for output in outputs:
+                        code_dir = os.path.dirname(output)
+                        code = os.path.basename(code_dir)
+                        sizes[output] = _size(f"{code_dir}/{code}-latest.osm.pbf") * PARQUET_BYTES_PER_PBF_BYTE
+                    self._sleep("duckdb", sum(sizes.values()))
+                    for output, size in sizes.items():
+                        _write_placeholder(output, size)
+                    with open(status, "w", encoding="utf-8") as fh:
+                        fh.write("ok\n1\n")
+        return work
+
+
+class TimedProcess:
+    """A process of osm_subsets.LocalRunner whose run time goes to the busy log."""
+
+    def __init__(self, runner, process):
+        self.runner = runner
+        self._process = process
+        self._start = time.monotonic()
+        self._logged = False
+
+    def __getattr__(self, name):
+        return getattr(self._process, name)
+
+    def _log(self):
+        if not self._logged:
+            self._logged = True
+            self.runner.busy.add(self._start, time.monotonic())
+
+    def wait(self, timeout=None):
+        result = self._process.wait(timeout)
+        self._log()
+        return result
+
+    def remove(self, force=False):
+        self._process.remove(force=force)
+        self._log()
+
+
+class LocalRunner:
+    """Run gol, osmium and duckdb natively where available, simulate the rest.
+
+    Native steps go through the pipeline's own local execution backend
+    (osm_subsets.LocalRunner), memory limits included.
+    """
+
+    def __init__(self, simulator, duckdb_path):
+        from workflows.utils import osm_subsets
+
+        self.simulator = simulator
+        self.busy = simulator.busy
+        self.native = osm_subsets.LocalRunner()
+        self.duckdb_path = duckdb_path
+        self.tools = {tool for tool in ("gol", "osmium") if shutil.which(tool)}
+        if duckdb_path:
+            self.tools.add("duckdb")
+
+    def start(self, cmd, image, env, mem_limit, shell):
+        from workflows.utils import osm_subsets
+
+        if shell:
+            tool = "duckdb" if "/duckdb " in cmd else cmd.split()[0]
+        elif image == osm_subsets.OSMIUM_IMAGE:
+            tool = "osmium"
+        else:
+            tool = cmd[0]
+        if tool not in self.tools:
+            return self.simulator.start(cmd, image, env, mem_limit, shell)
+        return TimedProcess(self, self.native.start(cmd, image, env, mem_limit, shell))
+
+    def memory_in_use(self):
+        return self.simulator.memory_in_use()
+
+
+class SimulatedHook:
+    """Stands in for R2IndexHook: sleeps like an upload of the source file.
+
+    Uploads fail from any thread but the one that created the hook, so a
+    hook shared between upload workers shows up as failed uploads.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.thread = threading.current_thread()
+
+    def upload(self, source, **kwargs):
+        if threading.current_thread() is not self.thread:
+            raise RuntimeError(f"Hook of {self.thread.name} used from {threading.current_thread().name}")
+        start = time.monotonic()
+        base, throughput = STEP_LATENCY["upload"]
+        time.sleep((base + _size(source) / throughput) * self.runner.time_scale)
+        self.runner.busy.add(start, time.monotonic())
+
+
+def synthesize_boundaries(boundaries_dir, codes, min_area, max_area, vertices, seed):
+    """Write wiggly polygons with log-uniform areas as raw boundary files."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    names = [f"S{i:05d}" for i in range(codes)]
+    os.makedirs(boundaries_dir, exist_ok=True)
+    for code in names:
+        area = math.exp(rng.uniform(math.log(min_area), math.log(max_area)))
+        lat = rng.uniform(-55, 65)
+        lon = rng.uniform(-170, 170)
+        # Radius in degrees of a disc of that area at that latitude.
+        radius = math.sqrt(area / math.pi) / 111.32
+        t = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+        r = radius * (1 + 0.25 * np.sin(rng.integers(3, 9) * t) + 0.03 * rng.standard_normal(vertices))
+        xs = np.clip(lon + r * np.cos(t) / max(math.cos(math.radians(lat)), 0.2), -180, 180)
+        ys = np.clip(lat + r * np.sin(t), -85, 85)
+        ring = np.c_[xs, ys].tolist()
+        ring.append(ring[0])
+        with open(f"{boundaries_dir}/{code}.raw.geojson", "w", encoding="utf-8") as fh:
+            json.dump({
+                "type": "FeatureCollection",
+                "name": "boundary",
+                "features": [{"type": "Feature", "properties": {},
+                              "geometry": {"type": "Polygon", "coordinates": [ring]}}],
+            }, fh)
+    return names
+
+
+def synthesize_planet(work_dir, planet_bytes, features, runner, seed):
+    """Write the planet snapshot files the pipeline reads.
+
+    With local osmium/gol/duckdb, real (small) inputs with random nodes are
+    generated so those tools have something to read; otherwise the snapshots
+    are sparse placeholders of planet_bytes.
+    """
+    import numpy as np
+
+    paths = {fmt: f"{work_dir}/planet-latest.osm.{fmt}" for fmt in ("pbf", "gol", "parquet")}
+    for path in paths.values():
+        _write_placeholder(path, planet_bytes)
+    tools = getattr(runner, "tools", set())
+    if not tools:
+        return paths
+
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(-180, 180, features)
+    lats = rng.uniform(-85, 85, features)
+    if "osmium" in tools:
+        opl = f"{work_dir}/planet.opl"
+        with open(opl, "w", encoding="utf-8") as fh:
+            for i, (lon, lat) in enumerate(zip(lons, lats), 1):
+                fh.write(f"n{i} v1 x{lon:.7f} y{lat:.7f} Tamenity=bench\n")
+        subprocess.run(["osmium", "cat", "--overwrite", opl, "-o", paths["pbf"]], check=True)
+        if "gol" in tools:
+            subprocess.run(["gol", "build", "--yes", paths["gol"], paths["pbf"]], check=True)
+    if "duckdb" in tools:
+        csv = f"{work_dir}/planet.csv"
+        with open(csv, "w", encoding="utf-8") as fh:
+            fh.write("id,lon,lat\n")
+            for i, (lon, lat) in enumerate(zip(lons, lats), 1):
+                fh.write(f"{i},{lon!r},{lat!r}\n")
+        sql = f"""
+INSTALL 'spatial'; LOAD 'spatial';
+COPY (
+    SELECT 'node' AS osm_type, id AS osm_id, MAP {{'amenity': 'bench'}} AS tags,
+           {{'xmin': lon::FLOAT, 'ymin': lat::FLOAT, 'xmax': lon::FLOAT, 'ymax': lat::FLOAT}} AS bbox,
+           ST_AsWKB(ST_Point(lon, lat)) AS geometry
+    FROM read_csv('{csv}') ORDER BY lon, lat
+) TO '{paths["parquet"]}' (FORMAT PARQUET);
+"""
+        subprocess.run([runner.duckdb_path, "-c", sql], check=True)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--work-dir", default="/tmp/osm-subsets-offline")
+    parser.add_argument("--runner", choices=["sim", "local"], default="sim")
+    parser.add_argument("--duckdb", help="local DuckDB CLI for --runner local")
+    parser.add_argument("--codes", type=int, default=200)
+    parser.add_argument("--level", default="countries")
+    parser.add_argument("--min-area", type=float, default=10.0, help="smallest boundary, km²")
+    parser.add_argument("--max-area", type=float, default=2e6, help="largest boundary, km²")
+    parser.add_argument("--vertices", type=int, default=2000, help="vertices per raw boundary")
+    parser.add_argument("--planet-gb", type=float, default=80.0, help="simulated planet PBF size")
+    parser.add_argument("--planet-features", type=int, default=100_000, help="nodes of local-tool inputs")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="multiplier on simulated latencies")
+    parser.add_argument("--batch-budget", type=float, default=30 * 60, help="predicted seconds per batch")
+    parser.add_argument("--batch-max-codes", type=int, default=64)
+    parser.add_argument("--build-workers", type=int, default=4)
+    parser.add_argument("--host-memory-gb", type=float, help="simulate a host with this much memory")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    from workflows.utils import osm_subsets
+
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+    boundaries_dir = f"{args.work_dir}/boundaries"
+    level_dir = f"{args.work_dir}/{args.level}"
+    os.makedirs(level_dir)
+    osm_subsets.SUBSET_TIMINGS_PATH = f"{args.work_dir}/timings.jsonl"
+
+    simulator = SimulatedRunner(args.time_scale, args.planet_gb * 1024**3 / LAND_AREA_KM2)
+    runner = simulator
+    if args.runner == "local":
+        if args.duckdb:
+            os.symlink(os.path.abspath(args.duckdb), f"{args.work_dir}/duckdb")
+        runner = LocalRunner(simulator, args.duckdb and f"{args.work_dir}/duckdb")
+        print(f"Local tools: {sorted(runner.tools) or 'none'}; simulating the rest")
+    if args.host_memory_gb:
+        total = int(args.host_memory_gb * 1024**3)
+        osm_subsets.host_memory = lambda: (total, total - runner.memory_in_use())
+
+    codes = synthesize_boundaries(boundaries_dir, args.codes, args.min_area, args.max_area, args.vertices, args.seed)
+    planet = synthesize_planet(args.work_dir, int(args.planet_gb * 1024**3), args.planet_features, runner, args.seed)
+
+    start = time.monotonic()
+    failures = osm_subsets.prepare_boundaries(codes, boundaries_dir, engine="shapely")
+    prepare_seconds = time.monotonic() - start
+    codes = [code for code in codes if code not in failures]
+    estimates = osm_subsets.estimate_subset_costs(codes, args.level, boundaries_dir)
+    batches = osm_subsets.pack_subset_batches(estimates, args.batch_budget, args.batch_max_codes, args.build_workers)
+    print(f"Prepared {len(codes)} boundaries in {prepare_seconds:,.1f}s, packed into {len(batches)} batch(es)")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    failed_batches = 0
+    start = time.monotonic()
+    with osm_subsets.container_runner(runner), \
+            osm_subsets.container_telemetry_log(f"{args.work_dir}/telemetry.jsonl"), \
+            DiskSampler(level_dir) as disk:
+        for batch in batches:
+            try:
+                osm_subsets.process_subset_batch(
+                    codes=batch,
+                    names={},
+                    level=args.level,
+                    level_dir=level_dir,
+                    boundaries_dir=boundaries_dir,
+                    snapshot_gol=planet["gol"],
+                    snapshot_parquet=planet["parquet"],
+                    work_dir=args.work_dir,
+                    r2index_conn_id="offline",
+                    build_workers=args.build_workers,
+                    refilter_gol_pbf=True,
+                    estimates={code: estimates[code] for code in batch},
+                    hook_factory=lambda: SimulatedHook(simulator),
+                )
+            except Exception as e:
+                failed_batches += 1
+                print(f"Batch {batch[0]} failed: {e}")
+    wall = time.monotonic() - start
+    busy = simulator.busy.covered(start, start + wall)
+
+    print("\n=== Offline subset pipeline benchmark ===")
+    print(f"runner            {args.runner} (time scale {args.time_scale})")
+    print(f"codes             {len(codes)} in {len(batches)} batch(es), {failed_batches} failed batch(es)")
+    print(f"wall time         {wall:,.2f}s")
+    print(f"throughput        {len(codes) / wall * 60:,.1f} codes/min")
+    print(f"tool time         {simulator.busy.tool_seconds:,.2f}s summed, {busy:,.2f}s wall covered")
+    print(f"orchestration     {wall - busy:,.2f}s ({(wall - busy) / wall:.1%} of wall time with no tool running)")
+    print(f"boundary prep     {prepare_seconds:,.2f}s")
+    print(f"peak disk         {disk.peak / 1024**3:,.2f} GiB of subset outputs")
+    print(f"max RSS           {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.1f} MiB")
+    if args.tracemalloc:
+        _current, peak = tracemalloc.get_traced_memory()
+        print(f"Python heap peak  {peak / 1024**2:,.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,14 @@
 """
 Compute area of a GeoJSON polygon in km² using geodesic calculation.
 Returns the computed area value.
+
+Also importable (the subset DAGs estimate extraction cost from boundary
+area): pyproj is only imported when an area is computed.
 """
 
 import json
 import sys
 
-try:
-    from pyproj import Geod
-except ImportError as e:
-    print(f"Error: Required Python package not found: {e}", file=sys.stderr)
-    print("Please install: pip install pyproj", file=sys.stderr)
-    sys.exit(1)
-
 
 def compute_polygon_area(coords, geod):
     """
@@ -32,28 +28,22 @@ def compute_polygon_area(coords, geod):
     return area
 
 
-def compute_area_km2(geojson_path):
+def geometry_area_km2(geometry):
     """
-    Compute the geodesic area of a GeoJSON polygon in km².
+    Compute the geodesic area of a GeoJSON geometry mapping in km².
     Uses WGS84 ellipsoid for accurate area calculation.
 
     Args:
-        geojson_path: Path to the GeoJSON file
+        geometry: GeoJSON Polygon or MultiPolygon mapping
 
     Returns:
-        Area in km²
-    """
-    # Read GeoJSON
-    with open(geojson_path, 'r') as f:
-        data = json.load(f)
+        Area in km², or None for other geometry types
 
-    if not data.get('features') or len(data['features']) == 0:
-        print("Error: No features found in GeoJSON", file=sys.stderr)
-        return None
+    Raises:
+        ImportError: pyproj is not installed
+    """
+    from pyproj import Geod
 
-    # Get the first feature's geometry
-    feature = data['features'][0]
-    geometry = feature['geometry']
     geom_type = geometry['type']
 
     # Use pyproj Geod for geodesic area calculation on WGS84 ellipsoid
@@ -94,13 +84,41 @@ def compute_area_km2(geojson_path):
     return area_km2
 
 
+def compute_area_km2(geojson_path):
+    """
+    Compute the geodesic area of a GeoJSON polygon in km².
+
+    Args:
+        geojson_path: Path to the GeoJSON file
+
+    Returns:
+        Area in km² of the first feature
+    """
+    # Read GeoJSON
+    with open(geojson_path, 'r') as f:
+        data = json.load(f)
+
+    if not data.get('features') or len(data['features']) == 0:
+        print("Error: No features found in GeoJSON", file=sys.stderr)
+        return None
+
+    # Get the first feature's geometry
+    feature = data['features'][0]
+    return geometry_area_km2(feature['geometry'])
+
+
 if __name__ == '__main__':
     if len(sys.argv) != 2:
         print("Usage: compute_area.py <geojson_file>", file=sys.stderr)
         sys.exit(1)
 
     input_file = sys.argv[1]
-    area_km2 = compute_area_km2(input_file)
+    try:
+        area_km2 = compute_area_km2(input_file)
+    except ImportError as e:
+        print(f"Error: Required Python package not found: {e}", file=sys.stderr)
+        print("Please install: pip install pyproj", file=sys.stderr)
+        sys.exit(1)
 
     if area_km2 is None:
         sys.exit(1)
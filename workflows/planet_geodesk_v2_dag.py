@@ -3,11 +3,20 @@ Planet GeoDesk v2 DAG - Build GOL and GOB indexes from OSM planet PBF.
 
 Schedule: Triggered by openplanetdata-osm-planet-pbf Asset
 Produces Assets: openplanetdata-osm-planet-gol-v2, openplanetdata-osm-planet-gob-v2
+
+The GOL is built with --updatable, so a run normally takes the previous run's
+GOL (the shared copy) and applies the replication diffs since with gol update,
+instead of rebuilding the whole planet from the PBF. An updated GOL whose
+way and relation counts drift away from the PBF's is rebuilt instead. The
+GOB is then saved from the updated GOL. Update and rebuild durations are
+recorded in the replication timings log (workflows/utils/osm_replication.py).
 """
 
 import os
 import shutil
+import sys
 from datetime import timedelta
+from pathlib import Path
 
 from airflow.providers.docker.operators.docker import DockerOperator
 from airflow.sdk import DAG, Asset, task
@@ -28,6 +37,19 @@ from openplanetdata.airflow.defaults import (
 WORK_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/geodesk/v2"
 GOL_PATH = f"{WORK_DIR}/planet-latest.osm.gol"
 GOB_PATH = f"{WORK_DIR}/planet-latest.osm.gob"
+CHANGES_PATH = f"{WORK_DIR}/changes/changes.osc.gz"
+
+# A full rebuild from the PBF still runs every GOL_REBUILD_DAYS days, which
+# bounds any drift of the update path, and whenever the previous GOL's
+# replication state cannot be trusted, the diffs since span more than
+# GOL_UPDATE_MAX_HOURS, or the update fails.
+GOL_REBUILD_DAYS = 7
+GOL_UPDATE_MAX_HOURS = 72
+# GOL features and PBF objects are not counted alike, so an updated GOL is
+# checked on the ratio of its way and relation counts to the PBF's: beyond
+# this relative change since the ratios measured after the last rebuild,
+# the update has drifted and the GOL is rebuilt.
+GOL_DRIFT_TOLERANCE = 0.001
 
 PBF_ASSET = Asset(
     name="openplanetdata-osm-planet-pbf",
@@ -42,6 +64,38 @@ GOB_V2_ASSET = Asset(
     uri=f"s3://{R2_BUCKET}/osm/planet/gob/v2/planet-latest.osm.gob",
 )
 
+
+def _utils():
+    """Import workflows.utils.osm_subsets and osm_replication at task runtime (bundle-relative)."""
+    bundle_root = str(Path(__file__).resolve().parent.parent)
+    if bundle_root not in sys.path:
+        sys.path.insert(0, bundle_root)
+    from workflows.utils import osm_replication, osm_subsets
+
+    return osm_subsets, osm_replication
+
+
+def _count_ratios(subsets) -> dict[str, float]:
+    """Way and relation counts of the GOL relative to the planet PBF's (see GOL_DRIFT_TOLERANCE)."""
+    import json
+    import shlex
+
+    info = json.loads(subsets.run_in_container(
+        ["fileinfo", "--extended", "--json", SHARED_PLANET_OSM_PBF_PATH],
+        image=subsets.OSMIUM_IMAGE,
+        mem_limit=subsets.OSMIUM_MEM_LIMIT,
+        stdout_only=True,
+        shell=False,
+        step="osmium fileinfo extended",
+    ))
+    ratios = {}
+    for selector, name in (("w", "ways"), ("r", "relations")):
+        query = shlex.join(["gol", "query", GOL_PATH, selector, "-f", "count"])
+        count = int(subsets.run_in_container(query, stdout_only=True, step="gol query count").split()[-1])
+        ratios[name] = count / info["data"]["count"][name]
+    return ratios
+
+
 with DAG(
     dag_display_name="OpenPlanetData OSM Planet GeoDesk v2",
     dag_id="openplanetdata_osm_geodesk_v2",
@@ -78,24 +132,71 @@ with DAG(
             verify_checksum=False,
         )
 
-    build_gol = DockerOperator(
-        task_id="build_gol",
-        task_display_name="Build GOL v2",
-        image=OPENPLANETDATA_IMAGE,
-        command=f"""bash -c '
-            mkdir -p {WORK_DIR}/.tmp &&
-            rm -rf {WORK_DIR}/*.osm-work &&
-            echo "Starting GOL build at $(date -u +%Y-%m-%d_%H:%M:%S)" &&
-            time gol build --updatable --yes {GOL_PATH} {SHARED_PLANET_OSM_PBF_PATH} &&
-            echo "Build finished at $(date -u +%Y-%m-%d_%H:%M:%S)" &&
-            ls -lh {GOL_PATH}
-        '""",
-        environment={"TMPDIR": f"{WORK_DIR}/.tmp"},
-        force_pull=True,
-        mounts=[Mount(**DOCKER_MOUNT)],
-        mount_tmp_dir=False,
-        auto_remove="success",
-    )
+    @task(task_display_name="Build GOL v2")
+    def build_gol() -> dict:
+        """Update the previous GOL with the replication diffs, or rebuild it from the PBF.
+
+        An update is checked for drift against the PBF (see
+        GOL_DRIFT_TOLERANCE) and falls back to a rebuild when it fails or
+        drifts. Returns the replication state of the new GOL, with the count
+        ratios of its last rebuild, recorded next to its shared copy by
+        copy_to_shared.
+        """
+        import datetime
+        import shlex
+        import time
+
+        subsets, replication = _utils()
+        # gol runs in its image, as the image's user, whatever the subset
+        # backend (OPENPLANETDATA_SUBSET_BACKEND) of the worker.
+        with subsets.container_runner(subsets.DockerRunner(image_user=True)):
+            sequence = replication.replication_sequence(SHARED_PLANET_OSM_PBF_PATH)
+            state = replication.read_state(SHARED_PLANET_OSM_GOL_PATH)
+            mode, reason = replication.plan_update(state, sequence, GOL_UPDATE_MAX_HOURS, GOL_REBUILD_DAYS)
+            print(f"GOL {mode}: {reason}")
+
+            os.makedirs(f"{WORK_DIR}/.tmp", exist_ok=True)
+            env = {"TMPDIR": f"{WORK_DIR}/.tmp"}
+            rebuilt = state["rebuilt"] if state else None
+            ratios = state.get("ratios") if state else None
+            diffs = 0
+            start = time.monotonic()
+            if mode == "update":
+                try:
+                    # A copy: the shared GOL may be hardlinked by a subsets run.
+                    copy = ["cp", "--reflink=auto", "--preserve=timestamps", SHARED_PLANET_OSM_GOL_PATH, GOL_PATH]
+                    subsets.run_in_container(shlex.join(copy), step="gol copy")
+                    if sequence > state["sequence"]:
+                        replication.fetch_changes(state["sequence"], sequence, CHANGES_PATH)
+                        update = shlex.join(["gol", "update", GOL_PATH, CHANGES_PATH])
+                        subsets.run_in_container(f"time {update}", env=env, step="gol update", stream_output=True)
+                    diffs = sequence - state["sequence"]
+                    if ratios is None:
+                        print("No count ratios recorded since the last rebuild, drift not checked")
+                    else:
+                        updated = _count_ratios(subsets)
+                        for name, ratio in updated.items():
+                            print(f"GOL/PBF {name}: {ratio:.6f} (after the last rebuild: {ratios[name]:.6f})")
+                            if abs(ratio / ratios[name] - 1) > GOL_DRIFT_TOLERANCE:
+                                raise ValueError(f"{name} drifted beyond {GOL_DRIFT_TOLERANCE:.1%}")
+                except Exception as e:
+                    print(f"GOL update failed, rebuilding: {e}")
+                    mode = "rebuild"
+                    start = time.monotonic()
+            if mode == "rebuild":
+                build = shlex.join(["gol", "build", "--updatable", "--yes", GOL_PATH, SHARED_PLANET_OSM_PBF_PATH])
+                subsets.run_in_container(
+                    f"rm -rf {shlex.quote(WORK_DIR)}/*.osm-work && time {build}", env=env, step="gol build",
+                    stream_output=True,
+                )
+                rebuilt = datetime.date.today().isoformat()
+                ratios = _count_ratios(subsets)
+            seconds = time.monotonic() - start
+            print(f"GOL {mode} finished in {seconds / 60:,.1f} min: {os.path.getsize(GOL_PATH):,} bytes")
+
+            replication.record_timing("gol", mode, seconds, sequence=sequence, diffs=diffs)
+            replication.report_timings("gol")
+            return {"sequence": sequence, "rebuilt": rebuilt, "ratios": ratios}
 
     build_gob = DockerOperator(
         task_id="build_gob",
@@ -157,12 +258,20 @@ with DAG(
         )]
 
     @task(task_display_name="Copy GOL to Shared Directory", outlets=[GOL_V2_ASSET])
-    def copy_to_shared() -> None:
-        """Copy GOL to shared directory atomically for use by other DAGs."""
+    def copy_to_shared(build: dict) -> None:
+        """Copy GOL to shared directory atomically for use by other DAGs.
+
+        Its replication state goes next to it, for the next run to update it.
+        """
         os.makedirs(OPENPLANETDATA_SHARED_DIR, exist_ok=True)
         tmp_path = f"{SHARED_PLANET_OSM_GOL_PATH}.tmp"
         shutil.copy2(GOL_PATH, tmp_path)
         os.rename(tmp_path, SHARED_PLANET_OSM_GOL_PATH)
+        if build["sequence"] is not None:
+            _subsets, replication = _utils()
+            replication.write_state(
+                SHARED_PLANET_OSM_GOL_PATH, build["sequence"], build["rebuilt"], ratios=build["ratios"],
+            )
 
     @task(task_id="osm_geodesk_v2_done", task_display_name="Done")
     def done() -> None:
@@ -175,16 +284,16 @@ with DAG(
 
     # Task flow
     download_result = download_planet_pbf()
-    download_result >> build_gol
+    gol_build = build_gol()
+    download_result >> gol_build
 
     gol_upload = upload_gol()
     gob_upload = upload_gob()
 
-    build_gol >> gol_upload
-    build_gol >> build_gob >> gob_upload
+    gol_build >> gol_upload
+    gol_build >> build_gob >> gob_upload
 
-    copy_result = copy_to_shared()
-    build_gol >> copy_result
+    copy_result = copy_to_shared(gol_build)
 
     done_result = done()
     cleanup_result = cleanup()
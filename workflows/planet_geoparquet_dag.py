@@ -4,13 +4,34 @@ Planet GeoParquet DAG - Build planet-scale GeoParquet from OSM PBF.
 Uses ohsome-planet for contribution extraction and DuckDB for spatial
 processing, validation, and output compression.
 
+Geometries are written as WKB with GeoParquet 1.1 metadata that declares the
+bbox struct as their covering, so any reader can prune row groups by bbox.
+Rows are written in GEOPARQUET_SORT_MODE order. "bbox" sorts by
+bbox.xmin first, so every row group is a thin longitude stripe whose
+ymin/ymax statistics span almost the whole latitude range; "hilbert" sorts
+by the Hilbert index of the bbox centre, so row groups cover compact tiles
+and bbox filters (the subset DAGs' GeoParquet extracts) prune far more of
+them. The subsets benchmark DAG compares both orders.
+
+With the bbox order, a run normally applies the replication diffs since
+the previous run to the stored partitions of the planet file instead: only
+the changed objects and those above them go through ohsome, and only the
+partitions holding them are rewritten (workflows/utils/osm_geoparquet.py);
+without diffs, the published file is reused as it is.
+A full rebuild still runs on a schedule and whenever the update cannot be
+trusted or fails. Update and rebuild durations are recorded in the
+replication timings log (workflows/utils/osm_replication.py).
+
 Schedule: Triggered by openplanetdata-osm-planet-pbf Asset
 Produces Asset: openplanetdata-osm-planet-geoparquet
 """
 
+import json
 import os
 import shutil
+import sys
 from datetime import timedelta
+from pathlib import Path
 
 from airflow.providers.docker.operators.docker import DockerOperator
 from airflow.sdk import DAG, Asset, task
@@ -28,10 +49,72 @@ from openplanetdata.airflow.defaults import (
     SHARED_PLANET_OSM_PBF_PATH,
 )
 
+# The planet sort keys and COPY options are needed at parse time (DAG-level
+# constants), so the bundle root goes on sys.path here too, not only in
+# _utils; geoparquet_layout only imports the standard library, unlike the
+# modules _utils loads.
+_BUNDLE_ROOT = str(Path(__file__).resolve().parent.parent)
+if _BUNDLE_ROOT not in sys.path:
+    sys.path.insert(0, _BUNDLE_ROOT)
+
+from workflows.utils.geoparquet_layout import (  # noqa: E402
+    GEOPARQUET_SORT_KEYS,
+    GEOPARQUET_SORT_TIEBREAK,
+    parquet_copy_options,
+)
+
 OHSOME_PLANET_VERSION = "1.3.1"
 WORK_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/geoparquet"
+OHSOME_IMAGE = "eclipse-temurin:25-jdk"
+OHSOME_SRC = f"{WORK_DIR}/ohsome-planet"
+OHSOME_JAR = f"{OHSOME_SRC}/ohsome-planet-cli/target/ohsome-planet.jar"
 OHSOME_DIR = f"{WORK_DIR}/ohsome-output"
 PARQUET_PATH = f"{WORK_DIR}/planet-latest.osm.parquet"
+BUILD_PLAN_PATH = f"{WORK_DIR}/build.json"
+CHANGES_DIR = f"{WORK_DIR}/changes"
+CONTEXT_PBF_PATH = f"{CHANGES_DIR}/context.osm.pbf"
+DELTA_OHSOME_DIR = f"{WORK_DIR}/ohsome-delta"
+# JVM heap of the ohsome run over the affected objects' extract: a few
+# GB of PBF, against the planet run's 84 GB.
+DELTA_OHSOME_HEAP = "16g"
+
+# A full rebuild still runs every GEOPARQUET_REBUILD_DAYS days, which bounds
+# any drift of the update path, and whenever the stored partitions'
+# replication state cannot be trusted, the diffs since span more than
+# GEOPARQUET_UPDATE_MAX_HOURS, or the update fails.
+GEOPARQUET_REBUILD_DAYS = 7
+GEOPARQUET_UPDATE_MAX_HOURS = 72
+
+# A key of GEOPARQUET_SORT_KEYS (workflows/utils/geoparquet_layout.py).
+GEOPARQUET_SORT_MODE = "bbox"
+
+# Planet rows from ohsome contributions ({contributions}: a Parquet glob),
+# for the full build and the incremental delta alike. Relations ohsome could
+# only give their bbox rectangle get the collection of their members'
+# geometries instead.
+GEOPARQUET_SELECT = """
+        SELECT
+            osm_type::ENUM ('node', 'way', 'relation') AS osm_type,
+            osm_id,
+            tags,
+            bbox,
+            ST_AsWKB(CASE
+                WHEN osm_type = 'relation'
+                     AND ST_NPoints(geometry) = 5
+                     AND ST_Equals(geometry, ST_Envelope(geometry))
+                     AND members IS NOT NULL
+                THEN ST_Collect(list_transform(
+                    list_filter(members, lambda m: m.geometry IS NOT NULL),
+                    lambda m: ST_GeomFromWKB(m.geometry)
+                ))
+                ELSE geometry
+            END) AS geometry
+        FROM '{contributions}'
+        WHERE status = 'latest'"""
+
+# COPY options of the planet file (workflows/utils/geoparquet_layout.py),
+# escaped for the double-quoted `duckdb -c` argument of build_geoparquet.
+GEOPARQUET_COPY_OPTIONS_SHELL = parquet_copy_options().replace('"', '\\"')
 
 PBF_ASSET = Asset(
     name="openplanetdata-osm-planet-pbf",
@@ -46,6 +129,37 @@ GEOPARQUET_SHARED_ASSET = Asset(
     uri=f"file://{SHARED_PLANET_OSM_PARQUET_PATH}",
 )
 
+
+def _utils():
+    """Import workflows.utils.osm_subsets, osm_replication and osm_geoparquet at task runtime (bundle-relative)."""
+    bundle_root = str(Path(__file__).resolve().parent.parent)
+    if bundle_root not in sys.path:
+        sys.path.insert(0, bundle_root)
+    from workflows.utils import osm_geoparquet, osm_replication, osm_subsets
+
+    return osm_subsets, osm_replication, osm_geoparquet
+
+
+def _published_state(replication) -> int | None:
+    """Replication sequence of the published planet file, if its state matches it."""
+    state = replication.read_state(SHARED_PLANET_OSM_PARQUET_PATH)
+    return state["sequence"] if state else None
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    """Hardlink source at destination, copying across filesystems.
+
+    The shared file is only ever replaced by rename (copy_to_shared), so the
+    link never sees it rewritten.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
 with DAG(
     dag_display_name="OpenPlanetData OSM Planet GeoParquet",
     dag_id="openplanetdata_osm_geoparquet",
@@ -84,34 +198,134 @@ with DAG(
 
     @task(task_display_name="Prepare Work Directory")
     def prepare_work_dir() -> None:
-        # Pre-create WORK_DIR as the airflow user. The next task (build_contributions)
+        # Pre-create WORK_DIR as the airflow user. The next task (build_ohsome)
         # runs as root in eclipse-temurin and would otherwise own WORK_DIR, blocking
         # the later airflow-user task from creating .duckdb-temp inside it.
         os.makedirs(WORK_DIR, exist_ok=True)
 
-    build_contributions = DockerOperator(
-        task_id="build_contributions",
-        task_display_name="Build Ohsome Contributions",
-        image="eclipse-temurin:25-jdk",
+    build_ohsome = DockerOperator(
+        task_id="build_ohsome",
+        task_display_name="Build Ohsome Planet",
+        image=OHSOME_IMAGE,
         command=f"""bash -c '
             set -euo pipefail
 
             apt-get update -qq && apt-get install -y -qq git > /dev/null 2>&1
 
-            mkdir -p {WORK_DIR}
-
             # Clone and build ohsome-planet at a pinned release tag
-            OHSOME_SRC="{WORK_DIR}/ohsome-planet"
-            rm -rf "$OHSOME_SRC"
+            rm -rf {OHSOME_SRC}
             git clone --depth 1 --branch {OHSOME_PLANET_VERSION} --recurse-submodules \
-                https://github.com/GIScience/ohsome-planet.git "$OHSOME_SRC"
-            cd "$OHSOME_SRC"
+                https://github.com/GIScience/ohsome-planet.git {OHSOME_SRC}
+            cd {OHSOME_SRC}
             ./mvnw -q clean package -DskipTests
-            JAR_PATH="$OHSOME_SRC/ohsome-planet-cli/target/ohsome-planet.jar"
+            ls -lh {OHSOME_JAR}
+        '""",
+        force_pull=True,
+        mounts=[Mount(**DOCKER_MOUNT)],
+        mount_tmp_dir=False,
+        auto_remove="success",
+    )
+
+    @task.branch(task_display_name="Update GeoParquet")
+    def update_geoparquet() -> str:
+        """Apply the replication diffs to the stored partitions, or choose a full rebuild.
+
+        Continues with validate_geoparquet once the planet file is assembled
+        from the updated partitions, with build_contributions otherwise.
+        """
+        import time
+
+        subsets, replication, geoparquet = _utils()
+        started = time.time()
+        # ohsome, osmium and DuckDB run in their images, as the images' users
+        # like the DAG's DockerOperators, whatever the subset backend
+        # (OPENPLANETDATA_SUBSET_BACKEND) of the worker.
+        with subsets.container_runner(subsets.DockerRunner(image_user=True)):
+            try:
+                sequence = replication.replication_sequence(SHARED_PLANET_OSM_PBF_PATH)
+            except Exception as e:
+                print(f"Reading the replication sequence of {SHARED_PLANET_OSM_PBF_PATH} failed: {e}")
+                sequence = None
+            partitions_dir = geoparquet.GEOPARQUET_PARTITIONS_DIR
+            staging_dir = geoparquet.GEOPARQUET_STAGING_DIR
+            state = replication.read_state(geoparquet.manifest_path(partitions_dir))
+            mode, reason = replication.plan_update(
+                state, sequence, GEOPARQUET_UPDATE_MAX_HOURS, GEOPARQUET_REBUILD_DAYS,
+            )
+            if mode == "update" and GEOPARQUET_SORT_MODE != "bbox":
+                mode, reason = "rebuild", f"partitions need the bbox sort order, not {GEOPARQUET_SORT_MODE}"
+            print(f"GeoParquet {mode}: {reason}")
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+            if mode == "update":
+                try:
+                    geoparquet.install_duckdb(WORK_DIR)
+                    stats = {}
+                    if sequence > state["sequence"]:
+                        changes = replication.collect_changes(
+                            SHARED_PLANET_OSM_PBF_PATH, state["sequence"], sequence, CHANGES_DIR,
+                        )
+                        affected_ids = f"{CHANGES_DIR}/affected.ids"
+                        with open(affected_ids, "w", encoding="utf-8") as out:
+                            for key in ("members_ids", "related_ids"):
+                                with open(changes[key], encoding="utf-8") as fh:
+                                    shutil.copyfileobj(fh, out)
+                        replication.extract_ids(SHARED_PLANET_OSM_PBF_PATH, affected_ids, CONTEXT_PBF_PATH)
+                        print(f"Affected objects' extract: {os.path.getsize(CONTEXT_PBF_PATH):,} bytes")
+
+                        print(subsets.run_in_container(
+                            f"""set -euo pipefail
+rm -rf {DELTA_OHSOME_DIR}
+time java -Xmx{DELTA_OHSOME_HEAP} -XX:+UseCompactObjectHeaders -jar {OHSOME_JAR} \
+    contributions --pbf {CONTEXT_PBF_PATH} --data {DELTA_OHSOME_DIR}
+""",
+                            image=OHSOME_IMAGE,
+                            env={"HOME": WORK_DIR},
+                            step="ohsome contributions",
+                        ).decode())
+                        stats = geoparquet.update_partitions(
+                            partitions_dir,
+                            staging_dir,
+                            GEOPARQUET_SELECT.format(contributions=f"{DELTA_OHSOME_DIR}/contributions/*.parquet"),
+                            affected_ids,
+                            f"{GEOPARQUET_SORT_KEYS[GEOPARQUET_SORT_MODE]}, {GEOPARQUET_SORT_TIEBREAK}",
+                            WORK_DIR,
+                            sequence,
+                        )
+                        geoparquet.assemble_partitions(staging_dir, PARQUET_PATH, WORK_DIR)
+                        print(f"GeoParquet updated: {os.path.getsize(PARQUET_PATH):,} bytes")
+                    elif _published_state(replication) == state["sequence"]:
+                        # No diffs: the published file is the stored partitions'.
+                        _link_or_copy(SHARED_PLANET_OSM_PARQUET_PATH, PARQUET_PATH)
+                        print(f"GeoParquet unchanged since sequence {sequence}, reusing the published file")
+                    else:
+                        geoparquet.assemble_partitions(partitions_dir, PARQUET_PATH, WORK_DIR)
+                        print(f"GeoParquet reassembled: {os.path.getsize(PARQUET_PATH):,} bytes")
+
+                    replication.record_timing(
+                        "geoparquet", "update", time.time() - started,
+                        sequence=sequence, diffs=sequence - state["sequence"], **stats,
+                    )
+                    replication.report_timings("geoparquet")
+                    return "validate_geoparquet"
+                except Exception as e:
+                    print(f"GeoParquet update failed, rebuilding: {e}")
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+
+        with open(BUILD_PLAN_PATH, "w", encoding="utf-8") as fh:
+            json.dump({"sequence": sequence, "started": time.time()}, fh)
+        return "build_contributions"
+
+    build_contributions = DockerOperator(
+        task_id="build_contributions",
+        task_display_name="Build Ohsome Contributions",
+        image=OHSOME_IMAGE,
+        command=f"""bash -c '
+            set -euo pipefail
 
             rm -rf {OHSOME_DIR}
             echo "Building ohsome contributions..."
-            time java -Xms84g -Xmx84g -XX:+UseCompactObjectHeaders -jar "$JAR_PATH" \
+            time java -Xms84g -Xmx84g -XX:+UseCompactObjectHeaders -jar {OHSOME_JAR} \
                 contributions --pbf {SHARED_PLANET_OSM_PBF_PATH} --data {OHSOME_DIR}
 
             echo "Contributions build complete"
@@ -207,32 +421,9 @@ set +e
     SET memory_limit='65GB';
     SET preserve_insertion_order=false;
 
-    COPY (
-        SELECT
-            osm_type::ENUM ('node', 'way', 'relation') AS osm_type,
-            osm_id,
-            tags,
-            bbox,
-            CASE
-                WHEN osm_type = 'relation'
-                     AND ST_NPoints(geometry) = 5
-                     AND ST_Equals(geometry, ST_Envelope(geometry))
-                     AND members IS NOT NULL
-                THEN ST_Collect(list_transform(
-                    list_filter(members, lambda m: m.geometry IS NOT NULL),
-                    lambda m: ST_GeomFromWKB(m.geometry)
-                ))
-                ELSE geometry
-            END AS geometry
-        FROM '{OHSOME_DIR}/contributions/*.parquet'
-        WHERE status = 'latest'
-        ORDER BY bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax
-    ) TO '{PARQUET_PATH}.tmp' (
-        FORMAT PARQUET,
-        CODEC 'zstd',
-        COMPRESSION_LEVEL 6,
-        PARQUET_VERSION v2
-    );
+    COPY ({GEOPARQUET_SELECT.format(contributions=f"{OHSOME_DIR}/contributions/*.parquet")}
+        ORDER BY {GEOPARQUET_SORT_KEYS[GEOPARQUET_SORT_MODE]}, {GEOPARQUET_SORT_TIEBREAK}
+    ) TO '{PARQUET_PATH}.tmp' {GEOPARQUET_COPY_OPTIONS_SHELL};
 "
 DUCKDB_EXIT=$?
 set -e
@@ -257,9 +448,33 @@ ls -lh {PARQUET_PATH}
         auto_remove="success",
     )
 
+    @task(task_display_name="Split GeoParquet Partitions")
+    def split_geoparquet() -> None:
+        """Stage the rebuilt planet file as partitions for the next runs to update."""
+        import datetime
+        import time
+
+        _subsets, replication, geoparquet = _utils()
+        with open(BUILD_PLAN_PATH, encoding="utf-8") as fh:
+            plan = json.load(fh)
+        if GEOPARQUET_SORT_MODE == "bbox":
+            geoparquet.install_duckdb(WORK_DIR)
+            count = geoparquet.split_partitions(
+                PARQUET_PATH, geoparquet.GEOPARQUET_STAGING_DIR, WORK_DIR,
+                plan["sequence"], datetime.date.today().isoformat(),
+            )
+            print(f"Staged {count} partition(s)")
+        else:
+            print(f"No partitions for the {GEOPARQUET_SORT_MODE} sort order")
+
+        replication.record_timing("geoparquet", "rebuild", time.time() - plan["started"], sequence=plan["sequence"])
+        replication.report_timings("geoparquet")
+
     validate_geoparquet = DockerOperator(
         task_id="validate_geoparquet",
         task_display_name="Validate GeoParquet",
+        # Follows either the update or the rebuild; the other one is skipped.
+        trigger_rule="none_failed_min_one_success",
         image=OPENPLANETDATA_IMAGE,
         command=["bash", "-c", f"""set -euo pipefail
 
@@ -322,6 +537,22 @@ echo "All (osm_type, osm_id) pairs are unique"
             if os.path.exists(tmp_path):
                 os.remove(tmp_path)
 
+    @task(task_display_name="Commit GeoParquet Partitions")
+    def commit_partitions() -> None:
+        """Replace the stored partitions with this run's, now that its planet file is published."""
+        _subsets, replication, geoparquet = _utils()
+        manifest = geoparquet.commit_partitions(
+            geoparquet.GEOPARQUET_STAGING_DIR, geoparquet.GEOPARQUET_PARTITIONS_DIR,
+        )
+        if manifest is None:
+            print("No partitions staged")
+            return
+        print(f"Stored partitions are up to date with sequence {manifest['sequence']}")
+        if manifest["sequence"] is not None:
+            # The published file is now the partitions' concatenation: an
+            # update without diffs reuses it instead of assembling them again.
+            replication.write_state(SHARED_PLANET_OSM_PARQUET_PATH, manifest["sequence"], manifest["rebuilt"])
+
     @task(task_id="osm_geoparquet_done", task_display_name="Done")
     def done() -> None:
         """No-op gate task to propagate upstream failures to DAG run state."""
@@ -342,11 +573,17 @@ echo "All (osm_type, osm_id) pairs are unique"
 
     # Task flow
     download_result = download_planet_pbf()
-    download_result >> prepare_work_dir() >> build_contributions >> validate_contributions >> build_geoparquet >> validate_geoparquet
+    update_result = update_geoparquet()
+    download_result >> prepare_work_dir() >> build_ohsome >> update_result
+    update_result >> build_contributions >> validate_contributions >> build_geoparquet
+    build_geoparquet >> split_geoparquet() >> validate_geoparquet
+    update_result >> validate_geoparquet
 
     upload_result = upload_geoparquet()
     validate_geoparquet >> upload_result
     copy_result = copy_to_shared()
     upload_result >> copy_result
-    copy_result >> done()
-    copy_result >> cleanup
+    commit_result = commit_partitions()
+    copy_result >> commit_result
+    commit_result >> done()
+    commit_result >> cleanup
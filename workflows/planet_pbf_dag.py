@@ -1,21 +1,31 @@
 """
-Planet PBF DAG - Daily OSM planet PBF download and replication update.
+Planet PBF DAG - Daily OSM planet PBF replication update.
+
+The previous run's planet, in the shared directory, is rolled forward with
+the replication diffs since. The planet is downloaded by torrent instead when
+the weekly planet dump is newer than the one the local planet started from,
+or when the local planet fails validation against the replication state
+recorded next to it. Durations and bytes downloaded of both paths are
+recorded in the replication timings log.
 
 Schedule: Daily at 01:00 UTC
 Produces Asset: openplanetdata-osm-planet-pbf (triggers downstream DAGs)
 """
 
+import datetime
+import json
+import os
+import shlex
 import shutil
+import sys
+import time
 from datetime import timedelta
+from pathlib import Path
 
-from airflow.providers.docker.operators.docker import DockerOperator
 from airflow.sdk import DAG, Asset, task
-from docker.types import Mount
 from elaunira.airflow.providers.r2index.operators import UploadItem
 from elaunira.r2index.storage import R2TransferConfig
 from openplanetdata.airflow.defaults import (
-    DOCKER_MOUNT,
-    OPENPLANETDATA_IMAGE,
     OPENPLANETDATA_SHARED_DIR,
     OPENPLANETDATA_WORK_DIR,
     R2_BUCKET,
@@ -25,12 +35,115 @@ from openplanetdata.airflow.defaults import (
 
 WORK_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/pbf"
 PBF_PATH = f"{WORK_DIR}/planet-latest.osm.pbf"
+SOURCE_PATH = f"{WORK_DIR}/source.json"
+
+# Must match osm_replication.REPLICATION_URL: choose_source only rolls forward
+# a planet whose header names it.
+REPLICATION_URL = "https://planet.openstreetmap.org/replication/hour"
+
+DOWNLOAD_SCRIPT = f"""
+    mkdir -p {WORK_DIR} &&
+    cd {WORK_DIR} &&
+    aria2c \
+        --allow-overwrite=true \
+        --bt-max-peers=500 \
+        --bt-request-peer-speed-limit=0 \
+        --bt-save-metadata=false \
+        --continue=true \
+        --disk-cache=0 \
+        --enable-dht=true \
+        --enable-peer-exchange=true \
+        --file-allocation=falloc \
+        --max-connection-per-server=16 \
+        --max-download-limit=0 \
+        --max-overall-download-limit=0 \
+        --min-split-size=10M \
+        --seed-time=0 \
+        --split=128 \
+        --summary-interval=10 \
+        https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf.torrent \
+        --index-out=1=planet-latest.osm.pbf &&
+    ls -lh {PBF_PATH}
+"""
+
+UPDATE_SCRIPT = f"""
+    cd {WORK_DIR} &&
+    set +e
+    status=1
+    iteration=0
+
+    while [ "$status" -eq 1 ]; do
+        iteration=$((iteration + 1))
+        echo "=== Update iteration $iteration ==="
+        pyosmium-up-to-date \
+            -vv \
+            --server {REPLICATION_URL} \
+            --size 2048 \
+            planet-latest.osm.pbf
+        status=$?
+        echo "Exit status: $status"
+        if [ "$status" -gt 1 ]; then
+            echo "Error: pyosmium-up-to-date failed with status $status"
+            exit "$status"
+        elif [ "$status" -eq 1 ]; then
+            echo "More updates available, continuing..."
+        else
+            echo "Update complete!"
+        fi
+    done
+
+    echo ""
+    echo "=== Grace period: Running additional updates to ensure fully caught up ==="
+    for grace in 1 2 3; do
+        echo "--- Grace update attempt $grace ---"
+        pyosmium-up-to-date \
+            -vv \
+            --server {REPLICATION_URL} \
+            --size 2048 \
+            planet-latest.osm.pbf
+        grace_status=$?
+        echo "Grace attempt $grace exit status: $grace_status"
+        if [ "$grace_status" -gt 1 ]; then
+            echo "Error during grace period update"
+            exit "$grace_status"
+        elif [ "$grace_status" -eq 0 ]; then
+            echo "No additional updates needed"
+            break
+        fi
+    done
+
+    echo ""
+    echo "=== Final verification ==="
+    osmium fileinfo -e planet-latest.osm.pbf || true
+    rm -f *.torrent
+"""
 
 PBF_ASSET = Asset(
     name="openplanetdata-osm-planet-pbf",
     uri=f"s3://{R2_BUCKET}/osm/planet/pbf/v1/planet-latest.osm.pbf",
 )
 
+
+def _utils():
+    """Import workflows.utils.osm_subsets and osm_replication at task runtime (bundle-relative)."""
+    bundle_root = str(Path(__file__).resolve().parent.parent)
+    if bundle_root not in sys.path:
+        sys.path.insert(0, bundle_root)
+    from workflows.utils import osm_replication, osm_subsets
+
+    return osm_subsets, osm_replication
+
+
+def _docker(subsets):
+    """Run the task's containers on Docker, as their images' users.
+
+    Whatever the subset backend (OPENPLANETDATA_SUBSET_BACKEND) of the
+    worker: the bytes-downloaded metrics come from the containers' network
+    counters, which only Docker reports.
+    """
+    return subsets.container_runner(subsets.DockerRunner(image_user=True))
+
+
 with DAG(
     dag_display_name="OpenPlanetData OSM Planet PBF",
     dag_id="openplanetdata_osm_pbf",
@@ -43,107 +156,118 @@ with DAG(
         "retries": 0,
         "weight_rule": "elaunira.airflow.priority.OldestFirstPriorityStrategy",
     },
-    description="Daily OSM planet PBF download via torrent and replication update",
+    description="Daily OSM planet PBF replication update, rolled forward or downloaded via torrent",
     doc_md=__doc__,
     max_active_runs=1,
     schedule="0 1 * * *",
     tags=["openplanetdata", "osm", "pbf", "planet"],
 ) as dag:
 
-    download_planet = DockerOperator(
-        task_id="download_planet_pbf",
-        task_display_name="Download Planet PBF via Torrent",
-        image=OPENPLANETDATA_IMAGE,
-        command=f"""bash -c '
-            mkdir -p {WORK_DIR} &&
-            cd {WORK_DIR} &&
-            aria2c \
-                --allow-overwrite=true \
-                --bt-max-peers=500 \
-                --bt-request-peer-speed-limit=0 \
-                --bt-save-metadata=false \
-                --continue=true \
-                --disk-cache=0 \
-                --enable-dht=true \
-                --enable-peer-exchange=true \
-                --file-allocation=falloc \
-                --max-connection-per-server=16 \
-                --max-download-limit=0 \
-                --max-overall-download-limit=0 \
-                --min-split-size=10M \
-                --seed-time=0 \
-                --split=128 \
-                --summary-interval=10 \
-                https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf.torrent \
-                --index-out=1=planet-latest.osm.pbf &&
-            ls -lh {PBF_PATH}
-        '""",
-        force_pull=True,
-        mounts=[Mount(**DOCKER_MOUNT)],
-        mount_tmp_dir=False,
-        auto_remove="success",
-    )
+    @task.branch(task_display_name="Choose Planet Source")
+    def choose_source() -> str:
+        """Roll the previous planet forward, unless a torrent download is needed.
+
+        The shared planet copied by the previous run is updated from the
+        replication diffs since its sequence. It is downloaded again by torrent
+        when it fails validation (no state, or a state, size, mtime or header
+        that do not match) or when the weekly planet dump is newer than the
+        dump it was rolled forward from. The choice, the dump date and the
+        start time go to SOURCE_PATH for update_planet and copy_to_shared.
+        """
+        subsets, replication = _utils()
+        os.makedirs(WORK_DIR, exist_ok=True)
+        dump = replication.planet_dump_date()
+        state = replication.read_state(SHARED_PLANET_OSM_PBF_PATH)
+        source, reason = "torrent", "no local planet with a matching replication state"
+        if state is not None:
+            try:
+                with _docker(subsets):
+                    header = replication.replication_header(SHARED_PLANET_OSM_PBF_PATH)
+            except Exception as e:
+                header, reason = None, f"local planet header unreadable: {e}"
+            if header is None:
+                pass
+            elif header.get("osmosis_replication_base_url", "").rstrip("/") != REPLICATION_URL:
+                reason = f"local planet not on {REPLICATION_URL}"
+            elif str(header.get("osmosis_replication_sequence_number")) != str(state["sequence"]):
+                reason = f"local planet header sequence does not match its state ({state['sequence']})"
+            elif dump is not None and dump > state["rebuilt"]:
+                reason = f"planet dump of {dump} newer than the local planet's, of {state['rebuilt']}"
+            else:
+                source = "local"
+                reason = f"rolling forward from sequence {state['sequence']} (planet dump of {state['rebuilt']})"
+        print(f"Planet source {source}: {reason}")
 
-    update_planet = DockerOperator(
+        with open(SOURCE_PATH, "w") as fh:
+            json.dump({
+                "source": source,
+                "dump": state["rebuilt"] if source == "local" else dump or datetime.date.today().isoformat(),
+                "started": time.time(),
+            }, fh)
+        return "copy_local_planet" if source == "local" else "download_planet_pbf"
+
+    @task(task_display_name="Copy Local Planet PBF")
+    def copy_local_planet() -> None:
+        """Copy the shared planet into the work directory for update_planet to roll forward."""
+        subsets, _ = _utils()
+        copy = ["cp", "--reflink=auto", "--preserve=timestamps", SHARED_PLANET_OSM_PBF_PATH, PBF_PATH]
+        with _docker(subsets):
+            subsets.run_in_container(shlex.join(copy), step="planet copy")
+
+    @task(task_id="download_planet_pbf", task_display_name="Download Planet PBF via Torrent")
+    def download_planet() -> None:
+        """Download the weekly planet dump by torrent, recording the bytes received."""
+        subsets, _ = _utils()
+        with _docker(subsets):
+            run = subsets.run_container(DOWNLOAD_SCRIPT, step="planet torrent", stream_output=True)
+        print(f"Torrent download: {run.telemetry.rx_bytes:,} bytes received")
+        with open(SOURCE_PATH) as fh:
+            plan = json.load(fh)
+        plan["torrent_bytes"] = run.telemetry.rx_bytes
+        with open(SOURCE_PATH, "w") as fh:
+            json.dump(plan, fh)
+
+    @task(
         task_id="update_planet_pbf",
         task_display_name="Update PBF to Latest Replication State",
-        image=OPENPLANETDATA_IMAGE,
-        command=f"""bash -c '
-            cd {WORK_DIR} &&
-            set +e
-            status=1
-            iteration=0
-
-            while [ "$status" -eq 1 ]; do
-                iteration=$((iteration + 1))
-                echo "=== Update iteration $iteration ==="
-                pyosmium-up-to-date \
-                    -vv \
-                    --server https://planet.openstreetmap.org/replication/hour \
-                    --size 2048 \
-                    planet-latest.osm.pbf
-                status=$?
-                echo "Exit status: $status"
-                if [ "$status" -gt 1 ]; then
-                    echo "Error: pyosmium-up-to-date failed with status $status"
-                    exit "$status"
-                elif [ "$status" -eq 1 ]; then
-                    echo "More updates available, continuing..."
-                else
-                    echo "Update complete!"
-                fi
-            done
-
-            echo ""
-            echo "=== Grace period: Running additional updates to ensure fully caught up ==="
-            for grace in 1 2 3; do
-                echo "--- Grace update attempt $grace ---"
-                pyosmium-up-to-date \
-                    -vv \
-                    --server https://planet.openstreetmap.org/replication/hour \
-                    --size 2048 \
-                    planet-latest.osm.pbf
-                grace_status=$?
-                echo "Grace attempt $grace exit status: $grace_status"
-                if [ "$grace_status" -gt 1 ]; then
-                    echo "Error during grace period update"
-                    exit "$grace_status"
-                elif [ "$grace_status" -eq 0 ]; then
-                    echo "No additional updates needed"
-                    break
-                fi
-            done
-
-            echo ""
-            echo "=== Final verification ==="
-            osmium fileinfo -e planet-latest.osm.pbf || true
-            rm -f *.torrent
-        '""",
-        force_pull=True,
-        mounts=[Mount(**DOCKER_MOUNT)],
-        mount_tmp_dir=False,
-        auto_remove="success",
+        trigger_rule="none_failed_min_one_success",
     )
+    def update_planet() -> None:
+        """Apply the replication diffs since the planet's sequence with pyosmium-up-to-date.
+
+        The run is recorded in the replication timings log as a pbf update
+        (rolled forward from the local planet) or rebuild (torrent download),
+        with the bytes downloaded: the torrent's plus the diffs'. If rolling
+        the local planet forward fails, the run fails; the local planet's
+        state is only dropped, so that the next run downloads the planet
+        again, when osmium cannot read the local planet itself. A failure of
+        the replication server keeps it.
+        """
+        subsets, replication = _utils()
+        with open(SOURCE_PATH) as fh:
+            plan = json.load(fh)
+        with _docker(subsets):
+            try:
+                run = subsets.run_container(UPDATE_SCRIPT, step="planet update", stream_output=True)
+            except Exception:
+                if plan["source"] == "local" and not replication.osm_file_readable(SHARED_PLANET_OSM_PBF_PATH):
+                    replication.drop_state(SHARED_PLANET_OSM_PBF_PATH)
+                raise
+            plan["sequence"] = replication.replication_sequence(PBF_PATH)
+        with open(SOURCE_PATH, "w") as fh:
+            json.dump(plan, fh)
+        torrent_bytes = plan.get("torrent_bytes", 0)
+        diff_bytes = run.telemetry.rx_bytes
+        replication.record_timing(
+            "pbf",
+            "update" if plan["source"] == "local" else "rebuild",
+            time.time() - plan["started"],
+            sequence=plan["sequence"],
+            downloaded=torrent_bytes + diff_bytes,
+            torrent_bytes=torrent_bytes,
+            diff_bytes=diff_bytes,
+        )
+        replication.report_timings("pbf")
 
     @task.r2index_upload(
         task_display_name="Upload PBF to R2",
@@ -169,14 +293,21 @@ with DAG(
 
     @task(task_display_name="Copy to Shared Directory", outlets=[PBF_ASSET])
     def copy_to_shared() -> None:
-        """Copy planet PBF to shared directory atomically for use by other DAGs."""
-        import os
+        """Copy planet PBF to shared directory atomically for use by other DAGs.
+
+        Along with its replication state, which validates it as the starting
+        point of the next run (see choose_source).
+        """
+        _, replication = _utils()
+        with open(SOURCE_PATH) as fh:
+            plan = json.load(fh)
 
         os.makedirs(OPENPLANETDATA_SHARED_DIR, exist_ok=True)
         tmp_path = f"{SHARED_PLANET_OSM_PBF_PATH}.tmp"
         try:
             shutil.copy2(PBF_PATH, tmp_path)
             os.rename(tmp_path, SHARED_PLANET_OSM_PBF_PATH)
+            replication.write_state(SHARED_PLANET_OSM_PBF_PATH, plan["sequence"], plan["dump"])
         finally:
             if os.path.exists(tmp_path):
                 os.remove(tmp_path)
@@ -191,9 +322,10 @@ with DAG(
         shutil.rmtree(WORK_DIR, ignore_errors=True)
 
     # Task flow
-    download_planet >> update_planet
+    update_result = update_planet()
+    choose_source() >> [copy_local_planet(), download_planet()] >> update_result
     upload_result = upload_pbf()
-    update_planet >> upload_result
+    update_result >> upload_result
     copy_result = copy_to_shared()
     upload_result >> copy_result
     copy_result >> done()
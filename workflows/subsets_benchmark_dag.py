@@ -12,6 +12,27 @@ loses at most one step's log. The final report task aggregates the timings
 into a summary. Use the numbers to calibrate the daily/weekly cadence of the
 subsets DAGs.
 
+Before the per-subset chains, the boundary-preparation engines (in-process
+Shapely pool vs one ogr2ogr container per code) are timed against each other
+on the full continents and regions aggregates, and their prepared outlines
+are compared.
+
+After the per-subset chains, the planet GeoParquet snapshot is rewritten in
+every planet layout (sort order x row group size, see planet_geoparquet_dag)
+and the three GeoParquet extracts are repeated against each copy, reporting
+wall time and the number of row groups the bbox prefilter cannot prune.
+
+Container overhead is measured too: the same trivial step run in a new
+container each time and as an exec in a pooled warm container, the per-step
+cost every gol and osmium call of the subset DAGs pays or saves.
+
+Every run is appended to a history store outside WORK_DIR with its timings,
+output sizes and environment (tool image digests, DuckDB and osmium
+versions, host). The report compares each step with the median of the
+previous runs and flags (and fails on) any step that regressed beyond
+BENCHMARK_REGRESSION_THRESHOLD, so a DuckDB `latest` bump or a gol upgrade
+that slows an extract is caught by the next benchmark.
+
 Also verifies extract semantics:
 - the FR PBF includes overseas territories (Reunion bbox must match features)
 - the subset PBF rebuilds into a GOL (gol >= 2.3.2 rejects ways with missing
@@ -38,6 +59,15 @@ from openplanetdata.airflow.defaults import (
     SHARED_PLANET_OSM_PBF_PATH,
 )
 
+# The planet sort keys are needed at parse time (DAG-level constants), so the
+# bundle root goes on sys.path here too, not only in _utils; geoparquet_layout
+# only imports the standard library, unlike the modules _utils loads.
+_BUNDLE_ROOT = str(Path(__file__).resolve().parent.parent)
+if _BUNDLE_ROOT not in sys.path:
+    sys.path.insert(0, _BUNDLE_ROOT)
+
+from workflows.utils.geoparquet_layout import GEOPARQUET_SORT_KEYS, GEOPARQUET_SORT_TIEBREAK  # noqa: E402
+
 WORK_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/benchmark"
 BOUNDARIES_DIR = f"{WORK_DIR}/boundaries"
 SNAPSHOT_GOL = f"{WORK_DIR}/planet-latest.osm.gol"
@@ -51,6 +81,39 @@ BENCHMARK_SUBSETS = [
     ("FR-IDF", "regions", "boundaries/regions/FR-IDF/geojson", "FR-IDF-latest.boundary.geojson"),
 ]
 
+# Planet aggregates prepared with every boundary engine:
+# (name, code property, R2 boundary path, aggregate filename)
+ENGINE_BENCHMARK_DIR = f"{WORK_DIR}/boundary-engines"
+ENGINE_BENCHMARK_AGGREGATES = [
+    ("continents", "slug", "boundaries/continents/planet/geojson", "planet-latest.continents.geojson"),
+    ("regions", "code", "boundaries/regions/planet/geojson", "planet-latest.regions.geojson"),
+]
+BOUNDARY_ENGINES = ["ogr2ogr", "shapely"]
+
+# Every planet sort order (GEOPARQUET_SORT_KEYS) is compared on the
+# GeoParquet extracts.
+SORT_ORDER_DIR = f"{WORK_DIR}/sort-orders"
+# Row group sizes compared for every sort order; the winner becomes
+# GEOPARQUET_ROW_GROUP_SIZE.
+ROW_GROUP_SIZES = [30_720, 61_440, 122_880]
+PLANET_LAYOUTS = [(mode, size) for mode in GEOPARQUET_SORT_KEYS for size in ROW_GROUP_SIZES]
+
+# Trivial steps timed per container runner: a new container per step (the
+# DockerRunner) versus an exec in a warm container (the ContainerPool the
+# subset batches use). The difference is the per-step overhead saved.
+CONTAINER_OVERHEAD_STEPS = 20
+
+# One JSON line per benchmark run; survives the manual removal of WORK_DIR.
+BENCHMARK_HISTORY_PATH = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/benchmark-history.jsonl"
+# A step regressed when it is slower than the median of the same step in the
+# last BENCHMARK_BASELINE_RUNS runs by more than the threshold (relative) and
+# BENCHMARK_REGRESSION_MIN_SECONDS (absolute: cache hits and other
+# sub-second steps are noise).
+BENCHMARK_BASELINE_RUNS = 5
+BENCHMARK_REGRESSION_THRESHOLD = 0.2
+BENCHMARK_REGRESSION_MIN_SECONDS = 30.0
+BENCHMARK_FAIL_ON_REGRESSION = True
+
 # Reunion island: proof that the FR extract includes overseas territories.
 REUNION_BBOX = (55.2, -21.4, 55.9, -20.8)
 
@@ -65,12 +128,90 @@ def _utils():
     return osm_subsets
 
 
-def _print_sizes(code: str, level: str) -> None:
+def _print_sizes(code: str, level: str) -> dict[str, int]:
     subset_dir = f"{WORK_DIR}/{level}/{code}"
     print(f"[{code}] output sizes:")
+    sizes = {}
     for entry in sorted(os.listdir(subset_dir)):
-        size = os.path.getsize(f"{subset_dir}/{entry}")
-        print(f"  {entry}: {size / 1024**3:,.2f} GiB")
+        if not os.path.isfile(f"{subset_dir}/{entry}"):
+            continue
+        sizes[entry] = os.path.getsize(f"{subset_dir}/{entry}")
+        print(f"  {entry}: {sizes[entry] / 1024**3:,.2f} GiB")
+    return sizes
+
+
+def _benchmark_environment(subsets) -> dict:
+    """Execution backend, tool image digests and versions, and the host, of this benchmark run."""
+    import platform
+
+    import docker
+    from docker.errors import ImageNotFound
+
+    images = {}
+    if subsets.SUBSET_EXECUTION_BACKEND == "docker":
+        client = docker.from_env()
+        for image in (subsets.OPENPLANETDATA_IMAGE, subsets.OSMIUM_IMAGE, subsets.GDAL_FULL_IMAGE):
+            try:
+                attrs = client.images.get(image).attrs
+                images[image] = (attrs.get("RepoDigests") or [attrs["Id"]])[0]
+            except ImageNotFound:
+                images[image] = None
+    duckdb = subsets.run_in_container(f"{WORK_DIR}/duckdb -version", env={"HOME": WORK_DIR}, stdout_only=True)
+    osmium = subsets.run_in_container(["--version"], image=subsets.OSMIUM_IMAGE, stdout_only=True, shell=False)
+    total, _available = subsets.host_memory()
+    return {
+        "backend": subsets.SUBSET_EXECUTION_BACKEND,
+        "images": images,
+        "duckdb": duckdb.decode().strip(),
+        "osmium": osmium.decode().splitlines()[0].strip(),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "memory_bytes": total,
+        "kernel": platform.release(),
+    }
+
+
+def _read_benchmark_history() -> list[dict]:
+    import json
+
+    try:
+        with open(BENCHMARK_HISTORY_PATH, "r", encoding="utf-8") as fh:
+            return [json.loads(line) for line in fh if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _benchmark_regressions(timings: list[dict], history: list[dict]) -> list[str]:
+    """Compare timings with the rolling baseline; return the regressions.
+
+    Prints every step next to its baseline (median of the last
+    BENCHMARK_BASELINE_RUNS runs that had it).
+    """
+    import statistics
+
+    previous: dict[tuple[str, str], list[float]] = {}
+    for run in history:
+        for timing in run["timings"]:
+            previous.setdefault((timing["code"], timing["step"]), []).append(timing["elapsed"])
+
+    regressions = []
+    print(f"\n=== Against the baseline (median of the last {BENCHMARK_BASELINE_RUNS} runs) ===")
+    for timing in timings:
+        key = (timing["code"], timing["step"])
+        line = f"{timing['code']:10s} {timing['step']:20s} {timing['elapsed']:10,.1f}s"
+        runs = previous.get(key, [])[-BENCHMARK_BASELINE_RUNS:]
+        if not runs:
+            print(f"{line}   (no baseline)")
+            continue
+        baseline = statistics.median(runs)
+        change = timing["elapsed"] / baseline - 1 if baseline else 0.0
+        line += f" {baseline:10,.1f}s {change:+7.1%}"
+        if (change > BENCHMARK_REGRESSION_THRESHOLD
+                and timing["elapsed"] - baseline > BENCHMARK_REGRESSION_MIN_SECONDS):
+            line += "   REGRESSION"
+            regressions.append(f"{timing['code']} {timing['step']}: {baseline:,.1f}s -> {timing['elapsed']:,.1f}s")
+        print(line)
+    return regressions
 
 
 with DAG(
@@ -132,6 +273,20 @@ with DAG(
             source_version="v2",
         )
 
+    @task.r2index_download(
+        task_display_name="Download Benchmark Aggregates",
+        bucket=R2_BUCKET,
+        r2index_conn_id=R2INDEX_CONNECTION_ID,
+    )
+    def download_aggregate(source_path: str, filename: str) -> DownloadItem:
+        """Download one planet boundary aggregate for the engine benchmark."""
+        return DownloadItem(
+            destination=f"{ENGINE_BENCHMARK_DIR}/{filename}",
+            source_filename=filename,
+            source_path=source_path,
+            source_version="v2",
+        )
+
     @task(task_display_name="Install DuckDB")
     def install_duckdb() -> None:
         """Download the DuckDB CLI once into the work directory."""
@@ -166,23 +321,129 @@ with DAG(
         for code, level, _path, _filename in BENCHMARK_SUBSETS:
             shutil.rmtree(f"{WORK_DIR}/{level}/{code}", ignore_errors=True)
             for leftover in (f"{WORK_DIR}/{level}/{code}.done", f"{BOUNDARIES_DIR}/{code}.meta.json",
-                             f"{BOUNDARIES_DIR}/{code}.prepared.geojson"):
+                             f"{BOUNDARIES_DIR}/{code}.prepared.geojson",
+                             f"{BOUNDARIES_DIR}/{code}.osmium.geojson",
+                             f"{BOUNDARIES_DIR}/{code}.pieces.geojson",
+                             f"{BOUNDARIES_DIR}/{code}.grid.csv"):
                 if os.path.exists(leftover):
                     os.remove(leftover)
 
+    @task(task_display_name="Benchmark Boundary Engines")
+    def benchmark_boundary_engines() -> list[dict]:
+        """Prepare the continents and regions aggregates with every engine.
+
+        Each engine works on its own hardlinked copy of the split raw files,
+        so neither can reuse the other's outputs. Outlines are compared by the
+        symmetric-difference area relative to the ogr2ogr result.
+        """
+        import shutil
+
+        import shapely
+
+        subsets = _utils()
+        timings = []
+        for name, code_property, _path, filename in ENGINE_BENCHMARK_AGGREGATES:
+            root = f"{ENGINE_BENCHMARK_DIR}/{name}"
+            shutil.rmtree(root, ignore_errors=True)
+            codes = subsets.split_boundary_aggregate(
+                f"{ENGINE_BENCHMARK_DIR}/{filename}", code_property, f"{root}/split",
+            )
+            prepared = {}
+            for engine in BOUNDARY_ENGINES:
+                engine_dir = f"{root}/{engine}"
+                os.makedirs(engine_dir)
+                for code in codes:
+                    os.link(f"{root}/split/{code}.raw.geojson", f"{engine_dir}/{code}.raw.geojson")
+                start = time.monotonic()
+                failures = subsets.prepare_boundaries(codes, engine_dir, engine=engine)
+                elapsed = time.monotonic() - start
+                print(f"[{name}] {engine}: {len(codes)} boundaries in {elapsed:,.1f}s "
+                      f"({len(failures)} failed)")
+                prepared[engine] = {code for code in codes if code not in failures}
+                timings.append({"code": name, "step": f"prepare ({engine})", "elapsed": elapsed})
+
+            deviations = []
+            for code in sorted(prepared["ogr2ogr"] & prepared["shapely"]):
+                outlines = []
+                for engine in ("ogr2ogr", "shapely"):
+                    with open(f"{root}/{engine}/{code}.prepared.geojson", "r", encoding="utf-8") as fh:
+                        outlines.append(shapely.from_geojson(fh.read()))
+                reference, candidate = outlines
+                deviations.append((
+                    shapely.symmetric_difference(reference, candidate).area / reference.area,
+                    code,
+                ))
+            if deviations:
+                deviations.sort(reverse=True)
+                mean = sum(d for d, _code in deviations) / len(deviations)
+                print(f"[{name}] outline deviation (sym. difference / area): mean {mean:.4%}, "
+                      f"worst {deviations[0][0]:.4%} ({deviations[0][1]})")
+        return timings
+
+    @task(task_display_name="Benchmark Container Overhead")
+    def benchmark_container_overhead() -> list[dict]:
+        """Time a no-op step in a new container per step and in a warm pooled one.
+
+        Both go through run_in_container (stats sampling included), with
+        the gol steps' memory limit, so the difference is what the pool saves
+        on every step of a subset build. Under the local execution backend,
+        times a native process per step instead.
+        """
+        import contextlib
+        import statistics
+
+        subsets = _utils()
+
+        def time_steps() -> list[float]:
+            durations = []
+            for _ in range(CONTAINER_OVERHEAD_STEPS):
+                start = time.monotonic()
+                subsets.run_in_container("true", mem_limit=subsets.GOL_MEM_LIMIT)
+                durations.append(time.monotonic() - start)
+            return durations
+
+        if subsets.SUBSET_EXECUTION_BACKEND == "docker":
+            runners = [("new container", contextlib.nullcontext), ("pooled exec", subsets.container_pool)]
+        else:
+            runners = [("local process", contextlib.nullcontext)]
+        medians = []
+        timings = []
+        for runner, context in runners:
+            with context():
+                # The first step pulls the image (and creates the warm container).
+                subsets.run_in_container("true", mem_limit=subsets.GOL_MEM_LIMIT)
+                durations = time_steps()
+            medians.append(statistics.median(durations))
+            print(f"{runner:14s}: median {medians[-1]:.3f}s, "
+                  f"max {max(durations):.3f}s per step ({len(durations)} steps)")
+            timings.append({"code": "containers", "step": f"{runner} x{len(durations)}", "elapsed": sum(durations)})
+        if len(medians) == 2:
+            saved = medians[0] - medians[1]
+            print(f"Saved per step: {saved:.3f}s (~{saved * 12_000 / 60:,.0f} min over the ~12,000 steps "
+                  f"of a regions run)")
+        return timings
+
     @task
     def prepare_boundary(code: str) -> dict:
-        """Buffer + simplify one boundary; fail loudly if preparation fails."""
+        """Buffer + simplify one boundary; fail loudly if preparation fails.
+
+        Goes through the boundary cache shared with the subset DAGs, so a
+        boundary unchanged since the last run is a cache hit. Hits and misses
+        are timed as separate steps: each is compared with the baseline of
+        its own kind.
+        """
         from airflow.exceptions import AirflowException
 
         subsets = _utils()
+        cached = subsets.boundary_cache_hit(code, BOUNDARIES_DIR, subsets.BOUNDARY_CACHE_DIR)
+        step = f"prepare boundary ({'cache hit' if cached else 'cache miss'})"
         start = time.monotonic()
-        failure = subsets.prepare_boundary(code, BOUNDARIES_DIR)
+        failures = subsets.prepare_boundaries([code], BOUNDARIES_DIR, cache_dir=subsets.BOUNDARY_CACHE_DIR)
         elapsed = time.monotonic() - start
-        print(f"[{code}] prepare boundary: {elapsed:,.1f}s")
-        if failure is not None:
+        print(f"[{code}] {step}: {elapsed:,.1f}s")
+        if failures:
             raise AirflowException(f"[{code}] boundary preparation failed")
-        return {"code": code, "step": "prepare boundary", "elapsed": elapsed}
+        return {"code": code, "step": step, "elapsed": elapsed}
 
     @task
     def build_files(code: str, level: str) -> dict:
@@ -193,19 +454,21 @@ with DAG(
         level_dir = f"{WORK_DIR}/{level}"
         os.makedirs(level_dir, exist_ok=True)
         start = time.monotonic()
-        result = subsets.build_subset_files(
-            code,
-            level_dir,
-            BOUNDARIES_DIR,
-            SNAPSHOT_GOL,
-            snapshot_pbf=SNAPSHOT_PBF if level == "continents" else None,
-        )
+        # Pooled like the subset batches, so the timing matches theirs.
+        with subsets.container_pool():
+            result = subsets.build_subset_files(
+                code,
+                level_dir,
+                BOUNDARIES_DIR,
+                SNAPSHOT_GOL,
+                snapshot_pbf=SNAPSHOT_PBF if level == "continents" else None,
+            )
         elapsed = time.monotonic() - start
         print(f"[{code}] pbf + gol + gob: {elapsed:,.1f}s")
         if result is not None:
             raise AirflowException(f"[{code}] pipeline failed: {result}")
-        _print_sizes(code, level)
-        return {"code": code, "step": "pbf + gol + gob", "elapsed": elapsed}
+        sizes = _print_sizes(code, level)
+        return {"code": code, "step": "pbf + gol + gob", "elapsed": elapsed, "sizes": sizes}
 
     @task
     def build_geoparquet(code: str, level: str) -> dict:
@@ -220,13 +483,128 @@ with DAG(
         print(f"[{code}] geoparquet: {elapsed:,.1f}s")
         if failed:
             raise AirflowException(f"[{code}] parquet extraction failed")
-        _print_sizes(code, level)
-        return {"code": code, "step": "geoparquet", "elapsed": elapsed}
+        sizes = {
+            name: size for name, size in _print_sizes(code, level).items() if name.endswith(".parquet")
+        }
+        return {"code": code, "step": "geoparquet", "elapsed": elapsed, "sizes": sizes}
+
+    @task(task_display_name="Benchmark Sort Orders", execution_timeout=timedelta(hours=24))
+    def benchmark_sort_orders() -> list[dict]:
+        """Rewrite the planet GeoParquet snapshot per layout and repeat every extract against it.
+
+        The current layout is rewritten too rather than linked, so every copy
+        comes from the same DuckDB writer (statistics, metadata). Each copy is
+        deleted once benchmarked, so at most one is on disk. Row groups read
+        are those whose bbox column statistics overlap the subset bbox, i.e.
+        the ones DuckDB's min/max pruning has to scan.
+        """
+        import json
+        import shutil
+
+        subsets = _utils()
+        shutil.rmtree(SORT_ORDER_DIR, ignore_errors=True)
+        os.makedirs(SORT_ORDER_DIR)
+        timings = []
+        for mode, row_group_size in PLANET_LAYOUTS:
+            layout = f"{mode}-{row_group_size}"
+            planet = f"{SORT_ORDER_DIR}/planet-{layout}.osm.parquet"
+            sql_path = f"{SORT_ORDER_DIR}/sort-{layout}.sql"
+            with open(sql_path, "w", encoding="utf-8") as fh:
+                fh.write(f"""
+SET extension_directory='{WORK_DIR}/.duckdb-extensions';
+SET temp_directory='{WORK_DIR}/.duckdb-temp';
+INSTALL 'spatial'; LOAD 'spatial';
+SET memory_limit='{subsets.PARQUET_DUCKDB_MEMORY_LIMIT}';
+COPY (
+    SELECT * REPLACE (ST_AsWKB(geometry) AS geometry)
+    FROM read_parquet('{SNAPSHOT_PARQUET}')
+    ORDER BY {GEOPARQUET_SORT_KEYS[mode]}, {GEOPARQUET_SORT_TIEBREAK}
+) TO '{planet}' {subsets.parquet_copy_options(row_group_size)};
+""")
+            start = time.monotonic()
+            subsets.run_in_container(
+                f"{WORK_DIR}/duckdb -f {sql_path}",
+                env={"HOME": WORK_DIR},
+                mem_limit=subsets.PARQUET_CONTAINER_MEM_LIMIT,
+            )
+            print(f"[planet] {layout} rewrite: {time.monotonic() - start:,.1f}s")
+
+            for code, _level, _path, _filename in BENCHMARK_SUBSETS:
+                with open(f"{BOUNDARIES_DIR}/{code}.meta.json", "r", encoding="utf-8") as fh:
+                    minx, miny, maxx, maxy = json.load(fh)["bbox"]
+                stats_sql_path = f"{SORT_ORDER_DIR}/row-groups-{layout}-{code}.sql"
+                with open(stats_sql_path, "w", encoding="utf-8") as fh:
+                    fh.write(f"""
+WITH stats AS (
+    SELECT
+        row_group_id,
+        min(stats_min_value::DOUBLE) FILTER (WHERE path_in_schema = 'bbox, xmin') AS xmin,
+        min(stats_min_value::DOUBLE) FILTER (WHERE path_in_schema = 'bbox, ymin') AS ymin,
+        max(stats_max_value::DOUBLE) FILTER (WHERE path_in_schema = 'bbox, xmax') AS xmax,
+        max(stats_max_value::DOUBLE) FILTER (WHERE path_in_schema = 'bbox, ymax') AS ymax
+    FROM parquet_metadata('{planet}')
+    GROUP BY row_group_id
+)
+SELECT
+    count(*) FILTER (WHERE xmax >= {minx} AND xmin <= {maxx} AND ymax >= {miny} AND ymin <= {maxy}),
+    count(*)
+FROM stats;
+""")
+                out = subsets.run_in_container(
+                    f"{WORK_DIR}/duckdb -csv -noheader -f {stats_sql_path}",
+                    env={"HOME": WORK_DIR},
+                    stdout_only=True,
+                )
+                row_groups_read, row_groups = (int(v) for v in out.decode().strip().split(","))
+
+                output_dir = f"{SORT_ORDER_DIR}/{layout}"
+                os.makedirs(output_dir, exist_ok=True)
+                sql_path = f"{output_dir}/{code}.sql"
+                with open(sql_path, "w", encoding="utf-8") as fh:
+                    fh.write(f"""
+SET extension_directory='{WORK_DIR}/.duckdb-extensions';
+SET temp_directory='{WORK_DIR}/.duckdb-temp';
+INSTALL 'spatial'; LOAD 'spatial';
+SET memory_limit='{subsets.PARQUET_DUCKDB_MEMORY_LIMIT}';
+SET threads={subsets.PARQUET_DUCKDB_THREADS};
+{subsets.parquet_copy_sql(code, f"{output_dir}/{code}-latest.osm.parquet", BOUNDARIES_DIR, planet)}
+""")
+                start = time.monotonic()
+                subsets.run_in_container(
+                    f"{WORK_DIR}/duckdb -f {sql_path}",
+                    env={"HOME": WORK_DIR},
+                    mem_limit=subsets.PARQUET_CONTAINER_MEM_LIMIT,
+                )
+                elapsed = time.monotonic() - start
+                print(f"[{code}] {layout}: {elapsed:,.1f}s, "
+                      f"{row_groups_read:,} / {row_groups:,} row groups read")
+                timings.append({
+                    "code": code,
+                    "step": f"geoparquet ({layout})",
+                    "elapsed": elapsed,
+                    "row_groups_read": row_groups_read,
+                    "row_groups": row_groups,
+                    "sizes": {
+                        f"{code}-latest.osm.parquet": os.path.getsize(f"{output_dir}/{code}-latest.osm.parquet"),
+                    },
+                })
+            os.remove(planet)
+        return timings
 
     @task(task_display_name="Verify Semantics & Report")
-    def verify_and_report(timings: list[dict]) -> None:
-        """Check overseas-territory semantics on FR and print the timing summary."""
+    def verify_and_report(
+        timings: list[dict], engine_timings: list[dict], container_timings: list[dict], sort_timings: list[dict],
+    ) -> None:
+        """Check overseas-territory semantics on FR, report and record the run.
+
+        The run (timings, output sizes, environment) is appended to
+        BENCHMARK_HISTORY_PATH before the comparison with the baseline, so a
+        regression fails the task but is still part of the history.
+        """
+        import json
+
         from airflow.exceptions import AirflowException
+        from airflow.sdk import get_current_context
 
         subsets = _utils()
 
@@ -260,10 +638,42 @@ with DAG(
             raise AirflowException("FR GOL subset is missing Reunion - overseas territories dropped")
         print("[FR] Reunion present in subset GOL")
 
+        all_timings = engine_timings + container_timings + timings + sort_timings
         print("\n=== Benchmark summary ===")
-        for timing in timings:
-            print(f"{timing['code']:10s} {timing['step']:20s} {timing['elapsed']:10,.1f}s")
+        for timing in all_timings:
+            line = f"{timing['code']:10s} {timing['step']:20s} {timing['elapsed']:10,.1f}s"
+            if "row_groups" in timing:
+                line += f" {timing['row_groups_read']:>8,} / {timing['row_groups']:,} row groups"
+            if timing.get("sizes"):
+                line += f" {sum(timing['sizes'].values()) / 1024**3:10,.2f} GiB"
+            print(line)
+
+        history = _read_benchmark_history()
+        environment = _benchmark_environment(subsets)
+        if history:
+            changed = {
+                key: (history[-1]["environment"].get(key), value)
+                for key, value in environment.items()
+                if history[-1]["environment"].get(key) != value
+            }
+            for key, (before, after) in changed.items():
+                print(f"Environment change since the last run: {key}: {before} -> {after}")
+        os.makedirs(os.path.dirname(BENCHMARK_HISTORY_PATH), exist_ok=True)
+        with open(BENCHMARK_HISTORY_PATH, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps({
+                "run_id": get_current_context()["run_id"],
+                "recorded": time.time(),
+                "environment": environment,
+                "timings": all_timings,
+            }) + "\n")
+
+        regressions = _benchmark_regressions(all_timings, history)
         print(f"\nOutputs kept in {WORK_DIR} for inspection - remove manually when done.")
+        if regressions:
+            message = f"{len(regressions)} step(s) regressed: " + "; ".join(regressions)
+            print(message)
+            if BENCHMARK_FAIL_ON_REGRESSION:
+                raise AirflowException(message)
 
     # Task flow: one prepare/build/geoparquet chain per subset, run
     # sequentially (max_active_tasks=1) so timings never overlap.
@@ -274,15 +684,24 @@ with DAG(
         )
         for code, _level, path, filename in BENCHMARK_SUBSETS
     ]
+    aggregate_downloads = [
+        download_aggregate.override(task_id=f"download_aggregate_{name}")(
+            source_path=path, filename=filename,
+        )
+        for name, _property, path, filename in ENGINE_BENCHMARK_AGGREGATES
+    ]
     normalized = normalize_boundaries()
     duckdb_install = install_duckdb()
     reset = reset_outputs()
+    engine_timings = benchmark_boundary_engines()
+    container_timings = benchmark_container_overhead()
 
-    snapshot >> downloads
-    downloads >> normalized >> duckdb_install >> reset
+    snapshot >> downloads + aggregate_downloads
+    downloads >> normalized
+    [normalized, *aggregate_downloads] >> duckdb_install >> reset >> engine_timings >> container_timings
 
     timings = []
-    previous = reset
+    previous = container_timings
     for code, level, _path, _filename in BENCHMARK_SUBSETS:
         slug = code.lower().replace("-", "_")
         prepared = prepare_boundary.override(
@@ -301,4 +720,9 @@ with DAG(
         timings += [prepared, built, parquet]
         previous = parquet
 
-    verify_and_report(timings=timings)
+    sort_timings = benchmark_sort_orders()
+    previous >> sort_timings
+
+    verify_and_report(
+        timings=timings, engine_timings=engine_timings, container_timings=container_timings, sort_timings=sort_timings,
+    )
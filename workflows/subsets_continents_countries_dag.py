@@ -6,19 +6,38 @@ have all been refreshed (same-day snapshot consistency) - i.e. it follows the
 planet pipeline's cadence, currently daily.
 
 Pipeline per subset (see workflows/utils/osm_subsets.py):
-1. osmium extract from planet PBF for continents; gol query followed by an
-   osmium complete_ways post-filter for countries
+1. osmium extract from planet PBF for continents (all continents in one
+   multi-extract pass over the planet); for countries, osmium complete_ways
+   from the smallest continent PBF that covers the country, or the same
+   complete_ways cut from the planet PBF for the countries no continent
+   covers (overseas territories, boundaries that cross continents), made in
+   the continents' multi-extract pass. A country whose PBF an
+   earlier run stored is refreshed instead: the replication diffs since
+   are replayed on the stored PBF, which is cut again with complete_ways
+   against what the planet holds around the changed objects (read once per
+   run), and a country whose content did not change skips steps 2-4
 2. gol build + gol save for the subset GOL/GOB
 3. DuckDB COPY from a snapshot of the planet GeoParquet (bbox pruning + ST_Intersects)
 4. Upload all four formats to R2
 
+Continent batches run before country batches so the continent PBFs are
+available as parents; uploaded country PBFs are kept in a shared store for the
+regions DAG to cut its regions from.
+
 Scheduling policy: every task runs in the shared openplanetdata_osm pool with
 an absolute priority weight of 1, far below the planet DAGs (their
 OldestFirstPriorityStrategy weight is the run age in seconds), so whenever a
 planet task and a subset task are both queued, the planet task always takes
 the free slot first. Airflow never preempts a running task, so a planet task
 can still wait behind an in-flight subset batch; batches are deliberately
-small so that wait is bounded by a single batch, not the whole run.
+small so that wait is bounded by a single batch, not the whole run. Country
+batches are packed to a predicted wall-time budget (boundary area, vertex
+count and the timings of past runs) rather than a code count, so that bound
+holds whether a batch draws RU and US or a run of micro-states; the
+predictions are compared with the actual durations at the end of the run.
+The change set refreshing the stored country PBFs is prepared next to the
+continent extraction and batches (max_active_tasks=2, one batch at a time),
+since only the country batches need it.
 """
 
 import os
@@ -45,19 +64,33 @@ BOUNDARIES_DIR = f"{WORK_DIR}/boundaries"
 SNAPSHOT_GOL = f"{WORK_DIR}/planet-latest.osm.gol"
 SNAPSHOT_PARQUET = f"{WORK_DIR}/planet-latest.osm.parquet"
 SNAPSHOT_PBF = f"{WORK_DIR}/planet-latest.osm.pbf"
+# Uploaded continent PBFs, kept for the country batches of this run.
+PARENTS_DIR = f"{WORK_DIR}/parents"
+# Change set refreshing the stored country PBFs to this run's planet.
+CHANGES_DIR = f"{WORK_DIR}/changes"
 
 CONTINENTS_AGGREGATE = f"{WORK_DIR}/planet-latest.continents.geojson"
 COUNTRIES_AGGREGATE = f"{WORK_DIR}/planet-latest.countries.geojson"
 
 # Continents are planet-scale extracts: one per batch, so the pool slot is
 # yielded after every single continent and a queued planet task never waits
-# behind more than one continent's work. Countries are far smaller.
+# behind more than one continent's work. Countries are far smaller and are
+# packed up to a predicted wall time per batch (a country predicted above the
+# budget gets a batch of its own).
 CONTINENT_BATCH_SIZE = 1
-COUNTRY_BATCH_SIZE = 32
-# Large-country gol exports can use 45-60 GiB each. Keep builds serial so two
-# countries cannot exhaust the 124 GiB edge host when a control-plane or other
-# Docker workload is also present.
-BUILD_WORKERS = 1
+COUNTRY_BATCH_BUDGET_SECONDS = 30 * 60
+COUNTRY_BATCH_MAX_CODES = 64
+# Large-country gol exports can use 45-60 GiB each, so builds are admitted in
+# parallel only while their predicted peak memory fits the 124 GiB edge host
+# next to whatever else runs there (see osm_subsets.MemoryAdmission); this
+# only caps how many small countries are in flight at once. Each build step
+# has its own, lower cap (osm_subsets.SUBSET_STAGE_LIMITS), so the extra
+# codes fill the other stages. Batches are packed assuming this parallelism.
+BUILD_WORKERS = 6
+# Only countries are refreshed from their previous PBF: every continent
+# changes every day, and one multi-extract pass over the planet already cuts
+# them all for less than replaying the diffs on each.
+REFRESH_LEVELS = ("countries",)
 
 # All three assets are emitted by the planet DAGs' copy_to_shared tasks, so a
 # trigger guarantees the shared files this DAG snapshots actually exist.
@@ -102,7 +135,8 @@ with DAG(
     description="Continent and country OSM extracts in PBF, GeoParquet, GOL and GOB",
     doc_md=__doc__,
     max_active_runs=1,
-    max_active_tasks=1,
+    # Room for prepare_refresh next to the batches, which run one at a time.
+    max_active_tasks=2,
     schedule=[PBF_ASSET, GOL_V2_ASSET, GEOPARQUET_SHARED_ASSET],
     tags=["continents", "countries", "openplanetdata", "osm", "subsets"],
 ) as dag:
@@ -113,7 +147,8 @@ with DAG(
 
         The shared files are replaced atomically (rename) by the planet DAGs,
         so hardlinks keep this run's inputs consistent even if the next daily
-        planet run finishes mid-flight.
+        planet run finishes mid-flight. The shared country parent store is
+        reset and tagged with this run's planet snapshot.
         """
         os.makedirs(WORK_DIR, exist_ok=True)
         for source, snapshot in [
@@ -124,6 +159,23 @@ with DAG(
             if os.path.exists(snapshot):
                 os.remove(snapshot)
             os.link(source, snapshot)
+        subsets = _utils()
+        subsets.reset_parent_store(subsets.SUBSET_PARENTS_DIR, SNAPSHOT_GOL)
+
+    @task(task_display_name="Prepare Change Set")
+    def prepare_refresh() -> dict | None:
+        """Fetch the replication diffs since the stored country PBFs, and their context.
+
+        Returns the osm_subsets.SubsetRefresh as a dict, None when the planet
+        snapshot has no replication sequence (every country is then
+        extracted in full and nothing is stored).
+        """
+        import dataclasses
+
+        subsets = _utils()
+        with subsets.task_telemetry_log():
+            refresh = subsets.prepare_subset_refresh(SNAPSHOT_PBF, subsets.SUBSET_PREVIOUS_DIR, CHANGES_DIR)
+        return dataclasses.asdict(refresh) if refresh else None
 
     @task.r2index_download(
         task_display_name="Download Continent Boundaries",
@@ -160,11 +212,9 @@ with DAG(
         script = "set -euo pipefail\n" + subsets.INSTALL_DUCKDB_TEMPLATE.format(work_dir=WORK_DIR)
         subsets.run_in_container(script)
 
-    @task(task_display_name="Prepare Boundaries")
-    def prepare_boundaries() -> list[dict]:
-        """Split, buffer and simplify boundaries; return processing batches."""
-        from concurrent.futures import ThreadPoolExecutor
-
+    @task(task_display_name="Prepare Boundaries", multiple_outputs=True)
+    def prepare_boundaries() -> dict[str, list[dict]]:
+        """Split, buffer and simplify boundaries; return batches per level."""
         from airflow.exceptions import AirflowException
 
         subsets = _utils()
@@ -173,14 +223,10 @@ with DAG(
         country_codes = subsets.split_boundary_aggregate(COUNTRIES_AGGREGATE, "code", BOUNDARIES_DIR)
         print(f"Found {len(continent_codes)} continents and {len(country_codes)} countries")
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            failures = {
-                code for code in executor.map(
-                    lambda code: subsets.prepare_boundary(code, BOUNDARIES_DIR),
-                    continent_codes + country_codes,
-                )
-                if code is not None
-            }
+        with subsets.task_telemetry_log():
+            failures = subsets.prepare_boundaries(
+                continent_codes + country_codes, BOUNDARIES_DIR, cache_dir=subsets.BOUNDARY_CACHE_DIR,
+            )
         if failures:
             # One malformed boundary must not sink the other ~250 subsets;
             # report_failures surfaces the dropped codes at the end of the run.
@@ -193,41 +239,95 @@ with DAG(
         continent_names = {c["slug"]: c["name"] for c in CONTINENTS}
         country_names = {code: entry["name"] for code, entry in COUNTRIES.items()}
 
-        batches = []
+        continent_estimates = subsets.estimate_subset_costs(continent_codes, "continents", BOUNDARIES_DIR)
+        country_estimates = subsets.estimate_subset_costs(country_codes, "countries", BOUNDARIES_DIR)
+
+        batches = {"continents": [], "countries": []}
         for i in range(0, len(continent_codes), CONTINENT_BATCH_SIZE):
             codes = continent_codes[i:i + CONTINENT_BATCH_SIZE]
-            batches.append({
+            batches["continents"].append({
                 "level": "continents",
                 "codes": codes,
                 "names": {c: continent_names.get(c, c) for c in codes},
+                "estimates": {c: continent_estimates[c] for c in codes},
             })
-        for i in range(0, len(country_codes), COUNTRY_BATCH_SIZE):
-            codes = country_codes[i:i + COUNTRY_BATCH_SIZE]
-            batches.append({
+        for codes in subsets.pack_subset_batches(
+            country_estimates, COUNTRY_BATCH_BUDGET_SECONDS, COUNTRY_BATCH_MAX_CODES, BUILD_WORKERS,
+        ):
+            batches["countries"].append({
                 "level": "countries",
                 "codes": codes,
                 "names": {c: country_names.get(c, c) for c in codes},
+                "estimates": {c: country_estimates[c] for c in codes},
             })
+        print(
+            f"Packed {len(country_codes)} countries into {len(batches['countries'])} batch(es) "
+            f"of at most {COUNTRY_BATCH_BUDGET_SECONDS // 60} predicted minutes"
+        )
         return batches
 
-    @task(task_display_name="Process Batch", retries=2, retry_delay=timedelta(minutes=10))
-    def process_batch(batch: dict) -> None:
-        """Build PBF/GOL/GOB, extract GeoParquet and upload for one batch."""
+    @task(task_display_name="Extract From Planet")
+    def extract_from_planet(continent_batches: list[dict], country_batches: list[dict]) -> None:
+        """Cut every continent PBF from the planet PBF in a single osmium pass.
+
+        The countries no continent boundary covers, which would otherwise
+        each be cut from the planet by their batch, join the same pass. The
+        batches then only run gol build/save, parquet and upload for them. A
+        subset this pass could not produce is extracted on its own by its
+        batch, so a failure here never fails the run.
+        """
         subsets = _utils()
-        subsets.process_subset_batch(
-            codes=batch["codes"],
-            names=batch["names"],
-            level=batch["level"],
-            level_dir=f"{WORK_DIR}/{batch['level']}",
-            boundaries_dir=BOUNDARIES_DIR,
-            snapshot_gol=SNAPSHOT_GOL,
-            snapshot_parquet=SNAPSHOT_PARQUET,
-            work_dir=WORK_DIR,
-            r2index_conn_id=R2INDEX_CONNECTION_ID,
-            build_workers=BUILD_WORKERS,
-            snapshot_pbf=SNAPSHOT_PBF if batch["level"] == "continents" else None,
-            refilter_gol_pbf=batch["level"] == "countries",
+        continents = [code for batch in continent_batches for code in batch["codes"]]
+        countries = [code for batch in country_batches for code in batch["codes"]]
+        uncovered = subsets.uncovered_subsets(
+            countries, BOUNDARIES_DIR, {code: f"{BOUNDARIES_DIR}/{code}.prepared.geojson" for code in continents},
         )
+        print(f"{len(uncovered)} country(ies) no continent covers: {uncovered}")
+        level_dirs = {
+            **{code: f"{WORK_DIR}/continents" for code in continents},
+            **{code: f"{WORK_DIR}/countries" for code in uncovered},
+        }
+        with subsets.task_telemetry_log():
+            failed = subsets.extract_subsets_multi(level_dirs, BOUNDARIES_DIR, SNAPSHOT_PBF)
+        if failed:
+            print(f"{len(failed)} subset(s) left to per-batch extraction: {sorted(failed)}")
+
+    @task(
+        task_display_name="Process Batch",
+        max_active_tis_per_dagrun=1,
+        retries=2,
+        retry_delay=timedelta(minutes=10),
+    )
+    def process_batch(batch: dict, refresh: dict | None = None) -> None:
+        """Build PBF/GOL/GOB, extract GeoParquet and upload for one batch.
+
+        Continent PBFs are retained as parents for the countries of this run,
+        country PBFs as parents for the regions DAG.
+        """
+        subsets = _utils()
+        is_continent = batch["level"] == "continents"
+        if refresh is not None and batch["level"] in REFRESH_LEVELS:
+            refresh = subsets.SubsetRefresh(**refresh)
+        else:
+            refresh = None
+        with subsets.task_telemetry_log(), subsets.container_pool():
+            subsets.process_subset_batch(
+                codes=batch["codes"],
+                names=batch["names"],
+                level=batch["level"],
+                level_dir=f"{WORK_DIR}/{batch['level']}",
+                boundaries_dir=BOUNDARIES_DIR,
+                snapshot_gol=SNAPSHOT_GOL,
+                snapshot_parquet=SNAPSHOT_PARQUET,
+                work_dir=WORK_DIR,
+                r2index_conn_id=R2INDEX_CONNECTION_ID,
+                build_workers=BUILD_WORKERS,
+                snapshot_pbf=SNAPSHOT_PBF,
+                parents_dir=None if is_continent else PARENTS_DIR,
+                retain_dir=PARENTS_DIR if is_continent else subsets.SUBSET_PARENTS_DIR,
+                estimates=batch.get("estimates"),
+                refresh=refresh,
+            )
 
     @task(task_display_name="Report Failures", trigger_rule="all_done")
     def report_failures() -> None:
@@ -248,6 +348,12 @@ with DAG(
         else:
             print("All subsets uploaded successfully.")
 
+    @task(task_display_name="Report Timings", trigger_rule="all_done")
+    def report_timings() -> None:
+        """Compare each batch's predicted duration with its actual one."""
+        subsets = _utils()
+        subsets.report_subset_timings(["continents", "countries"], SNAPSHOT_GOL)
+
     @task(task_id="osm_subsets_continents_countries_done", task_display_name="Done")
     def done() -> None:
         """No-op gate task to propagate upstream failures to DAG run state."""
@@ -259,6 +365,7 @@ with DAG(
 
     # Task flow
     snapshot = snapshot_inputs()
+    refresh = prepare_refresh()
     continent_boundaries = download_continent_boundaries()
     country_boundaries = download_country_boundaries()
     batches = prepare_boundaries()
@@ -266,12 +373,25 @@ with DAG(
     duckdb_install = install_duckdb()
     snapshot >> [continent_boundaries, country_boundaries]
     [continent_boundaries, country_boundaries] >> duckdb_install >> batches
+    # Only the country batches wait for the change set (partial below).
+    snapshot >> refresh
 
-    process_groups = process_batch.expand(batch=batches)
+    planet_extracted = extract_from_planet(batches["continents"], batches["countries"])
+    continent_groups = process_batch.override(task_id="process_continent_batch").expand(
+        batch=batches["continents"],
+    )
+    # Countries fall back to the planet for any continent that failed.
+    country_groups = process_batch.override(task_id="process_country_batch", trigger_rule="all_done").partial(
+        refresh=refresh,
+    ).expand(batch=batches["countries"])
+    planet_extracted >> continent_groups >> country_groups
+    process_groups = [continent_groups, country_groups]
 
     report = report_failures()
     process_groups >> report
+    timings = report_timings()
+    process_groups >> timings
 
     done_result = done()
     process_groups >> done_result
-    [report, done_result] >> cleanup()
+    [report, timings, done_result] >> cleanup()
@@ -12,9 +12,18 @@ Same pipeline and scheduling policy as the continents & countries subsets DAG
 strictly low
 priority in the shared openplanetdata_osm pool, one task at a time, so queued
 planet tasks always win the next free slot (a running batch is never
-preempted, but batches are small so any wait is bounded by one batch). Region
+preempted, but batches are packed to a predicted wall-time budget so any wait
+is bounded by one batch; predictions and actual durations are reported at
+the end of the run). Region
 codes come from the weekly boundaries aggregate; regions whose boundary
 matches nothing are skipped and reported rather than failing the run.
+
+Hierarchical extraction: when the shared country PBF store was built by the
+continents & countries DAG from the same planet snapshot, each region is cut
+with osmium from the smallest country PBF covering it instead of querying the
+planet GOL; regions no country covers get the same osmium complete_ways cut
+from the planet PBF, all of them in multi-extract passes before the batches,
+so a region's content does not depend on which countries were built.
 """
 
 import os
@@ -31,17 +40,27 @@ from openplanetdata.airflow.defaults import (
     R2INDEX_CONNECTION_ID,
     SHARED_PLANET_OSM_GOL_PATH,
     SHARED_PLANET_OSM_PARQUET_PATH,
+    SHARED_PLANET_OSM_PBF_PATH,
 )
 
 WORK_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/regions"
 BOUNDARIES_DIR = f"{WORK_DIR}/boundaries"
 SNAPSHOT_GOL = f"{WORK_DIR}/planet-latest.osm.gol"
 SNAPSHOT_PARQUET = f"{WORK_DIR}/planet-latest.osm.parquet"
+SNAPSHOT_PBF = f"{WORK_DIR}/planet-latest.osm.pbf"
+# This run's hardlinked snapshot of the shared country parent store.
+PARENTS_DIR = f"{WORK_DIR}/parents"
 
 REGIONS_AGGREGATE = f"{WORK_DIR}/planet-latest.regions.geojson"
 
-REGION_BATCH_SIZE = 32
-BUILD_WORKERS = 2
+# Regions are packed up to a predicted wall time per batch (see
+# osm_subsets.estimate_subset_costs) instead of a fixed code count.
+REGION_BATCH_BUDGET_SECONDS = 30 * 60
+REGION_BATCH_MAX_CODES = 64
+# Upper bound on codes in flight; osm_subsets.MemoryAdmission decides how many
+# of them fit in memory, osm_subsets.SUBSET_STAGE_LIMITS how many run each
+# build step at once. Batches are packed assuming this parallelism.
+BUILD_WORKERS = 6
 
 
 def _utils():
@@ -78,19 +97,26 @@ with DAG(
 
     @task(task_display_name="Snapshot Planet Inputs")
     def snapshot_inputs() -> None:
-        """Hardlink the shared planet GOL and GeoParquet for a stable snapshot."""
+        """Hardlink the shared planet GOL, GeoParquet and PBF for a stable snapshot.
+
+        Country parent PBFs are linked too when they were cut from the same
+        planet GOL snapshot.
+        """
         from airflow.exceptions import AirflowException
 
         os.makedirs(WORK_DIR, exist_ok=True)
         for source, snapshot in [
             (SHARED_PLANET_OSM_GOL_PATH, SNAPSHOT_GOL),
             (SHARED_PLANET_OSM_PARQUET_PATH, SNAPSHOT_PARQUET),
+            (SHARED_PLANET_OSM_PBF_PATH, SNAPSHOT_PBF),
         ]:
             if not os.path.exists(source):
                 raise AirflowException(f"Missing shared planet input: {source}")
             if os.path.exists(snapshot):
                 os.remove(snapshot)
             os.link(source, snapshot)
+        subsets = _utils()
+        subsets.snapshot_parent_store(subsets.SUBSET_PARENTS_DIR, PARENTS_DIR, SNAPSHOT_GOL)
 
     @task.r2index_download(
         task_display_name="Download Region Boundaries",
@@ -116,8 +142,6 @@ with DAG(
     @task(task_display_name="Prepare Boundaries")
     def prepare_boundaries() -> list[dict]:
         """Split, buffer and simplify region boundaries; return processing batches."""
-        from concurrent.futures import ThreadPoolExecutor
-
         from airflow.exceptions import AirflowException
 
         subsets = _utils()
@@ -125,46 +149,73 @@ with DAG(
         region_codes = subsets.split_boundary_aggregate(REGIONS_AGGREGATE, "code", BOUNDARIES_DIR)
         print(f"Found {len(region_codes)} regions")
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            failures = [
-                code for code in executor.map(
-                    lambda code: subsets.prepare_boundary(code, BOUNDARIES_DIR),
-                    region_codes,
-                )
-                if code is not None
-            ]
+        with subsets.task_telemetry_log():
+            failures = subsets.prepare_boundaries(region_codes, BOUNDARIES_DIR, cache_dir=subsets.BOUNDARY_CACHE_DIR)
         if failures:
             # A handful of broken region boundaries must not sink ~3,000 others.
             print(f"Boundary preparation failed for {len(failures)} region(s): {sorted(failures)}")
-            region_codes = [c for c in region_codes if c not in set(failures)]
+            region_codes = [c for c in region_codes if c not in failures]
         if not region_codes:
             raise AirflowException("No region boundary could be prepared")
 
-        return [
+        estimates = subsets.estimate_subset_costs(region_codes, "regions", BOUNDARIES_DIR)
+        batches = [
             {
                 "level": "regions",
-                "codes": region_codes[i:i + REGION_BATCH_SIZE],
+                "codes": codes,
                 "names": {},
+                "estimates": {c: estimates[c] for c in codes},
             }
-            for i in range(0, len(region_codes), REGION_BATCH_SIZE)
+            for codes in subsets.pack_subset_batches(
+                estimates, REGION_BATCH_BUDGET_SECONDS, REGION_BATCH_MAX_CODES, BUILD_WORKERS,
+            )
         ]
+        print(
+            f"Packed {len(region_codes)} regions into {len(batches)} batch(es) "
+            f"of at most {REGION_BATCH_BUDGET_SECONDS // 60} predicted minutes"
+        )
+        return batches
+
+    @task(task_display_name="Extract Uncovered Regions")
+    def extract_uncovered(batches: list[dict]) -> None:
+        """Cut the regions no country parent covers from the planet PBF.
+
+        Their batches would otherwise read the whole planet once per region;
+        multi-extract passes read it once per OSMIUM_MULTI_EXTRACT_MAX_CODES
+        regions. A region these passes could not produce is extracted on its
+        own by its batch, so a failure here never fails the run.
+        """
+        subsets = _utils()
+        codes = [code for batch in batches for code in batch["codes"]]
+        uncovered = subsets.uncovered_subsets(codes, BOUNDARIES_DIR, subsets.parent_boundaries(PARENTS_DIR))
+        print(f"{len(uncovered)} region(s) no country covers")
+        with subsets.task_telemetry_log():
+            failed = subsets.extract_subsets_multi(
+                {code: f"{WORK_DIR}/regions" for code in uncovered}, BOUNDARIES_DIR, SNAPSHOT_PBF,
+            )
+        if failed:
+            print(f"{len(failed)} region(s) left to per-batch extraction: {sorted(failed)}")
 
     @task(task_display_name="Process Batch", retries=1)
     def process_batch(batch: dict) -> None:
         """Build PBF/GOL/GOB, extract GeoParquet and upload for one batch."""
         subsets = _utils()
-        subsets.process_subset_batch(
-            codes=batch["codes"],
-            names=batch["names"],
-            level=batch["level"],
-            level_dir=f"{WORK_DIR}/{batch['level']}",
-            boundaries_dir=BOUNDARIES_DIR,
-            snapshot_gol=SNAPSHOT_GOL,
-            snapshot_parquet=SNAPSHOT_PARQUET,
-            work_dir=WORK_DIR,
-            r2index_conn_id=R2INDEX_CONNECTION_ID,
-            build_workers=BUILD_WORKERS,
-        )
+        with subsets.task_telemetry_log(), subsets.container_pool():
+            subsets.process_subset_batch(
+                codes=batch["codes"],
+                names=batch["names"],
+                level=batch["level"],
+                level_dir=f"{WORK_DIR}/{batch['level']}",
+                boundaries_dir=BOUNDARIES_DIR,
+                snapshot_gol=SNAPSHOT_GOL,
+                snapshot_parquet=SNAPSHOT_PARQUET,
+                work_dir=WORK_DIR,
+                r2index_conn_id=R2INDEX_CONNECTION_ID,
+                build_workers=BUILD_WORKERS,
+                snapshot_pbf=SNAPSHOT_PBF,
+                parents_dir=PARENTS_DIR,
+                estimates=batch.get("estimates"),
+            )
 
     @task(task_display_name="Report Failures", trigger_rule="all_done")
     def report_failures() -> None:
@@ -183,6 +234,12 @@ with DAG(
         else:
             print("All regions uploaded successfully.")
 
+    @task(task_display_name="Report Timings", trigger_rule="all_done")
+    def report_timings() -> None:
+        """Compare each batch's predicted duration with its actual one."""
+        subsets = _utils()
+        subsets.report_subset_timings(["regions"], SNAPSHOT_GOL)
+
     @task(task_id="osm_subsets_regions_done", task_display_name="Done")
     def done() -> None:
         """No-op gate task to propagate upstream failures to DAG run state."""
@@ -200,11 +257,15 @@ with DAG(
 
     snapshot >> boundaries >> duckdb_install >> batches
 
+    uncovered_extracted = extract_uncovered(batches)
     process_groups = process_batch.expand(batch=batches)
+    uncovered_extracted >> process_groups
 
     report = report_failures()
     process_groups >> report
+    timings = report_timings()
+    process_groups >> timings
 
     done_result = done()
     process_groups >> done_result
-    [report, done_result] >> cleanup()
+    [report, timings, done_result] >> cleanup()
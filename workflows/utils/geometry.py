@@ -0,0 +1,138 @@
+"""Compact NumPy representation of GeoJSON boundary geometries.
+
+Prepared boundaries reach hundreds of thousands of vertices, and walking the
+nested GeoJSON lists one position at a time dominated bbox computation and
+world clamping. PackedGeometry stores every vertex in one flat float64 array
+plus two offset arrays (GeoArrow layout), so those operations run vectorized
+and the nested lists are built exactly once, on serialization:
+
+    coords        (n, ndim) positions of all rings, in order
+    ring_offsets  ring i spans coords[ring_offsets[i]:ring_offsets[i + 1]]
+    part_offsets  part j spans rings[part_offsets[j]:part_offsets[j + 1]]
+
+Every geometry type is normalized to parts of rings of positions: a Polygon
+is one part, a LineString one part with one ring, a Point one ring holding a
+single position.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from itertools import chain
+
+import numpy as np
+
+# Nesting depth of "coordinates" for each supported GeoJSON type, counted in
+# list levels above the position itself.
+_COORDINATE_DEPTH = {
+    "Point": 0,
+    "MultiPoint": 1,
+    "LineString": 1,
+    "MultiLineString": 2,
+    "Polygon": 2,
+    "MultiPolygon": 3,
+}
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+@dataclass(frozen=True)
+class PackedGeometry:
+    """A GeoJSON geometry as flat coordinate and offset arrays."""
+
+    geometry_type: str
+    coords: np.ndarray
+    ring_offsets: np.ndarray
+    part_offsets: np.ndarray
+
+    @classmethod
+    def from_geojson(cls, geometry: dict) -> PackedGeometry:
+        """Pack a GeoJSON geometry mapping (Point through MultiPolygon)."""
+        geometry_type = geometry["type"]
+        depth = _COORDINATE_DEPTH.get(geometry_type)
+        if depth is None:
+            raise ValueError(f"Unsupported geometry type: {geometry_type}")
+
+        coordinates = geometry["coordinates"]
+        if depth == 0:
+            parts = [[[coordinates]]]
+        elif depth == 1:
+            parts = [[coordinates]]
+        elif depth == 2:
+            parts = [coordinates]
+        else:
+            parts = coordinates
+
+        rings = list(chain.from_iterable(parts))
+        positions = list(chain.from_iterable(rings))
+        ndim = len(positions[0]) if positions else 2
+        return cls(
+            geometry_type=geometry_type,
+            coords=np.array(positions, dtype=np.float64).reshape(-1, ndim),
+            ring_offsets=_offsets([len(ring) for ring in rings]),
+            part_offsets=_offsets([len(part) for part in parts]),
+        )
+
+    @classmethod
+    def from_shapely(cls, geometry) -> PackedGeometry:
+        """Pack a Shapely (Multi)Polygon without a GeoJSON round trip."""
+        import shapely
+
+        if geometry.geom_type not in ("Polygon", "MultiPolygon"):
+            return cls.from_geojson(json.loads(shapely.to_geojson(geometry)))
+
+        _kind, coords, offsets = shapely.to_ragged_array([geometry])
+        ring_offsets = np.asarray(offsets[0], dtype=np.int64)
+        if geometry.geom_type == "Polygon":
+            part_offsets = np.array([0, len(ring_offsets) - 1], dtype=np.int64)
+        else:
+            part_offsets = np.asarray(offsets[1], dtype=np.int64)
+        return cls(
+            geometry_type=geometry.geom_type,
+            coords=np.ascontiguousarray(coords, dtype=np.float64),
+            ring_offsets=ring_offsets,
+            part_offsets=part_offsets,
+        )
+
+    def bbox(self) -> tuple[float, float, float, float]:
+        """Return (minx, miny, maxx, maxy); infinities for an empty geometry."""
+        if not len(self.coords):
+            return float("inf"), float("inf"), float("-inf"), float("-inf")
+        minx, miny = self.coords[:, :2].min(axis=0).tolist()
+        maxx, maxy = self.coords[:, :2].max(axis=0).tolist()
+        return minx, miny, maxx, maxy
+
+    def clamp_to_world(self) -> PackedGeometry:
+        """Clamp positions to the valid longitude/latitude range."""
+        coords = self.coords.copy()
+        np.clip(coords[:, 0], -180.0, 180.0, out=coords[:, 0])
+        np.clip(coords[:, 1], -90.0, 90.0, out=coords[:, 1])
+        return PackedGeometry(self.geometry_type, coords, self.ring_offsets, self.part_offsets)
+
+    def to_geojson(self) -> dict:
+        """Rebuild the GeoJSON geometry mapping (positions become float lists)."""
+        positions = self.coords.tolist()
+        ring_bounds = self.ring_offsets.tolist()
+        rings = [positions[start:end] for start, end in zip(ring_bounds, ring_bounds[1:])]
+        part_bounds = self.part_offsets.tolist()
+        parts = [rings[start:end] for start, end in zip(part_bounds, part_bounds[1:])]
+
+        depth = _COORDINATE_DEPTH[self.geometry_type]
+        if depth == 0:
+            coordinates = parts[0][0][0]
+        elif depth == 1:
+            coordinates = parts[0][0]
+        elif depth == 2:
+            coordinates = parts[0]
+        else:
+            coordinates = parts
+        return {"type": self.geometry_type, "coordinates": coordinates}
+
+    def to_json(self) -> str:
+        """Serialize as a bare GeoJSON geometry (json.dumps formatting)."""
+        return json.dumps(self.to_geojson())
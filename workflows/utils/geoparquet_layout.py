@@ -0,0 +1,68 @@
+"""Layout of the planet GeoParquet and of every file cut from it.
+
+The full planet build (planet_geoparquet_dag), its incremental update
+(workflows.utils.osm_geoparquet) and the subset extracts
+(workflows.utils.osm_subsets) all write through parquet_copy_options, so an
+updated planet file is laid out exactly like a rebuilt one.
+
+planet_geoparquet_dag and subsets_benchmark_dag build their commands from
+these at parse time, so this module only imports the standard library: the
+scheduler loads it with every parse of both DAGs, without the subset
+pipeline behind workflows.utils.osm_subsets.
+"""
+
+import json
+
+# ORDER BY keys of the planet rows per sort mode (planet_geoparquet_dag's
+# GEOPARQUET_SORT_MODE; the subsets benchmark DAG compares them all).
+GEOPARQUET_SORT_KEYS = {
+    "bbox": "bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax",
+    "hilbert": (
+        "ST_Hilbert((bbox.xmin + bbox.xmax) / 2, (bbox.ymin + bbox.ymax) / 2, "
+        "ST_Extent(ST_MakeEnvelope(-180, -90, 180, 90)))"
+    ),
+}
+# Appended to the sort keys: rows with equal keys get a fixed order, so an
+# incremental update (workflows.utils.osm_geoparquet) writes them exactly
+# where a full rebuild does.
+GEOPARQUET_SORT_TIEBREAK = "osm_type::VARCHAR, osm_id"
+
+# GeoParquet 1.1 file metadata declaring the bbox struct as the covering of
+# the WKB geometry column, so readers can prune row groups on bbox
+# statistics without decoding geometries. Geometry is written as WKB through
+# ST_AsWKB: DuckDB writes its own (1.0, covering-less) "geo" key for GEOMETRY
+# columns, which would clash with this one.
+GEOPARQUET_METADATA = json.dumps({
+    "version": "1.1.0",
+    "primary_column": "geometry",
+    "columns": {
+        "geometry": {
+            "encoding": "WKB",
+            "geometry_types": [],
+            "covering": {
+                "bbox": {
+                    "xmin": ["bbox", "xmin"],
+                    "ymin": ["bbox", "ymin"],
+                    "xmax": ["bbox", "xmax"],
+                    "ymax": ["bbox", "ymax"],
+                },
+            },
+        },
+    },
+})
+# Rows per Parquet row group (DuckDB's default). Smaller groups let the bbox
+# prefilter skip more rows for small subsets at the cost of more metadata;
+# the subsets benchmark DAG times the candidates.
+GEOPARQUET_ROW_GROUP_SIZE = 122_880
+
+
+def parquet_copy_options(row_group_size: int = GEOPARQUET_ROW_GROUP_SIZE) -> str:
+    """Return the COPY options shared by every GeoParquet writer."""
+    return f"""(
+    FORMAT PARQUET,
+    CODEC 'zstd',
+    COMPRESSION_LEVEL 6,
+    PARQUET_VERSION v2,
+    ROW_GROUP_SIZE {row_group_size},
+    KV_METADATA {{geo: '{GEOPARQUET_METADATA}'}}
+)"""
@@ -0,0 +1,300 @@
+"""Incremental updates of the planet GeoParquet from replication diffs.
+
+The planet GeoParquet is one bbox-sorted file (planet_geoparquet_dag), built
+from a full ohsome contributions run over the planet and a full sort. Its
+rows are also kept as partitions: consecutive bbox.xmin ranges of the sorted
+file, one Parquet file each, stored outside the DAG's work directory
+(GEOPARQUET_PARTITIONS_DIR). A run then applies the diffs since instead:
+
+1. the affected objects, every object the diffs created, modified or
+   deleted and every way and relation above them, are extracted from the
+   new planet PBF with everything they reference
+   (osm_replication.collect_changes, extract_ids);
+2. ohsome contributions over that extract, through the planet SELECT and
+   restricted to the affected objects, gives their new rows: the delta
+   (deleted objects have none);
+3. each partition holding an affected object or receiving a delta row is
+   rewritten, sorted: its rows minus the affected objects, plus its delta
+   rows. The other partitions are hardlinked as they are;
+4. the planet file is the concatenation of the partitions, in order.
+
+Sort ties are broken on (osm_type, osm_id), so the result is row for row
+the file a full rebuild writes. New partitions are staged next to the
+stored ones (GEOPARQUET_STAGING_DIR) and only replace them
+(commit_partitions) once the planet file they make has been published.
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import os
+import shlex
+import shutil
+
+from openplanetdata.airflow.defaults import OPENPLANETDATA_WORK_DIR
+
+from workflows.utils.geoparquet_layout import GEOPARQUET_ROW_GROUP_SIZE, parquet_copy_options
+from workflows.utils.osm_subsets import INSTALL_DUCKDB_TEMPLATE, run_in_container
+
+GEOPARQUET_PARTITIONS_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/geoparquet-partitions"
+GEOPARQUET_STAGING_DIR = f"{GEOPARQUET_PARTITIONS_DIR}.next"
+# Rows per partition at split time (64 row groups, a few hundred MB). A
+# day's changes touch most longitude stripes, so smaller partitions save
+# little rewriting; this size keeps each rewrite an in-memory sort.
+# Partitions grow or shrink with updates until the next full rebuild splits
+# the planet again.
+GEOPARQUET_PARTITION_ROWS = 64 * GEOPARQUET_ROW_GROUP_SIZE
+# Same budget as the full build's DuckDB run.
+GEOPARQUET_DUCKDB_MEMORY_LIMIT = "65GB"
+
+_MANIFEST = "manifest.json"
+# Planet columns as written: the "geo" metadata makes DuckDB read geometry
+# back as GEOMETRY, which goes out as WKB again (see GEOPARQUET_METADATA).
+_PLANET_COLUMNS = "osm_type, osm_id, tags, bbox, ST_AsWKB(geometry) AS geometry"
+
+
+def manifest_path(partitions_dir: str) -> str:
+    """Path of the manifest of partitions_dir, which its replication state describes."""
+    return f"{partitions_dir}/{_MANIFEST}"
+
+
+def _partition_path(partitions_dir: str, index: int) -> str:
+    return f"{partitions_dir}/part-{index:05d}.parquet"
+
+
+def _read_manifest(partitions_dir: str) -> dict:
+    with open(manifest_path(partitions_dir), encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def _write_manifest(partitions_dir: str, manifest: dict) -> None:
+    tmp_path = f"{manifest_path(partitions_dir)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh)
+    os.rename(tmp_path, manifest_path(partitions_dir))
+
+
+def _partition_filter(bounds: list[float], index: int) -> str:
+    """WHERE condition selecting partition index: bbox.xmin in [bounds[index - 1], bounds[index]).
+
+    Rows without a bbox sort last, so they belong to the last partition.
+    """
+    conditions = []
+    if index > 0:
+        conditions.append(f"bbox.xmin >= {bounds[index - 1]!r}")
+    if index < len(bounds):
+        conditions.append(f"bbox.xmin < {bounds[index]!r}")
+    condition = " AND ".join(conditions) or "true"
+    if index == len(bounds):
+        condition = f"({condition} OR bbox.xmin IS NULL)"
+    return condition
+
+
+def _partition_index_sql(bounds: list[float]) -> str:
+    """SQL expression of the partition a row belongs to (see _partition_filter)."""
+    values = ", ".join(repr(bound) for bound in bounds)
+    return (
+        f"len(list_filter([{values}]::DOUBLE[], "
+        f"lambda b: b <= coalesce(bbox.xmin::DOUBLE, 'infinity'::DOUBLE)))"
+    )
+
+
+def _affected_table_sql(affected_ids: str) -> str:
+    """Create the affected (osm_type, osm_id) table from an osmium ID file (n1, w2, r3)."""
+    return f"""
+CREATE OR REPLACE TEMP TABLE affected AS
+SELECT DISTINCT
+    CASE left(id, 1) WHEN 'n' THEN 'node' WHEN 'w' THEN 'way' ELSE 'relation' END AS osm_type,
+    CAST(substr(id, 2) AS BIGINT) AS osm_id
+FROM read_csv('{affected_ids}', columns = {{'id': 'VARCHAR'}}, header = false);
+"""
+
+
+def install_duckdb(work_dir: str) -> None:
+    """Download the DuckDB CLI into work_dir unless already there."""
+    if not os.path.exists(f"{work_dir}/duckdb"):
+        run_in_container("set -euo pipefail\n" + INSTALL_DUCKDB_TEMPLATE.format(work_dir=work_dir))
+
+
+def _run_duckdb(sql: str, work_dir: str, name: str) -> None:
+    """Run a DuckDB script with the CLI of install_duckdb."""
+    path = f"{work_dir}/{name}.sql"
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(f"""
+SET extension_directory='{work_dir}/.duckdb-extensions';
+SET temp_directory='{work_dir}/.duckdb-temp';
+SET memory_limit='{GEOPARQUET_DUCKDB_MEMORY_LIMIT}';
+INSTALL 'spatial'; LOAD 'spatial';
+""")
+        fh.write(sql)
+    run_in_container(f"{work_dir}/duckdb -bail -f {shlex.quote(path)}", env={"HOME": work_dir}, step=f"duckdb {name}")
+
+
+def _read_csv(path: str) -> list[list[str]]:
+    with open(path, encoding="utf-8", newline="") as fh:
+        return list(csv.reader(fh))
+
+
+def split_partitions(parquet_path: str, staging_dir: str, work_dir: str, sequence: int | None, rebuilt: str) -> int:
+    """Split a fully built planet file into partitions in staging_dir; return their count.
+
+    Partition bounds are the bbox.xmin of every GEOPARQUET_PARTITION_ROWS-th
+    row. Each partition is one filtered read of the sorted file, which the
+    bbox.xmin row group statistics prune to its own row groups, so rows keep
+    their order.
+    """
+    bounds_path = f"{work_dir}/partition-bounds.csv"
+    _run_duckdb(f"""
+COPY (
+    SELECT DISTINCT bbox.xmin::DOUBLE
+    FROM read_parquet('{parquet_path}', file_row_number = true)
+    WHERE file_row_number % {GEOPARQUET_PARTITION_ROWS} = 0 AND file_row_number > 0 AND bbox.xmin IS NOT NULL
+    ORDER BY 1
+) TO '{bounds_path}' (FORMAT CSV, HEADER false);
+""", work_dir, "partition-bounds")
+    bounds = [float(row[0]) for row in _read_csv(bounds_path)]
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    _run_duckdb("".join(
+        f"""
+COPY (
+    SELECT {_PLANET_COLUMNS} FROM read_parquet('{parquet_path}') WHERE {_partition_filter(bounds, index)}
+) TO '{_partition_path(staging_dir, index)}' {parquet_copy_options()};
+"""
+        for index in range(len(bounds) + 1)
+    ), work_dir, "split-partitions")
+    _write_manifest(staging_dir, {"bounds": bounds, "sequence": sequence, "rebuilt": rebuilt})
+    return len(bounds) + 1
+
+
+def update_partitions(
+    partitions_dir: str,
+    staging_dir: str,
+    delta_select: str,
+    affected_ids: str,
+    order_by: str,
+    work_dir: str,
+    sequence: int,
+) -> dict[str, int]:
+    """Stage the partitions of partitions_dir with the delta applied.
+
+    delta_select is the planet SELECT over the contributions of the affected
+    objects' extract, affected_ids their osmium ID file, order_by the
+    planet's sort keys. Raises ValueError when the delta's schema differs
+    from the planet's. Returns counts of the partitions and delta rows.
+    """
+    manifest = _read_manifest(partitions_dir)
+    bounds = manifest["bounds"]
+    count = len(bounds) + 1
+    delta_path = f"{work_dir}/delta.parquet"
+    touched_path = f"{work_dir}/touched.csv"
+    delta_rows_path = f"{work_dir}/delta-rows.csv"
+    delta_schema_path = f"{work_dir}/delta-schema.csv"
+    planet_schema_path = f"{work_dir}/planet-schema.csv"
+    partitions = ", ".join(f"'{_partition_path(partitions_dir, index)}'" for index in range(count))
+
+    _run_duckdb(_affected_table_sql(affected_ids) + f"""
+COPY (
+    SELECT delta.*, {_partition_index_sql(bounds)} AS part
+    FROM ({delta_select}) delta
+    WHERE EXISTS (
+        SELECT 1 FROM affected
+        WHERE affected.osm_type = delta.osm_type::VARCHAR AND affected.osm_id = delta.osm_id
+    )
+) TO '{delta_path}' (FORMAT PARQUET);
+
+COPY (SELECT count(*) FROM '{delta_path}') TO '{delta_rows_path}' (FORMAT CSV, HEADER false);
+COPY (
+    SELECT column_name, column_type FROM (DESCRIBE SELECT * EXCLUDE (part) FROM '{delta_path}')
+) TO '{delta_schema_path}' (FORMAT CSV, HEADER false);
+COPY (
+    SELECT column_name, column_type
+    FROM (DESCRIBE SELECT {_PLANET_COLUMNS} FROM '{_partition_path(partitions_dir, 0)}')
+) TO '{planet_schema_path}' (FORMAT CSV, HEADER false);
+
+COPY (
+    SELECT DISTINCT part FROM '{delta_path}'
+    UNION
+    SELECT DISTINCT regexp_extract(filename, 'part-(\\d+)\\.parquet$', 1)::INTEGER
+    FROM read_parquet([{partitions}], filename = true) planet
+    WHERE EXISTS (
+        SELECT 1 FROM affected
+        WHERE affected.osm_type = planet.osm_type AND affected.osm_id = planet.osm_id
+    )
+) TO '{touched_path}' (FORMAT CSV, HEADER false);
+""", work_dir, "geoparquet-delta")
+
+    delta_schema = _read_csv(delta_schema_path)
+    planet_schema = _read_csv(planet_schema_path)
+    if delta_schema != planet_schema:
+        raise ValueError(f"Delta schema {delta_schema} differs from the planet's {planet_schema}")
+    touched = sorted(int(row[0]) for row in _read_csv(touched_path))
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+    for index in range(count):
+        if index not in touched:
+            os.link(_partition_path(partitions_dir, index), _partition_path(staging_dir, index))
+    if touched:
+        _run_duckdb(_affected_table_sql(affected_ids) + "".join(
+            f"""
+COPY (
+    SELECT * FROM (
+        SELECT {_PLANET_COLUMNS} FROM '{_partition_path(partitions_dir, index)}' planet
+        WHERE NOT EXISTS (
+            SELECT 1 FROM affected
+            WHERE affected.osm_type = planet.osm_type AND affected.osm_id = planet.osm_id
+        )
+        UNION ALL
+        SELECT * EXCLUDE (part) FROM '{delta_path}' WHERE part = {index}
+    )
+    ORDER BY {order_by}
+) TO '{_partition_path(staging_dir, index)}' {parquet_copy_options()};
+"""
+            for index in touched
+        ), work_dir, "rewrite-partitions")
+    _write_manifest(staging_dir, {"bounds": bounds, "sequence": sequence, "rebuilt": manifest["rebuilt"]})
+
+    delta_rows = int(_read_csv(delta_rows_path)[0][0])
+    print(f"Rewrote {len(touched)} of {count} partition(s) with {delta_rows:,} delta row(s)")
+    return {"partitions": count, "rewritten": len(touched), "delta_rows": delta_rows}
+
+
+def assemble_partitions(partitions_dir: str, output_path: str, work_dir: str) -> None:
+    """Write the partitions of partitions_dir, concatenated in order, to output_path.
+
+    A plain scan of the file list: DuckDB preserves insertion order, so the
+    output keeps the partitions' sort without sorting again.
+    """
+    count = len(_read_manifest(partitions_dir)["bounds"]) + 1
+    partitions = ", ".join(f"'{_partition_path(partitions_dir, index)}'" for index in range(count))
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    _run_duckdb(f"""
+SET preserve_insertion_order = true;
+COPY (SELECT {_PLANET_COLUMNS} FROM read_parquet([{partitions}])) TO '{output_path}.tmp' {parquet_copy_options()};
+""", work_dir, "assemble-partitions")
+    os.rename(f"{output_path}.tmp", output_path)
+
+
+def commit_partitions(staging_dir: str, partitions_dir: str) -> dict | None:
+    """Replace the partitions of partitions_dir with the staged ones and record their state.
+
+    Returns the staged manifest, None when nothing is staged.
+    """
+    from workflows.utils.osm_replication import write_state
+
+    if not os.path.exists(manifest_path(staging_dir)):
+        return None
+    manifest = _read_manifest(staging_dir)
+    previous_dir = f"{partitions_dir}.previous"
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if os.path.exists(partitions_dir):
+        os.rename(partitions_dir, previous_dir)
+    os.rename(staging_dir, partitions_dir)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+    if manifest["sequence"] is not None:
+        write_state(manifest_path(partitions_dir), manifest["sequence"], manifest["rebuilt"])
+    return manifest
@@ -0,0 +1,378 @@
+"""OSM replication diffs between two planet snapshots.
+
+The planet PBF DAG keeps the planet current with pyosmium-up-to-date against
+the hourly replication server, which records the replication sequence number
+of the last applied diff in the PBF header
+(osmosis_replication_sequence_number). Datasets that keep their previous
+output read that sequence from the snapshot they were built from and from
+the new one, then replay exactly the hourly diffs in between (fetch_changes)
+instead of rebuilding from the whole planet. collect_changes also finds
+what those diffs affect: the ways and relations above the changed objects.
+
+Planet files updated in place that way record their replication state in a
+sidecar (read_state, write_state), and plan_update decides between an update
+and a full rebuild from it. Both paths are timed in one shared log
+(record_timing, report_timings).
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import shutil
+import statistics
+import time
+import urllib.request
+
+from openplanetdata.airflow.defaults import OPENPLANETDATA_WORK_DIR
+
+from workflows.utils.osm_subsets import OSMIUM_IMAGE, OSMIUM_MEM_LIMIT, run_in_container
+
+REPLICATION_URL = "https://planet.openstreetmap.org/replication/hour"
+# The weekly planet dump the planet PBF DAG falls back to (by torrent).
+PLANET_DUMP_URL = "https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf"
+# Download attempts per diff (linear backoff) before a fetch gives up; the
+# replication server occasionally answers 5xx for a few seconds.
+REPLICATION_FETCH_ATTEMPTS = 5
+REPLICATION_FETCH_TIMEOUT = 120
+
+# Update and rebuild durations of every planet file kept up to date from the
+# diffs, appended as JSON lines; report_timings compares the two paths over
+# the last REPLICATION_TIMINGS_HISTORY runs of each.
+REPLICATION_TIMINGS_PATH = f"{OPENPLANETDATA_WORK_DIR}/osm/replication-timings.jsonl"
+REPLICATION_TIMINGS_HISTORY = 10
+
+
+def replication_diff_url(sequence: int, base_url: str = REPLICATION_URL) -> str:
+    """URL of one replication diff: sequence 4123456 is 004/123/456.osc.gz."""
+    digits = f"{sequence:09d}"
+    return f"{base_url}/{digits[:3]}/{digits[3:6]}/{digits[6:]}.osc.gz"
+
+
+def replication_header(path: str) -> dict[str, str]:
+    """Header options of an OSM file (osmium fileinfo, without reading its data)."""
+    output = run_in_container(
+        ["fileinfo", "--json", path],
+        image=OSMIUM_IMAGE,
+        stdout_only=True,
+        shell=False,
+        step="osmium fileinfo",
+    )
+    return json.loads(output)["header"].get("option", {})
+
+
+def replication_sequence(path: str) -> int | None:
+    """Replication sequence an OSM file is up to date with, None if unknown."""
+    value = replication_header(path).get("osmosis_replication_sequence_number")
+    return int(value) if value else None
+
+
+def osm_file_readable(path: str) -> bool:
+    """Whether osmium reads every block of an OSM file without error.
+
+    Reads the whole file (osmium fileinfo --extended). Only a failure of
+    osmium itself counts: Docker errors are raised.
+    """
+    from docker.errors import ContainerError
+
+    try:
+        run_in_container(
+            ["fileinfo", "--extended", path],
+            image=OSMIUM_IMAGE,
+            mem_limit=OSMIUM_MEM_LIMIT,
+            shell=False,
+            step="osmium fileinfo extended",
+        )
+    except ContainerError as e:
+        print(f"{path} is unreadable: {e}")
+        return False
+    return True
+
+
+def planet_dump_date(url: str = PLANET_DUMP_URL) -> str | None:
+    """Date (ISO) of the latest weekly planet dump, from its Last-Modified; None if unknown."""
+    import email.utils
+
+    try:
+        request = urllib.request.Request(url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=REPLICATION_FETCH_TIMEOUT) as response:
+            return email.utils.parsedate_to_datetime(response.headers["Last-Modified"]).date().isoformat()
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Date of the planet dump {url} unknown: {e}")
+        return None
+
+
+def _download(url: str, path: str) -> int:
+    attempt = 1
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=REPLICATION_FETCH_TIMEOUT) as response, \
+                    open(f"{path}.tmp", "wb") as fh:
+                shutil.copyfileobj(response, fh)
+            os.rename(f"{path}.tmp", path)
+            return os.path.getsize(path)
+        except OSError as e:
+            if attempt == REPLICATION_FETCH_ATTEMPTS:
+                raise
+            print(f"Download of {url} failed ({e}), retrying")
+            time.sleep(10 * attempt)
+            attempt += 1
+
+
+def fetch_changes(start_sequence: int, end_sequence: int, output_path: str, base_url: str = REPLICATION_URL) -> int:
+    """Merge the diffs after start_sequence up to end_sequence into one change file.
+
+    Each diff is downloaded into a diffs/ directory next to output_path (kept
+    across retries), then all of them are merged with osmium merge-changes
+    --simplify, which keeps only the last version of every object. Returns
+    the number of bytes downloaded.
+    """
+    if end_sequence <= start_sequence:
+        raise ValueError(f"No diffs after {start_sequence} up to {end_sequence}")
+    diffs_dir = f"{os.path.dirname(output_path)}/diffs"
+    os.makedirs(diffs_dir, exist_ok=True)
+    paths = []
+    downloaded = 0
+    for sequence in range(start_sequence + 1, end_sequence + 1):
+        path = f"{diffs_dir}/{sequence}.osc.gz"
+        if not os.path.exists(path):
+            downloaded += _download(replication_diff_url(sequence, base_url), path)
+        paths.append(path)
+    print(f"Fetched {len(paths)} diff(s) {start_sequence + 1}..{end_sequence}: {downloaded:,} bytes downloaded")
+
+    run_in_container(
+        ["merge-changes", "--simplify", "--overwrite", "--output", output_path, *paths],
+        image=OSMIUM_IMAGE,
+        mem_limit=OSMIUM_MEM_LIMIT,
+        shell=False,
+        step="osmium merge-changes",
+    )
+    return downloaded
+
+
+def _write_ids(opl_path: str, outputs: dict[str, str]) -> None:
+    """Append the IDs (n1, w2, r3) of an OPL file to one ID file per object types.
+
+    outputs maps an ID file path to the types it takes ("nwr", "nw", "r").
+    """
+    files = {path: open(path, "a", encoding="utf-8") for path in outputs}
+    try:
+        with open(opl_path, encoding="utf-8") as fh:
+            for line in fh:
+                object_id = line.split(" ", 1)[0].strip()
+                if not object_id:
+                    continue
+                for path, types in outputs.items():
+                    if object_id[0] in types:
+                        files[path].write(f"{object_id}\n")
+    finally:
+        for output in files.values():
+            output.close()
+
+
+def _osmium(args: list[str], step: str) -> None:
+    run_in_container(args, image=OSMIUM_IMAGE, mem_limit=OSMIUM_MEM_LIMIT, shell=False, step=step)
+
+
+def extract_ids(planet_pbf: str, id_file: str, output_path: str) -> None:
+    """Extract the objects of an ID file from planet_pbf, with everything they reference.
+
+    IDs missing from the planet (objects the diffs deleted) are skipped.
+    """
+    from docker.errors import ContainerError
+
+    try:
+        _osmium(
+            ["getid", "--add-referenced", "--overwrite", "--id-file", id_file, "--output", output_path, planet_pbf],
+            "osmium getid",
+        )
+    except ContainerError as e:
+        # Exit 1: some IDs were not found.
+        if e.exit_status != 1 or not os.path.exists(output_path):
+            raise
+
+
+def collect_changes(planet_pbf: str, start_sequence: int, end_sequence: int, work_dir: str) -> dict[str, str]:
+    """Fetch the diffs after start_sequence and find what they affect in planet_pbf.
+
+    Besides the objects the diffs created, modified or deleted, a change
+    affects every way and relation above them, read from planet_pbf (the
+    planet at end_sequence):
+
+    1. getparents: the ways and relations referencing a changed object
+    2. getid --add-referenced: the changed nodes and ways and the ways of
+       step 1, with all their nodes
+    3. getparents --add-self on the planet's relations (one cat pass),
+       repeated until no relation is added: the changed relations, those
+       of step 1 and every relation above them
+
+    Returns paths in work_dir: "changes" (the merged diffs), "changed_ids"
+    (ID file of the changed objects), "members" and "members_ids" (step 2
+    and the nodes and ways it started from), "related" and "related_ids"
+    (step 3, and the ways and relations it started from).
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = {
+        "changes": f"{work_dir}/changes.osc.gz",
+        "changed_ids": f"{work_dir}/changed.ids",
+        "members": f"{work_dir}/members.osm.pbf",
+        "members_ids": f"{work_dir}/members.ids",
+        "related": f"{work_dir}/related.osm.pbf",
+        "related_ids": f"{work_dir}/related.ids",
+    }
+    opl_path = f"{work_dir}/objects.opl"
+    parents_path = f"{work_dir}/parents.osm.pbf"
+    relations_path = f"{work_dir}/relations.osm.pbf"
+    intermediates = (opl_path, parents_path, relations_path)
+
+    def write_ids(path: str, outputs: dict[str, str]) -> None:
+        _osmium(["cat", "--overwrite", "--output-format", "opl", "--output", opl_path, path], "osmium cat")
+        _write_ids(opl_path, outputs)
+
+    fetch_changes(start_sequence, end_sequence, paths["changes"])
+    for path in (*paths.values(), *intermediates):
+        if path != paths["changes"] and os.path.exists(path):
+            os.remove(path)
+    try:
+        write_ids(paths["changes"], {paths["changed_ids"]: "nwr", paths["members_ids"]: "nw", paths["related_ids"]: "r"})
+        _osmium(
+            ["getparents", "--overwrite", "--id-file", paths["changed_ids"], "--output", parents_path, planet_pbf],
+            "osmium getparents",
+        )
+        write_ids(parents_path, {paths["members_ids"]: "w", paths["related_ids"]: "wr"})
+        extract_ids(planet_pbf, paths["members_ids"], paths["members"])
+
+        _osmium(
+            ["cat", "--overwrite", "--object-type", "relation", "--output", relations_path, planet_pbf],
+            "osmium cat relations",
+        )
+        related = -1
+        while True:
+            _osmium(
+                [
+                    "getparents", "--add-self", "--overwrite",
+                    "--id-file", paths["related_ids"],
+                    "--output", paths["related"],
+                    relations_path,
+                ],
+                "osmium getparents relations",
+            )
+            write_ids(paths["related"], {paths["related_ids"]: "r"})
+            with open(paths["related_ids"], encoding="utf-8") as fh:
+                ids = set(fh)
+            if len(ids) == related:
+                break
+            related = len(ids)
+    finally:
+        for path in intermediates:
+            if os.path.exists(path):
+                os.remove(path)
+    return paths
+
+
+def _state_path(path: str) -> str:
+    return f"{path}.state.json"
+
+
+def _file_identity(path: str) -> list[int]:
+    # Copies keep size and mtime (shutil.copy2, cp -p), so the identity
+    # follows a file into the shared directory and back.
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_state(path: str) -> dict | None:
+    """Replication state of a planet file, None if unknown.
+
+    The state ({path}.state.json) holds the sequence the file is up to date
+    with and the date of its last full rebuild. It also records the size
+    and mtime of the file it describes: a state that outlived its file (a
+    new file copied without it) is never trusted.
+    """
+    try:
+        with open(_state_path(path), encoding="utf-8") as fh:
+            state = json.load(fh)
+        if state.pop("file") != _file_identity(path):
+            print(f"Replication state of {path} describes another file")
+            return None
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    return state
+
+
+def write_state(path: str, sequence: int, rebuilt: str, **fields) -> None:
+    """Record that path is up to date with sequence, last rebuilt on rebuilt (ISO date).
+
+    fields are kept along, for read_state to return.
+    """
+    tmp_path = f"{_state_path(path)}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump({**fields, "sequence": sequence, "rebuilt": rebuilt, "file": _file_identity(path)}, fh)
+    os.rename(tmp_path, _state_path(path))
+
+
+def drop_state(path: str) -> None:
+    """Forget the replication state of path, so that it gets rebuilt."""
+    if os.path.exists(_state_path(path)):
+        os.remove(_state_path(path))
+
+
+def plan_update(state: dict | None, sequence: int | None, max_hours: int, rebuild_days: int) -> tuple[str, str]:
+    """Decide how to bring a planet file with state to sequence.
+
+    Returns ("update", reason) when replaying the diffs is safe, else
+    ("rebuild", reason): no usable state or sequence, a planet behind the
+    file (re-downloaded from an older dump), a gap of more than max_hours
+    diffs, or a last rebuild rebuild_days or more ago (the scheduled
+    rebuild, which bounds any drift of the update path).
+    """
+    if sequence is None:
+        return "rebuild", "the planet has no replication sequence"
+    if state is None:
+        return "rebuild", "no trusted replication state"
+    if sequence < state["sequence"]:
+        return "rebuild", f"the planet ({sequence}) is behind the file ({state['sequence']})"
+    if sequence - state["sequence"] > max_hours:
+        return "rebuild", f"{sequence - state['sequence']} diffs behind"
+    age = (datetime.date.today() - datetime.date.fromisoformat(state["rebuilt"])).days
+    if age >= rebuild_days:
+        return "rebuild", f"scheduled, last rebuilt {age} days ago"
+    return "update", f"{sequence - state['sequence']} diff(s) since {state['sequence']}, rebuilt {age} days ago"
+
+
+def record_timing(dataset: str, mode: str, seconds: float, path: str | None = None, **fields) -> None:
+    """Append one update or rebuild duration of dataset to the timings log."""
+    path = path or REPLICATION_TIMINGS_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    record = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "dataset": dataset,
+        "mode": mode,
+        "seconds": round(seconds, 1),
+        **fields,
+    }
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(record) + "\n")
+
+
+def report_timings(dataset: str, path: str | None = None) -> None:
+    """Print the median update and rebuild durations of dataset's recent runs.
+
+    With the bytes downloaded, for runs that record them (a downloaded field).
+    """
+    records = []
+    try:
+        with open(path or REPLICATION_TIMINGS_PATH, encoding="utf-8") as fh:
+            records = [json.loads(line) for line in fh if line.strip()]
+    except FileNotFoundError:
+        pass
+    for mode in ("update", "rebuild"):
+        runs = [r for r in records if r["dataset"] == dataset and r["mode"] == mode][-REPLICATION_TIMINGS_HISTORY:]
+        if not runs:
+            continue
+        line = f"{dataset} {mode}: median {statistics.median(r['seconds'] for r in runs) / 60:,.1f} min"
+        downloaded = [r["downloaded"] for r in runs if r.get("downloaded") is not None]
+        if downloaded:
+            line += f", {statistics.median(downloaded):,.0f} bytes downloaded"
+        print(f"{line} over {len(runs)} run(s)")
@@ -5,15 +5,27 @@ the daily planet artifacts:
 
 1. PBF        gol query <planet.gol> --area <boundary> -f pbf followed by an
               osmium complete_ways post-filter, or direct osmium extraction
-              from <planet.osm.pbf> for planet-scale areas
+              from <planet.osm.pbf> for planet-scale areas (all of them in a
+              single multi-extract pass when possible). In hierarchical mode
+              a subset is instead cut with osmium from the smallest
+              already-built parent PBF whose boundary covers it (FR-IDF from
+              FR, FR from europe), falling back to the same osmium cut from
+              <planet.osm.pbf>, so its content does not depend on which
+              parents were built
 2. GOL v2     gol build from the subset PBF
 3. GOB        gol save from the subset GOL
-4. GeoParquet DuckDB COPY from the planet GeoParquet (bbox prefilter for
-              row-group pruning + ST_Intersects with the boundary)
+4. GeoParquet DuckDB COPY from the planet GeoParquet in one DuckDB session
+              per batch, one scan joined against all of its boundaries
+              (bbox prefilter for row-group pruning, a quadtree grid that
+              settles rows deep inside/outside the boundary, ST_Intersects
+              with the small pieces the boundary is subdivided into for
+              the rest)
 
 Boundary polygons come from the openplanetdata-boundaries planet aggregates and
 are pre-simplified (0.005 deg) per input geometry, then unioned, buffered
-(0.02 deg) and simplified (0.01 deg) once per run: the raw coastline-clipped
+(0.02 deg) and simplified (0.01 deg) in a local Shapely process pool (or one
+ogr2ogr container per code), once per distinct raw geometry thanks to a
+cross-run cache: the raw coastline-clipped
 boundaries have millions of vertices (europe is a ~620 MB GeoJSON), which
 would cripple both gol's and DuckDB's point-in-polygon tests - and buffering
 them at full resolution exhausts GEOS memory (a full-res europe buffer got
@@ -21,32 +33,91 @@ OOM-killed along with the edge worker). Pre-simplification error (0.005) plus
 final simplification error (0.01) stays below the 0.02 buffer, so the result
 remains a superset of the land boundary: nearshore objects are retained,
 deep-offshore objects are excluded (land-extract semantics).
+
+Subsets can also be refreshed rather than extracted: a subset PBF kept from
+an earlier run (SUBSET_PREVIOUS_DIR) is brought up to the planet snapshot with
+the replication diffs in between (prepare_subset_refresh, refresh_subset_pbf),
+and a subset whose content did not change is not built or uploaded again.
+
+Tool steps run in Docker containers with per-step memory limits; subset
+batches exec them in warm pooled containers (ContainerPool) instead of
+creating a container per step. Deployments with the tools installed natively
+set OPENPLANETDATA_SUBSET_BACKEND=local to run them as local processes under
+the same limits (LocalRunner).
 """
 
 from __future__ import annotations
 
+import contextlib
+import contextvars
+import dataclasses
+import functools
+import hashlib
 import json
 import os
+import re
 import shlex
 import shutil
-from typing import Any
+import statistics
+import threading
+import time
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from typing import Any, NamedTuple
 
 from openplanetdata.airflow.defaults import (
     DOCKER_MOUNT,
     GDAL_FULL_IMAGE,
     OPENPLANETDATA_IMAGE,
+    OPENPLANETDATA_WORK_DIR,
     R2_BUCKET,
 )
 
+from workflows.utils.geometry import PackedGeometry
+from workflows.utils.geoparquet_layout import parquet_copy_options
+
 BOUNDARY_BUFFER_DEG = 0.02
 BOUNDARY_SIMPLIFY_DEG = 0.01
 BOUNDARY_PRESIMPLIFY_DEG = 0.005
 
-# Hard cap for the boundary-prep GDAL container: a runaway ST_Buffer must die
-# alone instead of triggering the host OOM killer (which also takes down the
-# Airflow edge worker and loses the task logs).
+# Hard cap for the boundary-prep GDAL container (and for the Shapely worker
+# preparing the largest boundary; the other workers get a
+# BOUNDARY_PREP_WORKERS-th of it each): a runaway ST_Buffer must die alone
+# instead of triggering the host OOM killer (which also takes down the Airflow
+# edge worker and loses the task logs).
 BOUNDARY_PREP_MEM_LIMIT = "64g"
 
+# "shapely" prepares boundaries in a local process pool; "ogr2ogr" starts one
+# GDAL container per code. Both produce the same prepared/meta files.
+BOUNDARY_PREP_ENGINE = "shapely"
+BOUNDARY_PREP_WORKERS = 4
+# SpatiaLite's ST_Buffer approximates each quarter circle with 30 segments
+# (GEOS defaults to 8); match it so both engines trace the same outline.
+BOUNDARY_BUFFER_QUAD_SEGS = 30
+
+# The prepared boundary is also cut into pieces of at most this many vertices
+# ({code}.pieces.geojson), each with its own bbox, so the GeoParquet extracts
+# test most candidate rows against a tiny polygon instead of a whole country.
+# Adjacent pieces overlap by BOUNDARY_PIECE_OVERLAP_DEG: their union is the
+# boundary itself, without float gaps along the cut lines.
+BOUNDARY_PIECE_MAX_VERTICES = 256
+BOUNDARY_PIECE_OVERLAP_DEG = 1e-7
+BOUNDARY_PIECE_MAX_DEPTH = 32
+# Pieces are matched to rows through a hash join on grid cells of this size
+# (a range join on the piece bboxes was two orders of magnitude slower than
+# the scan). Rows whose bbox spans several cells are rare and are tested
+# against the whole boundary instead.
+BOUNDARY_PIECE_CELL_DEG = 1.0
+# Quadtree below those cells ({code}.grid.csv): every leaf is inside, outside
+# or on the edge of the boundary, down to BOUNDARY_GRID_LEVELS halvings
+# (1/16 deg). Rows whose bbox lies in an inside or outside leaf are accepted
+# or rejected on integer cell keys alone; only the rest reach the pieces.
+BOUNDARY_GRID_LEVELS = 4
+# Cells are classified with this margin, and piece bboxes widened by it, so
+# planet bboxes rounded to float32 (ulp up to 1.5e-5 deg near +-180) can
+# never land a row in the wrong cell.
+BOUNDARY_GRID_MARGIN_DEG = 1e-4
+
 # Same protection for the gol containers: gol 2.3's PBF exporter buffers the
 # whole result set in memory (a europe extract reached ~120 GiB RSS on the
 # 124 GiB host and the global OOM killer took out neighboring pods and the
@@ -56,6 +127,12 @@ GOL_MEM_LIMIT = "100g"
 # osmium's complete_ways extractor uses compact ID bitsets and two input passes,
 # but keep a generous hard cap so regressions cannot take down the edge worker.
 OSMIUM_MEM_LIMIT = "32g"
+# A multi-extract pass keeps one set of ID bitsets per extract (roughly 2-3 GiB
+# each at planet scale), so writing all continents at once gets a larger cap,
+# and a pass writes at most OSMIUM_MULTI_EXTRACT_MAX_CODES extracts (more take
+# another pass over the planet).
+OSMIUM_MULTI_EXTRACT_MEM_LIMIT = "64g"
+OSMIUM_MULTI_EXTRACT_MAX_CODES = 24
 OSMIUM_IMAGE = "docker.io/iboates/osmium:1.19.0"
 
 # DuckDB's allocator limit does not include every allocation or filesystem
@@ -66,6 +143,119 @@ PARQUET_CONTAINER_MEM_LIMIT = "64g"
 PARQUET_DUCKDB_MEMORY_LIMIT = "32GB"
 PARQUET_DUCKDB_THREADS = 24
 
+# Prepared boundaries survive across runs (and across the continents/countries,
+# regions and benchmark DAGs) in a content-addressed cache outside every DAG's
+# WORK_DIR, keyed by the raw geometry and the preparation parameters. Least
+# recently used entries are evicted beyond the disk budget.
+BOUNDARY_CACHE_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/.boundary-cache"
+BOUNDARY_CACHE_MAX_BYTES = 20 * 1024**3
+# Bump to invalidate every cached boundary when the preparation output
+# changes in a way the key parameters do not capture.
+BOUNDARY_CACHE_VERSION = 3
+BOUNDARY_CACHE_FILES = ("prepared.geojson", "osmium.geojson", "pieces.geojson", "grid.csv", "meta.json")
+
+# Country PBFs kept for the regions DAG to cut its regions from, instead of
+# querying the planet GOL. The store is tagged with the planet snapshot it was
+# built from and only used by a regions run that snapshotted the same planet.
+# Sized like one planet PBF; reset by every continents/countries run.
+SUBSET_PARENTS_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/parents"
+
+# Previous subset PBFs, brought up to date with the replication diffs instead
+# of being extracted again every run (see refresh_subset_pbf). Next to each
+# {code}-latest.osm.pbf, {code}.json records the replication sequence it is
+# up to date with, a digest of the boundary it was cut with, the osmium extract
+# options it was cut with (a PBF cut any other way is extracted in full again)
+# and the number of incremental refreshes since its last full extract. Kept
+# across runs; sized like the outputs of the levels that use it.
+SUBSET_PREVIOUS_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/previous"
+# Incremental refreshes in a row before a subset is extracted in full again,
+# which bounds any drift of the incremental path (a malformed diff, history
+# redactions the diffs do not carry).
+SUBSET_REFRESH_MAX_INCREMENTAL = 6
+# Hours of diffs replayed at most: after a longer gap (a stalled planet DAG)
+# every subset is extracted in full.
+SUBSET_REFRESH_MAX_HOURS = 72
+
+# Per-subset timings of every run, appended as JSON lines and read back to
+# predict subset cost (see estimate_subset_costs). Shared by all subset DAGs.
+SUBSET_TIMINGS_PATH = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/timings.jsonl"
+# A subset with history is predicted from the median of its last runs; the
+# level's calibration uses its last SUBSET_TIMINGS_CALIBRATION records.
+SUBSET_TIMINGS_HISTORY = 5
+SUBSET_TIMINGS_CALIBRATION = 500
+# Prior cost of a subset without history, before calibration: every step
+# scales with the data inside the boundary, which area approximates, and the
+# osmium/gol point-in-polygon tests with its vertex count. Roughly a 10M km²
+# continent at 35 minutes and a micro-state at half a minute.
+SUBSET_COST_OVERHEAD_SECONDS = 30.0
+SUBSET_COST_SECONDS_PER_KM2 = 2e-4
+SUBSET_COST_SECONDS_PER_VERTEX = 2e-3
+# Mean length of one degree at the equator, for the planar area fallback.
+_KM_PER_DEG = 111.32
+
+# Builds of one batch run in parallel as long as their predicted peak memory
+# (largest container of the build: gol query/build/save, osmium) fits the
+# host. The prior for a subset without history is a base plus a term linear
+# in area (a 17M km² country's gol export reached ~60 GiB); history keeps the
+# largest recent peak. Predictions get a safety margin, and this much memory
+# is always left to the OS, Airflow and other Docker workloads.
+BUILD_PEAK_RSS_BASE_BYTES = 2 * 1024**3
+BUILD_PEAK_RSS_BYTES_PER_KM2 = 4096
+BUILD_PEAK_RSS_SAFETY = 1.25
+BUILD_MEMORY_RESERVE_BYTES = 16 * 1024**3
+
+# process_subset_batch pipelines its codes through these stages, each code
+# moving on as soon as its own previous stage is done. The build stages keep
+# the four concurrent steps of the former strict phases, so more codes in
+# flight (build_workers) fill the other stages instead of oversubscribing
+# one; tune them with the container telemetry. An upload stage is one
+# artifact streaming to R2, started once every artifact of its code is
+# final; uploads are network-bound, so they overlap the tools. The GeoParquet
+# extracts are not a stage: a batch scans the planet GeoParquet once, in
+# one DuckDB session of PARQUET_DUCKDB_THREADS threads, as soon as every
+# code's PBF extract is done (while GOL builds and saves still run).
+SUBSET_STAGE_LIMITS = {"extract": 4, "gol build": 4, "gol save": 4, "upload": 4}
+# The build artifact each artifact is made from: finalizing the GOL ends the
+# build's use of the PBF, finalizing the GOB its use of the GOL. An artifact
+# is deleted once uploaded and no longer needed by the build.
+SUBSET_ARTIFACT_SOURCES = {"gol": "pbf", "gob": "gol"}
+# Admission prediction of the parquet session: DuckDB's memory_limit plus
+# what it allocates outside of it.
+PARQUET_SESSION_PEAK_RSS_BYTES = 40 * 1024**3
+
+# Container telemetry (see container_telemetry_log), one JSONL file per DAG
+# run under {dag_id}/{run_id}.jsonl: peak memory, CPU seconds, block I/O and
+# wall time of every gol, osmium, DuckDB and ogr2ogr container, for tuning
+# GOL_MEM_LIMIT, OSMIUM_MEM_LIMIT and PARQUET_DUCKDB_THREADS.
+SUBSET_TELEMETRY_DIR = f"{OPENPLANETDATA_WORK_DIR}/osm/subsets/telemetry"
+
+# Warm containers of a ContainerPool carry this label, set to the owning
+# "{hostname}:{pid}", so the ones a killed task left behind can be found.
+# A warm container is recycled after CONTAINER_POOL_MAX_EXECS execs, which
+# bounds whatever the steps leave behind in it (page cache charged to its
+# cgroup, stray processes).
+CONTAINER_POOL_LABEL = "org.openplanetdata.subsets.pool"
+CONTAINER_POOL_MAX_EXECS = 100
+
+# Execution backend of the tool steps, chosen per deployment: "docker" runs
+# each step in a container of its image (pooled within subset batches),
+# "local" runs the natively installed gol, osmium, duckdb and ogr2ogr as
+# subprocesses of the worker (see LocalRunner).
+SUBSET_EXECUTION_BACKEND = os.environ.get("OPENPLANETDATA_SUBSET_BACKEND", "docker")
+# Delegated cgroup v2 directory (memory controller enabled for its children,
+# writable by the worker) in which the local backend runs each step in a
+# child cgroup capped at the step's mem_limit, like a container. Without
+# one, the cap is an RLIMIT_DATA on every process of the step.
+SUBSET_LOCAL_CGROUP = os.environ.get("OPENPLANETDATA_SUBSET_CGROUP")
+# Worker environment variables the local backend passes on to the tools;
+# like a container, a step sees nothing else but its own env.
+_LOCAL_ENV_PASSTHROUGH = ("PATH", "HOME", "LANG", "LC_ALL", "TZ")
+
+# Read size of the streaming boundary splitter. A feature larger than one
+# chunk grows the buffer geometrically, so only the largest single feature -
+# never the whole multi-GB aggregate - has to fit in memory.
+BOUNDARY_SPLIT_CHUNK_CHARS = 16 * 1024 * 1024
+
 # A PBF smaller than this holds only a header: the boundary matched nothing.
 EMPTY_PBF_THRESHOLD_BYTES = 1024
 
@@ -107,9 +297,6 @@ rm -f {work_dir}/duckdb.zip
 """
 
 
-_PULLED_IMAGES: set[str] = set()
-
-
 def _marker_matches(path: str, expected: str) -> bool:
     try:
         with open(path, "r", encoding="utf-8") as fh:
@@ -118,179 +305,1883 @@ def _marker_matches(path: str, expected: str) -> bool:
         return False
 
 
-def run_in_container(
+class DockerRunner:
+    """Start the pipeline's tool containers on the local Docker daemon.
+
+    The default container runner. Anything with the same start() method can
+    replace it (see container_runner), as long as the objects it returns
+    behave like docker-py containers for what the pipeline uses: wait(),
+    logs(), remove(), reload()/status and stats().
+
+    Containers run as DOCKER_USER, or with image_user as their image's own
+    default user, like a DockerOperator's.
+    """
+
+    def __init__(self, image_user: bool = False):
+        self._pulled: set[str] = set()
+        self._lock = threading.Lock()
+        self._image_user = image_user
+
+    def _run(self, image: str, **options):
+        """Start a detached container of image with the /data mount."""
+        import docker
+        from docker.types import Mount
+
+        from openplanetdata.airflow.operators.gol import DOCKER_USER
+
+        client = docker.from_env()
+        # Pulled once per process, mirroring DockerOperator's force_pull.
+        with self._lock:
+            if image not in self._pulled:
+                client.images.pull(image)
+                self._pulled.add(image)
+
+        if not self._image_user:
+            options["user"] = DOCKER_USER
+        return client.containers.run(
+            image=image,
+            detach=True,
+            mounts=[Mount(**DOCKER_MOUNT)],
+            **options,
+        )
+
+    def start(self, cmd: str | list[str], image: str, env: dict | None, mem_limit: str | None, shell: bool):
+        container_command = f"bash -c {shlex.quote(cmd)}" if shell else cmd
+        return self._run(image, command=container_command, environment=env or {}, mem_limit=mem_limit)
+
+
+def _stats_counters(stats: dict) -> tuple[int, dict[str, int]]:
+    """Cumulative CPU nanoseconds and block I/O bytes of a Docker stats sample."""
+    cpu = ((stats.get("cpu_stats") or {}).get("cpu_usage") or {}).get("total_usage", 0)
+    # cgroup v1 reports "Read"/"Write", cgroup v2 "read"/"write".
+    io = {"read": 0, "write": 0}
+    for entry in (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []:
+        op = entry.get("op", "").lower()
+        if op in io:
+            io[op] += entry.get("value", 0)
+    return cpu, io
+
+
+def _stats_rx_bytes(stats: dict) -> int:
+    """Cumulative network bytes received, over all interfaces, of a Docker stats sample."""
+    return sum(network.get("rx_bytes", 0) for network in (stats.get("networks") or {}).values())
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _CommandHandle:
+    """Output and state of a command run outside its own container.
+
+    Base of the stand-ins ContainerPool and LocalRunner return for a
+    docker-py container: output is collected as it streams (there is no
+    container to keep logs), and the subclass sets _done when the command
+    has finished.
+    """
+
+    STATS_INTERVAL = 1.0
+
+    def __init__(self):
+        self._output: list[tuple[bool, bytes]] = []
+        self._done = threading.Event()
+        self._removed = False
+
+    @property
+    def status(self) -> str:
+        return "exited" if self._done.is_set() else "running"
+
+    def _collect(self, stream, is_stdout: bool | None = None) -> None:
+        """Append stream's chunks; demuxed (stdout, stderr) pairs when is_stdout is None."""
+        for chunk in stream:
+            if is_stdout is not None:
+                self._output.append((is_stdout, chunk))
+                continue
+            stdout, stderr = chunk
+            if stdout:
+                self._output.append((True, stdout))
+            if stderr:
+                self._output.append((False, stderr))
+
+    def logs(
+        self, stdout: bool = True, stderr: bool = True, tail: int | str = "all", stream: bool = False,
+        follow: bool = False,
+    ):
+        if stream:
+            return self._follow(stdout, stderr, follow)
+        data = b"".join(
+            chunk for is_stdout, chunk in list(self._output)
+            if (stdout if is_stdout else stderr)
+        )
+        if tail != "all":
+            data = b"".join(data.splitlines(keepends=True)[-tail:])
+        return data
+
+    def _follow(self, stdout: bool, stderr: bool, follow: bool) -> Iterator[bytes]:
+        """Yield output chunks as collected; with follow, until the command has finished."""
+        index = 0
+        while True:
+            done = self._done.is_set() or not follow
+            chunks = self._output[index:]
+            index += len(chunks)
+            for is_stdout, chunk in chunks:
+                if stdout if is_stdout else stderr:
+                    yield chunk
+            if done:
+                return
+            self._done.wait(self.STATS_INTERVAL)
+
+    def reload(self) -> None:
+        pass
+
+
+class _PooledExec(_CommandHandle):
+    """One command exec'd in a pooled container, shaped like a docker-py container.
+
+    wait() reports the exec's exit code, stats() the container's usage while
+    the exec runs, and remove() hands the container back to the pool, for
+    reuse only if Docker reported the exec finished with an exit code.
+    """
+
+    def __init__(self, pool: ContainerPool, key: tuple, container, command: list[str], env: dict | None):
+        super().__init__()
+        self._pool = pool
+        self._key = key
+        self._container = container
+        self._api = container.client.api
+        self._exit_code: int | None = None
+        self._exec_id = self._api.exec_create(container.id, command, environment=env or None)["Id"]
+        # The exec starts with this request; its output is collected as it
+        # streams, since Docker keeps no logs for execs.
+        stream = self._api.exec_start(self._exec_id, stream=True, demux=True)
+        threading.Thread(target=self._stream, args=(stream,), daemon=True).start()
+
+    @property
+    def id(self) -> str:
+        return self._container.id
+
+    def _stream(self, stream) -> None:
+        try:
+            self._collect(stream)
+        except Exception:
+            # The container was removed under the exec (pool closed), or the
+            # stream broke while the exec may still run: wait() asks Docker.
+            pass
+        finally:
+            self._done.set()
+
+    def wait(self, timeout: float | None = None) -> dict:
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Exec still running after {timeout}s")
+        if self._exit_code is None:
+            # The output stream can close a moment before the exit code lands.
+            for _ in range(50):
+                info = self._api.exec_inspect(self._exec_id)
+                if not info["Running"] and isinstance(info.get("ExitCode"), int):
+                    self._exit_code = info["ExitCode"]
+                    break
+                time.sleep(0.1)
+            else:
+                raise RuntimeError(f"Exec {self._exec_id[:12]} lost its output stream but has not exited")
+        return {"StatusCode": self._exit_code}
+
+    def stats(self, decode: bool = True, stream: bool = True) -> Iterator[dict]:
+        """Yield container stats while the exec runs, then stop.
+
+        The container runs nothing else, so its usage is the exec's, except
+        that CPU and block I/O counters are rebased on the first sample (they
+        are cumulative over every exec) and memory usage includes active page
+        cache left by earlier execs.
+        """
+        baseline = None
+        while not self._done.is_set():
+            stats = self._api.stats(self._container.id, stream=False, one_shot=True)
+            if self._done.is_set():
+                return
+            cpu, io = _stats_counters(stats)
+            if baseline is None:
+                baseline = cpu, io
+            yield {
+                "memory_stats": stats.get("memory_stats") or {},
+                "cpu_stats": {"cpu_usage": {"total_usage": cpu - baseline[0]}},
+                "blkio_stats": {"io_service_bytes_recursive": [
+                    {"op": op, "value": value - baseline[1][op]} for op, value in io.items()
+                ]},
+            }
+            self._done.wait(self.STATS_INTERVAL)
+
+    def remove(self, force: bool = False) -> None:
+        if self._removed:
+            return
+        self._removed = True
+        self._pool._release(self._key, self._container, reusable=self._exit_code is not None)
+
+
+class ContainerPool(DockerRunner):
+    """Container runner that execs each command in a warm, long-lived container.
+
+    Creating, waiting on and force-removing a container per step costs every
+    subset build 3-4 container lifecycles, well over 10,000 per regions run.
+    The pool keeps warm containers (`sleep infinity` under an init process)
+    per image and memory limit, and runs each command in one of them with
+    docker exec. A warm container serves one exec at a time: it is checked
+    out for the exec and returned when the exec is removed, so every step
+    still runs alone under its own mem_limit cgroup and concurrent steps
+    each get a container. An exec that is still running when it is removed
+    (task kill, timeout) takes its container down with it; an exec that
+    failed, even OOM-killed, leaves a reusable container.
+
+    Close the pool to remove its containers (see container_pool).
+    """
+
+    def __init__(self, max_execs: int = CONTAINER_POOL_MAX_EXECS):
+        super().__init__()
+        self.max_execs = max_execs
+        self._idle: dict[tuple, list] = {}
+        self._live: dict[str, Any] = {}
+        self._execs: dict[str, int] = {}
+        self._entrypoints: dict[str, list[str]] = {}
+        self._closed = False
+
+    @staticmethod
+    def _owner() -> str:
+        import socket
+
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _checkout(self, key: tuple):
+        with self._lock:
+            idle = self._idle.get(key, [])
+            container = idle.pop() if idle else None
+        if container is not None:
+            from docker.errors import NotFound
+
+            try:
+                container.reload()
+                if container.status == "running":
+                    return container
+            except NotFound:
+                pass
+            self._discard(container)
+
+        image, mem_limit = key
+        container = self._run(
+            image,
+            entrypoint=["sleep", "infinity"],
+            init=True,
+            mem_limit=mem_limit,
+            labels={CONTAINER_POOL_LABEL: self._owner()},
+        )
+        with self._lock:
+            self._live[container.id] = container
+            self._execs[container.id] = 0
+        if image not in self._entrypoints:
+            # Execs bypass the entrypoint; prepend the image's own (the
+            # osmium image exposes its CLI that way).
+            config = container.client.images.get(image).attrs.get("Config") or {}
+            self._entrypoints[image] = config.get("Entrypoint") or []
+        return container
+
+    def _release(self, key: tuple, container, reusable: bool) -> None:
+        with self._lock:
+            if container.id in self._execs:
+                self._execs[container.id] += 1
+                if reusable and not self._closed and self._execs[container.id] < self.max_execs:
+                    self._idle.setdefault(key, []).append(container)
+                    return
+        self._discard(container)
+
+    def _discard(self, container) -> None:
+        from docker.errors import NotFound
+
+        with self._lock:
+            self._live.pop(container.id, None)
+            self._execs.pop(container.id, None)
+        try:
+            container.remove(force=True)
+        except NotFound:
+            pass
+
+    def start(self, cmd: str | list[str], image: str, env: dict | None, mem_limit: str | None, shell: bool):
+        key = (image, mem_limit)
+        container = self._checkout(key)
+        command = ["bash", "-c", cmd] if shell else list(cmd)
+        try:
+            return _PooledExec(self, key, container, self._entrypoints[image] + command, env)
+        except BaseException:
+            self._discard(container)
+            raise
+
+    def close(self) -> None:
+        """Remove every container of the pool, killing running execs."""
+        with self._lock:
+            self._closed = True
+            containers = list(self._live.values())
+            self._idle.clear()
+        for container in containers:
+            self._discard(container)
+
+    def remove_orphans(self) -> int:
+        """Remove pooled containers of dead processes on this host; return how many.
+
+        A task killed with SIGKILL never closes its pool, and its warm
+        containers would otherwise sleep forever.
+        """
+        import socket
+
+        import docker
+
+        host = socket.gethostname()
+        removed = 0
+        client = docker.from_env()
+        for container in client.containers.list(all=True, filters={"label": CONTAINER_POOL_LABEL}):
+            owner_host, _, pid = container.labels.get(CONTAINER_POOL_LABEL, "").rpartition(":")
+            if owner_host != host or not pid.isdigit() or _process_alive(int(pid)):
+                continue
+            container.remove(force=True)
+            removed += 1
+        return removed
+
+
+@contextlib.contextmanager
+def container_runner(runner) -> Iterator[None]:
+    """Run every container of this process with runner instead of the backend's.
+
+    For offline benchmarks and tests (see scripts/benchmark_subsets_offline.py):
+    the whole pipeline, DuckDB worker sessions included, goes through
+    start_container. The planet DAGs also pin their steps to Docker this way,
+    whatever the subset backend.
+    """
+    global _container_runner
+    previous, _container_runner = _container_runner, runner
+    try:
+        yield
+    finally:
+        _container_runner = previous
+
+
+def _read_key_values(path: str) -> dict[str, int]:
+    """Parse a "key value" file (cgroup memory.stat, cpu.stat) into ints."""
+    values = {}
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                key, _, value = line.partition(" ")
+                if value.strip().isdigit():
+                    values[key] = int(value)
+    except OSError:
+        pass
+    return values
+
+
+def _process_tree(pid: int) -> list[int]:
+    """pid and its live descendants."""
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children", "r", encoding="utf-8") as fh:
+                    pending.extend(int(child) for child in fh.read().split())
+        except OSError:
+            continue
+    return tree
+
+
+class _LocalProcess(_CommandHandle):
+    """One step run as a local process group, shaped like a docker-py container.
+
+    wait() reports its exit code the way Docker does (128 + signal when
+    killed), stats() samples its cgroup, or its process tree without one,
+    and remove() kills whatever is left of it and removes the cgroup.
+    """
+
+    def __init__(self, command: list[str], env: dict, cgroup: str | None):
+        import subprocess
+
+        super().__init__()
+        self._cgroup = cgroup
+        # Its own session, so remove() reaches the whole process group; no
+        # preexec_fn, which is unsafe in the threaded builds.
+        self._process = subprocess.Popen(
+            command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self._readers = [
+            threading.Thread(target=self._collect, args=(iter(functools.partial(pipe.read1, 65536), b""), is_stdout),
+                             daemon=True)
+            for pipe, is_stdout in ((self._process.stdout, True), (self._process.stderr, False))
+        ]
+        for reader in self._readers:
+            reader.start()
+
+    @property
+    def id(self) -> str:
+        return str(self._process.pid)
+
+    @property
+    def status(self) -> str:
+        return "exited" if self._process.poll() is not None else "running"
+
+    def _kill(self) -> None:
+        import signal
+
+        if self._cgroup is not None and os.path.exists(f"{self._cgroup}/cgroup.kill"):
+            with open(f"{self._cgroup}/cgroup.kill", "w", encoding="utf-8") as fh:
+                fh.write("1")
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self._process.pid, signal.SIGKILL)
+
+    def wait(self, timeout: float | None = None) -> dict:
+        returncode = self._process.wait(timeout)
+        # Like a container's, a step's processes end with its main process
+        # (and stop holding the output pipes open).
+        self._kill()
+        for reader in self._readers:
+            reader.join()
+        self._done.set()
+        return {"StatusCode": 128 - returncode if returncode < 0 else returncode}
+
+    def _sample(self) -> dict:
+        if self._cgroup is not None:
+            memory = _read_key_values(f"{self._cgroup}/memory.stat")
+            with open(f"{self._cgroup}/memory.current", "r", encoding="utf-8") as fh:
+                usage = int(fh.read())
+            cpu = _read_key_values(f"{self._cgroup}/cpu.stat").get("usage_usec", 0) * 1000
+            io = {"read": 0, "write": 0}
+            with contextlib.suppress(OSError), open(f"{self._cgroup}/io.stat", "r", encoding="utf-8") as fh:
+                for line in fh:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition("=")
+                        if key in ("rbytes", "wbytes"):
+                            io["read" if key == "rbytes" else "write"] += int(value)
+            inactive_file = memory.get("inactive_file", 0)
+        else:
+            usage, ticks, io = 0, 0, {"read": 0, "write": 0}
+            for pid in _process_tree(self._process.pid):
+                with contextlib.suppress(OSError, ValueError, IndexError):
+                    with open(f"/proc/{pid}/status", "r", encoding="utf-8") as fh:
+                        usage += next((int(line.split()[1]) * 1024 for line in fh if line.startswith("VmRSS:")), 0)
+                    with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as fh:
+                        fields = fh.read().rpartition(")")[2].split()
+                    ticks += int(fields[11]) + int(fields[12])
+                    counters = _read_key_values(f"/proc/{pid}/io")
+                    io["read"] += counters.get("read_bytes:", 0)
+                    io["write"] += counters.get("write_bytes:", 0)
+            cpu = ticks * 1_000_000_000 // os.sysconf("SC_CLK_TCK")
+            inactive_file = 0
+        return {
+            "memory_stats": {"usage": usage, "stats": {"inactive_file": inactive_file}},
+            "cpu_stats": {"cpu_usage": {"total_usage": cpu}},
+            "blkio_stats": {"io_service_bytes_recursive": [{"op": op, "value": value} for op, value in io.items()]},
+        }
+
+    def stats(self, decode: bool = True, stream: bool = True) -> Iterator[dict]:
+        """Yield Docker-shaped stats samples until the process exits.
+
+        Without a cgroup, memory is the RSS sum and CPU and I/O the counters
+        of the live process tree, so a child that already exited is missed.
+        """
+        while self._process.poll() is None:
+            try:
+                yield self._sample()
+            except OSError:
+                return
+            # Set by wait(), which ends the stream without a last interval.
+            self._done.wait(self.STATS_INTERVAL)
+
+    def remove(self, force: bool = False) -> None:
+        if self._removed:
+            return
+        self._removed = True
+        self._kill()
+        self.wait()
+        if self._cgroup is not None:
+            # The kill is asynchronous; the cgroup is busy until it lands.
+            for _ in range(50):
+                try:
+                    os.rmdir(self._cgroup)
+                    break
+                except FileNotFoundError:
+                    break
+                except OSError:
+                    time.sleep(0.1)
+
+
+class LocalRunner:
+    """Container runner that runs the tools natively, one process group per step.
+
+    For hosts with gol, osmium, duckdb and ogr2ogr installed, where the
+    Docker wrapper only adds startup latency and hides the processes from
+    cgroup and perf tooling. Commands run as they would in their container:
+    shell commands through bash, an image's entrypoint (osmium) in front of
+    its argument lists, paths as-is (the work directory is mounted at the
+    same path in the containers), and an environment of step env plus the
+    _LOCAL_ENV_PASSTHROUGH variables. mem_limit caps the step's child cgroup
+    under SUBSET_LOCAL_CGROUP (memory.max, no swap), so an overrun is
+    OOM-killed with exit status 137 as in a container. Without a delegated
+    cgroup, RLIMIT_DATA caps every process of the step instead; that makes
+    allocations fail rather than OOM-kill, and leaves out file mappings such
+    as gol's memory-mapped tiles.
+    """
+
+    # Images whose CLI is their entrypoint: shell=False commands are its arguments.
+    ENTRYPOINTS = {OSMIUM_IMAGE: ["osmium"]}
+
+    def __init__(self, cgroup_root: str | None = SUBSET_LOCAL_CGROUP):
+        self.cgroup_root = cgroup_root
+        self._steps = 0
+        self._lock = threading.Lock()
+
+    def start(self, cmd: str | list[str], image: str, env: dict | None, mem_limit: str | None, shell: bool):
+        command = ["bash", "-c", cmd] if shell else [*self.ENTRYPOINTS.get(image, []), *cmd]
+        environment = {name: os.environ[name] for name in _LOCAL_ENV_PASSTHROUGH if name in os.environ}
+        environment.update(env or {})
+
+        # The limit is entered by a sh prelude that execs the step, so a
+        # missing tool fails with exit status 127 like in a container.
+        prelude = ""
+        cgroup = None
+        if mem_limit is not None and self.cgroup_root:
+            with self._lock:
+                self._steps += 1
+                cgroup = f"{self.cgroup_root}/step-{os.getpid()}-{self._steps}"
+            os.mkdir(cgroup)
+            with open(f"{cgroup}/memory.max", "w", encoding="utf-8") as fh:
+                fh.write(str(_parse_mem_limit(mem_limit)))
+            with contextlib.suppress(OSError), open(f"{cgroup}/memory.swap.max", "w", encoding="utf-8") as fh:
+                fh.write("0")
+            prelude = f"echo $$ > {shlex.quote(cgroup)}/cgroup.procs && "
+        elif mem_limit is not None:
+            prelude = f"ulimit -d {_parse_mem_limit(mem_limit) // 1024} && "
+        command = ["sh", "-c", prelude + 'exec "$@"', "sh", *command]
+        try:
+            return _LocalProcess(command, environment, cgroup)
+        except BaseException:
+            if cgroup is not None:
+                os.rmdir(cgroup)
+            raise
+
+
+def _backend_runner(backend: str):
+    if backend == "docker":
+        return DockerRunner()
+    if backend == "local":
+        return LocalRunner()
+    raise ValueError(f"Unknown subset execution backend: {backend!r} (expected 'docker' or 'local')")
+
+
+_container_runner = _backend_runner(SUBSET_EXECUTION_BACKEND)
+
+
+@contextlib.contextmanager
+def container_pool(max_execs: int = CONTAINER_POOL_MAX_EXECS) -> Iterator[ContainerPool | None]:
+    """Run every container of this process as an exec in a ContainerPool.
+
+    Warm containers orphaned by killed tasks on this host are removed first;
+    the pool's own containers are all removed on exit, running execs
+    included. Pools only the Docker backend: under any other runner (the
+    local backend, a benchmark's) this yields None and changes nothing.
+    """
+    if type(_container_runner) is not DockerRunner:
+        yield None
+        return
+    pool = ContainerPool(max_execs)
+    removed = pool.remove_orphans()
+    if removed:
+        print(f"Removed {removed} orphaned pooled container(s)")
+    try:
+        with container_runner(pool):
+            yield pool
+    finally:
+        pool.close()
+
+
+def start_container(
+    cmd: str | list[str],
+    image: str = OPENPLANETDATA_IMAGE,
+    env: dict | None = None,
+    mem_limit: str | None = None,
+    shell: bool = True,
+):
+    """Start a detached container with the /data mount and return it.
+
+    The caller owns the container and must force-remove it. By default cmd
+    runs through bash; set shell=False for images that expose their CLI as
+    the entrypoint. Containers come from the current container runner: the
+    SUBSET_EXECUTION_BACKEND one (DockerRunner or LocalRunner) unless
+    container_pool or container_runner says otherwise.
+    """
+    if shell and not isinstance(cmd, str):
+        raise TypeError("shell commands must be strings")
+    return _container_runner.start(cmd, image, env, mem_limit, shell)
+
+
+@dataclass
+class ContainerTelemetry:
+    """Resource usage of one container, sampled from the Docker stats stream.
+
+    peak_rss is usage minus inactive file cache (what the docker CLI
+    reports); cpu_seconds, the block I/O totals and rx_bytes (network bytes
+    received) are cumulative counters as of the last sample, about one second
+    before exit. rx_bytes stays 0 under the local backend, whose processes
+    share the host's network.
+    """
+
+    image: str
+    code: str | None = None
+    step: str | None = None
+    wall_seconds: float = 0.0
+    peak_rss: int = 0
+    cpu_seconds: float = 0.0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    rx_bytes: int = 0
+    samples: int = 0
+    exit_status: int | None = None
+
+    def update(self, stats: dict) -> None:
+        """Fold one Docker stats sample into the record."""
+        memory = stats.get("memory_stats") or {}
+        detail = memory.get("stats") or {}
+        cache = detail.get("inactive_file", detail.get("total_inactive_file", 0))
+        self.peak_rss = max(self.peak_rss, memory.get("usage", 0) - cache)
+        cpu, io = _stats_counters(stats)
+        self.cpu_seconds = max(self.cpu_seconds, cpu / 1e9)
+        self.read_bytes = max(self.read_bytes, io["read"])
+        self.write_bytes = max(self.write_bytes, io["write"])
+        self.rx_bytes = max(self.rx_bytes, _stats_rx_bytes(stats))
+        self.samples += 1
+
+
+class _ContainerSampler:
+    """Sample a container's stats into a ContainerTelemetry in a thread.
+
+    Only the container's stats() stream is used, so any object exposing it
+    (a local stand-in for the Docker API included) can be sampled. The
+    stream ends when the container exits.
+    """
+
+    def __init__(self, container, telemetry: ContainerTelemetry):
+        self.container = container
+        self.telemetry = telemetry
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self) -> None:
+        try:
+            for stats in self.container.stats(decode=True, stream=True):
+                self.telemetry.update(stats)
+        except Exception:
+            # Telemetry only; the container itself is the caller's concern.
+            pass
+
+    def finish(self, exit_status: int | None) -> ContainerTelemetry:
+        """Stop timing; wait briefly for the stream to end; return the record."""
+        self.telemetry.wall_seconds = round(time.monotonic() - self._started, 3)
+        self.telemetry.exit_status = exit_status
+        self._thread.join(timeout=5)
+        _record_container_telemetry(self.telemetry)
+        return self.telemetry
+
+
+# Where the current context appends container telemetry (see
+# container_telemetry_log); builds that track their peak memory
+# (track_container_memory) also get it per thread. Worker threads run in
+# copies of their caller's context to log to the same file.
+_telemetry_log: contextvars.ContextVar[str | None] = contextvars.ContextVar("telemetry_log", default=None)
+_telemetry_lock = threading.Lock()
+_memory_tracking = threading.local()
+
+
+@contextlib.contextmanager
+def container_telemetry_log(path: str) -> Iterator[None]:
+    """Append the telemetry of every container run in this context to path.
+
+    One JSON line per container, keyed by code, step and image. Nested logs
+    restore the outer one on exit.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    token = _telemetry_log.set(path)
+    try:
+        yield
+    finally:
+        _telemetry_log.reset(token)
+
+
+def task_telemetry_log() -> contextlib.AbstractContextManager[None]:
+    """Log the current Airflow task's container telemetry to its run's JSONL file."""
+    from airflow.sdk import get_current_context
+
+    context = get_current_context()
+    return container_telemetry_log(f"{SUBSET_TELEMETRY_DIR}/{context['dag'].dag_id}/{context['run_id']}.jsonl")
+
+
+def _record_container_telemetry(telemetry: ContainerTelemetry) -> None:
+    tracker = getattr(_memory_tracking, "current", None)
+    if tracker is not None:
+        tracker.peak = max(tracker.peak, telemetry.peak_rss)
+    path = _telemetry_log.get()
+    if path is None:
+        return
+    line = json.dumps({"recorded": time.time(), **dataclasses.asdict(telemetry)}) + "\n"
+    with _telemetry_lock, open(path, "a", encoding="utf-8") as fh:
+        fh.write(line)
+
+
+class _PeakMemory:
+    def __init__(self):
+        self.peak = 0
+
+
+@contextlib.contextmanager
+def track_container_memory() -> Iterator[_PeakMemory]:
+    """Track the peak memory of every container run by this thread."""
+    tracker = _PeakMemory()
+    _memory_tracking.current = tracker
+    try:
+        yield tracker
+    finally:
+        _memory_tracking.current = None
+
+
+class ContainerRun(NamedTuple):
+    output: bytes
+    telemetry: ContainerTelemetry
+
+
+def _print_output(container) -> None:
+    """Print container's output line by line as it streams, until it exits."""
+    import codecs
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    try:
+        for chunk in container.logs(stdout=True, stderr=True, stream=True, follow=True):
+            # Progress meters (aria2c's) rewrite their line with \r.
+            *lines, pending = re.split(r"\r\n|\r|\n", pending + decoder.decode(chunk))
+            for line in lines:
+                print(line, flush=True)
+    except Exception as e:
+        print(f"Output stream ended: {e}")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        print(pending, flush=True)
+
+
+def run_container(
     cmd: str | list[str],
     image: str = OPENPLANETDATA_IMAGE,
     env: dict | None = None,
     stdout_only: bool = False,
     mem_limit: str | None = None,
     shell: bool = True,
-) -> bytes:
+    code: str | None = None,
+    step: str | None = None,
+    stream_output: bool = False,
+) -> ContainerRun:
     """Run a command in a Docker container with the /data mount.
 
-    Thread-safe (Docker SDK). The image is pulled once per process (mirroring
-    DockerOperator's force_pull). The container is started detached and force-
-    removed in a finally block, so an exception raised in the calling thread
-    (task kill, timeout) kills the container instead of orphaning it. Raises
-    docker.errors.ContainerError on non-zero exit. By default cmd runs through
-    bash; set shell=False for images that expose their CLI as the entrypoint.
-    Returns the stdout logs (plus stderr unless stdout_only).
+    Or natively, as the same command would run in its image, under the local
+    execution backend (see LocalRunner): output and exceptions are the same.
+    Thread-safe (Docker SDK). The container is started detached (see
+    start_container) and force-removed in a finally block, so an exception
+    raised in the calling thread (task kill, timeout) kills the container
+    instead of orphaning it. Its stats are sampled while it runs; the
+    telemetry, labelled with code and step, is recorded (container_telemetry_log)
+    whatever the outcome. With stream_output, stdout and stderr are also
+    printed line by line while the command runs, so a step killed by a
+    timeout still leaves its log. Raises docker.errors.ContainerError on
+    non-zero exit. Returns the stdout logs (plus stderr unless stdout_only)
+    and the telemetry.
     """
-    import docker
     from docker.errors import ContainerError
-    from docker.types import Mount
 
-    from openplanetdata.airflow.operators.gol import DOCKER_USER
-
-    client = docker.from_env()
-    if image not in _PULLED_IMAGES:
-        client.images.pull(image)
-        _PULLED_IMAGES.add(image)
-
-    if shell:
-        if not isinstance(cmd, str):
-            raise TypeError("shell commands must be strings")
-        container_command: str | list[str] = f"bash -c {shlex.quote(cmd)}"
-    else:
-        container_command = cmd
-
-    container = client.containers.run(
-        image=image,
-        command=container_command,
-        detach=True,
-        environment=env or {},
-        mem_limit=mem_limit,
-        mounts=[Mount(**DOCKER_MOUNT)],
-        user=DOCKER_USER,
-    )
+    container = start_container(cmd, image=image, env=env, mem_limit=mem_limit, shell=shell)
+    sampler = _ContainerSampler(container, ContainerTelemetry(image=image, code=code, step=step))
+    printer = None
+    if stream_output:
+        printer = threading.Thread(target=_print_output, args=(container,), daemon=True)
+        printer.start()
+    status = None
     try:
         status = container.wait()["StatusCode"]
+        if printer is not None:
+            # The stream ends with the container; this only lets it flush.
+            printer.join(timeout=30)
+        telemetry = sampler.finish(status)
         if status != 0:
             output = container.logs(stdout=True, stderr=True)
             raise ContainerError(container, status, cmd, image, output)
-        return container.logs(stdout=True, stderr=not stdout_only)
+        return ContainerRun(container.logs(stdout=True, stderr=not stdout_only), telemetry)
     finally:
+        if status is None:
+            sampler.finish(None)
         container.remove(force=True)
 
 
-def _geometry_bbox(geometry: dict) -> tuple[float, float, float, float]:
-    """Compute (minx, miny, maxx, maxy) of a GeoJSON geometry."""
-    minx = miny = float("inf")
-    maxx = maxy = float("-inf")
+def run_in_container(
+    cmd: str | list[str],
+    image: str = OPENPLANETDATA_IMAGE,
+    env: dict | None = None,
+    stdout_only: bool = False,
+    mem_limit: str | None = None,
+    shell: bool = True,
+    code: str | None = None,
+    step: str | None = None,
+    stream_output: bool = False,
+) -> bytes:
+    """run_container, returning only the logs."""
+    return run_container(
+        cmd, image=image, env=env, stdout_only=stdout_only, mem_limit=mem_limit, shell=shell,
+        code=code, step=step, stream_output=stream_output,
+    ).output
 
-    def visit(coords: Any) -> None:
-        nonlocal minx, miny, maxx, maxy
-        if isinstance(coords[0], (int, float)):
-            x, y = coords[0], coords[1]
-            minx, miny = min(minx, x), min(miny, y)
-            maxx, maxy = max(maxx, x), max(maxy, y)
-        else:
-            for part in coords:
-                visit(part)
 
-    visit(geometry["coordinates"])
-    return minx, miny, maxx, maxy
+class _JSONStreamReader:
+    """Pull-parser over a JSON text file that decodes one value at a time.
 
+    Values are decoded with the stdlib decoder (same float/str semantics as
+    json.load); the read buffer only ever holds the value being decoded plus
+    at most one chunk of look-ahead.
+    """
 
-def _clamp_geometry_to_world(geometry: dict) -> dict:
-    """Clamp GeoJSON positions to osmium's valid longitude/latitude range.
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+    def __init__(self, fh, chunk_chars: int) -> None:
+        self._fh = fh
+        self._chunk_chars = chunk_chars
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, min_chars: int = 0) -> bool:
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        chunk = self._fh.read(max(self._chunk_chars, min_chars))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf += chunk
+        return True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            self._pos = self._WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill():
+                return self._buf[self._pos:self._pos + 1]
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r}, found {found or 'end of file'!r}")
+        self._pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A scalar ending exactly at the buffer edge may be truncated.
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Double the pending text so a huge feature costs amortized O(n).
+            self._fill(len(self._buf) - self._pos)
+
+
+def _iter_geojson_features(path: str, chunk_chars: int = BOUNDARY_SPLIT_CHUNK_CHARS) -> Iterator[dict]:
+    """Yield the features of a GeoJSON FeatureCollection one at a time."""
+    with open(path, "r", encoding="utf-8") as fh:
+        reader = _JSONStreamReader(fh, chunk_chars)
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "features":
+                reader.expect("[")
+                if reader.peek() == "]":
+                    reader.expect("]")
+                else:
+                    while True:
+                        yield reader.value()
+                        if reader.peek() == "]":
+                            reader.expect("]")
+                            break
+                        reader.expect(",")
+            else:
+                reader.value()
+            if reader.peek() == "}":
+                return
+            reader.expect(",")
 
-    Buffered boundaries that touch the antimeridian or a pole can extend up to
-    BOUNDARY_BUFFER_DEG beyond the world envelope. No valid OSM location can
-    occupy that overflow, so clamping it does not change extract membership.
-    """
-    def clamp(coords: list) -> list:
-        if isinstance(coords[0], (int, float)):
-            return [
-                max(-180.0, min(180.0, coords[0])),
-                max(-90.0, min(90.0, coords[1])),
-                *coords[2:],
-            ]
-        return [clamp(part) for part in coords]
 
-    return {**geometry, "coordinates": clamp(geometry["coordinates"])}
+# Prefix json.dump emits for {"type": ..., "name": "boundary", "features": [...]};
+# the streaming splitter writes the same bytes piecewise.
+_RAW_BOUNDARY_HEADER = '{"type": "FeatureCollection", "name": "boundary", "features": ['
+_RAW_BOUNDARY_FOOTER = "]}"
 
 
 def split_boundary_aggregate(aggregate_path: str, code_property: str, boundaries_dir: str) -> list[str]:
     """Split a planet boundary aggregate into per-code raw GeoJSON files.
 
     Writes {boundaries_dir}/{code}.raw.geojson with layer name "boundary" (used
-    by the simplify SQL). Returns the sorted list of codes found.
+    by the simplify SQL) and {code}.raw.sha256, the digest of its geometries
+    (the boundary cache key). Returns the sorted list of codes found.
+
+    The aggregate is streamed one feature at a time and each feature is
+    appended to its code's file as soon as it is parsed, so peak memory is
+    bounded by the largest single feature instead of the multi-GB aggregate.
+    The files are byte-identical to a json.dump of the whole collection and
+    only appear under their final name once complete.
     """
     os.makedirs(boundaries_dir, exist_ok=True)
-    with open(aggregate_path, "r", encoding="utf-8") as fh:
-        data = json.load(fh)
 
-    features_by_code: dict[str, list] = {}
-    for feature in data.get("features", []):
+    digests: dict[str, Any] = {}
+    for feature in _iter_geojson_features(aggregate_path):
         code = (feature.get("properties") or {}).get(code_property)
-        if code and feature.get("geometry"):
-            features_by_code.setdefault(code, []).append(feature)
+        if not code or not feature.get("geometry"):
+            continue
+        tmp_path = f"{boundaries_dir}/{code}.raw.geojson.tmp"
+        if code in digests:
+            with open(tmp_path, "a", encoding="utf-8") as fh:
+                fh.write(", ")
+                json.dump(feature, fh)
+        else:
+            # First occurrence in this run truncates leftovers of a killed one.
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                fh.write(_RAW_BOUNDARY_HEADER)
+                json.dump(feature, fh)
+            digests[code] = hashlib.sha256()
+        _update_geometry_digest(digests[code], feature)
+
+    for code, digest in digests.items():
+        tmp_path = f"{boundaries_dir}/{code}.raw.geojson.tmp"
+        with open(tmp_path, "a", encoding="utf-8") as fh:
+            fh.write(_RAW_BOUNDARY_FOOTER)
+        os.rename(tmp_path, f"{boundaries_dir}/{code}.raw.geojson")
+        with open(f"{boundaries_dir}/{code}.raw.sha256", "w", encoding="utf-8") as fh:
+            fh.write(digest.hexdigest())
+
+    return sorted(digests)
+
+
+def _update_geometry_digest(digest, feature: dict) -> None:
+    # Geometry only: renaming a boundary or editing its tags must not
+    # invalidate its prepared outline.
+    digest.update(json.dumps(feature["geometry"], sort_keys=True).encode())
+    digest.update(b"\n")
+
+
+def _raw_geometry_digest(code: str, boundaries_dir: str) -> str:
+    """Return the geometry digest of a raw boundary.
+
+    Uses the sidecar written by split_boundary_aggregate; raw files from other
+    sources (the benchmark's per-entity downloads) are hashed on the fly.
+    """
+    try:
+        with open(f"{boundaries_dir}/{code}.raw.sha256", "r", encoding="utf-8") as fh:
+            return fh.read().strip()
+    except FileNotFoundError:
+        digest = hashlib.sha256()
+        for feature in _iter_geojson_features(f"{boundaries_dir}/{code}.raw.geojson"):
+            if feature.get("geometry"):
+                _update_geometry_digest(digest, feature)
+        return digest.hexdigest()
+
+
+def _boundary_cache_key(code: str, boundaries_dir: str, engine: str) -> str:
+    params = (
+        f"v{BOUNDARY_CACHE_VERSION}|{engine}|{_raw_geometry_digest(code, boundaries_dir)}|"
+        f"{BOUNDARY_PRESIMPLIFY_DEG}|{BOUNDARY_BUFFER_DEG}|{BOUNDARY_SIMPLIFY_DEG}|"
+        f"{BOUNDARY_BUFFER_QUAD_SEGS}|{BOUNDARY_PIECE_MAX_VERTICES}|{BOUNDARY_PIECE_OVERLAP_DEG}|"
+        f"{BOUNDARY_PIECE_CELL_DEG}|{BOUNDARY_GRID_LEVELS}|{BOUNDARY_GRID_MARGIN_DEG}"
+    )
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    """Atomically place source at destination, hardlinked when possible.
+
+    Prepared files are only ever replaced by rename, never rewritten in
+    place, so sharing inodes between the cache and a WORK_DIR is safe.
+    """
+    tmp_path = f"{destination}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.rename(tmp_path, destination)
+
+
+def _boundary_cache_fetch(key: str, code: str, boundaries_dir: str, cache_dir: str) -> bool:
+    """Materialize a cached prepared boundary; return False on a miss."""
+    entry_dir = f"{cache_dir}/{key[:2]}/{key}"
+    try:
+        # meta.json last: its presence is what marks the boundary prepared.
+        for name in BOUNDARY_CACHE_FILES:
+            _link_or_copy(f"{entry_dir}/{name}", f"{boundaries_dir}/{code}.{name}")
+        os.utime(entry_dir)
+    except FileNotFoundError:
+        # Not cached, or evicted by a concurrent run halfway through.
+        return False
+    return True
+
+
+def _boundary_cache_store(key: str, code: str, boundaries_dir: str, cache_dir: str) -> None:
+    entry_dir = f"{cache_dir}/{key[:2]}/{key}"
+    if os.path.exists(entry_dir):
+        return
+    tmp_dir = f"{cache_dir}/.tmp-{key}-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        for name in BOUNDARY_CACHE_FILES:
+            _link_or_copy(f"{boundaries_dir}/{code}.{name}", f"{tmp_dir}/{name}")
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another run stored the same key first (rename onto a non-empty
+        # directory fails); its entry is equivalent.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    for code, features in features_by_code.items():
-        with open(f"{boundaries_dir}/{code}.raw.geojson", "w", encoding="utf-8") as fh:
-            json.dump({"type": "FeatureCollection", "name": "boundary", "features": features}, fh)
 
-    return sorted(features_by_code.keys())
+def boundary_cache_hit(code: str, boundaries_dir: str, cache_dir: str, engine: str = BOUNDARY_PREP_ENGINE) -> bool:
+    """Whether prepare_boundaries would link code's prepared files from cache_dir."""
+    key = _boundary_cache_key(code, boundaries_dir, engine)
+    return os.path.isdir(f"{cache_dir}/{key[:2]}/{key}")
+
+
+def _evict_boundary_cache(cache_dir: str, max_bytes: int) -> int:
+    """Delete least recently used entries beyond max_bytes; return the count."""
+    entries = []
+    total = 0
+    for shard in os.listdir(cache_dir):
+        shard_dir = f"{cache_dir}/{shard}"
+        if shard.startswith(".") or not os.path.isdir(shard_dir):
+            continue
+        for key in os.listdir(shard_dir):
+            entry_dir = f"{shard_dir}/{key}"
+            try:
+                size = sum(os.path.getsize(f"{entry_dir}/{name}") for name in BOUNDARY_CACHE_FILES)
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except FileNotFoundError:
+                continue
+            total += size
+
+    evicted = 0
+    for _mtime, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        evicted += 1
+    return evicted
+
+
+def _parse_mem_limit(limit: str) -> int:
+    """Convert a Docker-style memory limit ("64g", "512m") to bytes."""
+    units = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+    limit = limit.strip().lower()
+    if limit[-1] in units:
+        return int(float(limit[:-1]) * units[limit[-1]])
+    return int(limit)
+
+
+def _limit_process_memory(limit_bytes: int) -> None:
+    """Process-pool initializer capping the worker's address space.
+
+    The in-process counterpart of a container mem_limit: a runaway GEOS buffer
+    raises MemoryError inside its own worker instead of waking the host OOM
+    killer.
+    """
+    import resource
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+
+
+def _prepare_geometry_ogr2ogr(raw_path: str, prepared_path: str) -> PackedGeometry | None:
+    """Run the boundary SQL in a GDAL container; return the prepared geometry."""
+    # Pre-simplify each input geometry BEFORE union/buffer: buffering the
+    # full-resolution coastline is what exhausts memory, not the union.
+    # Plain ST_Simplify (Douglas-Peucker), not ST_SimplifyPreserveTopology:
+    # the topology-preserving variant needs >1h of CPU on the ~25M-vertex
+    # europe boundary while DP takes seconds. DP may self-intersect, so
+    # ST_Buffer(.., 0) repairs each geometry before the union.
+    sql = (
+        f"SELECT ST_SimplifyPreserveTopology(ST_Buffer(ST_Union("
+        f"ST_Buffer(ST_Simplify(geometry, {BOUNDARY_PRESIMPLIFY_DEG}), 0)), "
+        f"{BOUNDARY_BUFFER_DEG}), {BOUNDARY_SIMPLIFY_DEG}) AS geometry FROM boundary"
+    )
+    args = shlex.join([
+        "ogr2ogr", "-f", "GeoJSON", prepared_path, raw_path,
+        "-dialect", "sqlite", "-sql", sql,
+    ])
+    code = os.path.basename(raw_path).removesuffix(".raw.geojson")
+    run_in_container(args, image=GDAL_FULL_IMAGE, env={"OGR_GEOJSON_MAX_OBJ_SIZE": "0"},
+                     mem_limit=BOUNDARY_PREP_MEM_LIMIT, code=code, step="ogr2ogr prepare")
+
+    with open(prepared_path, "r", encoding="utf-8") as fh:
+        prepared = json.load(fh)
+    features = prepared.get("features") or []
+    geometry = features[0].get("geometry") if features else None
+    return PackedGeometry.from_geojson(geometry) if geometry is not None else None
+
+
+def _prepare_geometry_shapely(raw_path: str) -> PackedGeometry | None:
+    """Same pipeline as the ogr2ogr SQL, vectorized with Shapely 2 in-process.
+
+    GEOS parses the whole FeatureCollection natively (no Python JSON tree) and
+    the per-feature pre-simplify and repair run as single array operations.
+    """
+    import shapely
+
+    with open(raw_path, "r", encoding="utf-8") as fh:
+        collection = shapely.from_geojson(fh.read())
+    parts = shapely.get_parts(collection)
+    parts = parts[~shapely.is_empty(parts)]
+
+    parts = shapely.simplify(parts, BOUNDARY_PRESIMPLIFY_DEG, preserve_topology=False)
+    parts = shapely.buffer(parts, 0)
+    merged = shapely.union_all(parts)
+    merged = shapely.buffer(merged, BOUNDARY_BUFFER_DEG, quad_segs=BOUNDARY_BUFFER_QUAD_SEGS)
+    merged = shapely.simplify(merged, BOUNDARY_SIMPLIFY_DEG, preserve_topology=True)
+    if merged.is_empty:
+        return None
+    return PackedGeometry.from_shapely(merged)
 
 
-def prepare_boundary(code: str, boundaries_dir: str) -> str | None:
+def _subdivide_geometry(geometry_json: str) -> list[tuple[tuple[float, float, float, float], str]]:
+    """Cut a (Multi)Polygon into pieces of at most BOUNDARY_PIECE_MAX_VERTICES.
+
+    Pieces larger than the limit are halved across the longer side of their
+    bbox (a k-d split, like PostGIS ST_Subdivide) with an exact overlay, so
+    every piece is valid; each half reaches BOUNDARY_PIECE_OVERLAP_DEG past
+    the cut. Returns (bbox, GeoJSON geometry) per piece.
+    """
+    import shapely
+
+    eps = BOUNDARY_PIECE_OVERLAP_DEG
+    pieces = []
+    stack = [(part, 0) for part in shapely.get_parts(shapely.from_geojson(geometry_json))]
+    while stack:
+        part, depth = stack.pop()
+        minx, miny, maxx, maxy = part.bounds
+        width, height = maxx - minx, maxy - miny
+        if (
+            shapely.get_num_coordinates(part) <= BOUNDARY_PIECE_MAX_VERTICES
+            or depth >= BOUNDARY_PIECE_MAX_DEPTH
+            or max(width, height) <= 4 * eps
+        ):
+            pieces.append((part.bounds, shapely.to_geojson(part)))
+            continue
+        if width >= height:
+            mid = (minx + maxx) / 2
+            halves = [(minx, miny, mid + eps, maxy), (mid - eps, miny, maxx, maxy)]
+        else:
+            mid = (miny + maxy) / 2
+            halves = [(minx, miny, maxx, mid + eps), (minx, mid - eps, maxx, maxy)]
+        for box in halves:
+            clipped = shapely.intersection(part, shapely.box(*box))
+            # Overlays can add slivers of lower dimension along the box edge.
+            stack.extend(
+                (piece, depth + 1) for piece in shapely.get_parts(clipped)
+                if piece.geom_type == "Polygon" and not piece.is_empty
+            )
+    return pieces
+
+
+def _boundary_grid(geometry_json: str) -> list[tuple[int, int, int, str]]:
+    """Classify the quadtree cells over a boundary as inside/outside/edge.
+
+    Level 0 cells are the BOUNDARY_PIECE_CELL_DEG cells overlapping the
+    boundary bbox; edge cells are split into four children down to
+    BOUNDARY_GRID_LEVELS. Cell (level, x, y) spans longitudes
+    [x * size - 180, (x + 1) * size - 180) with size = cell deg / 2**level,
+    latitudes likewise from -90. A cell is inside when the boundary contains
+    it (grown by BOUNDARY_GRID_MARGIN_DEG) properly, outside when the grown
+    cell misses the boundary. Returns the leaves as (level, x, y, state).
+    """
+    import numpy as np
+    import shapely
+
+    boundary = shapely.from_geojson(geometry_json)
+    shapely.prepare(boundary)
+    margin = BOUNDARY_GRID_MARGIN_DEG
+    minx, miny, maxx, maxy = boundary.bounds
+    root = BOUNDARY_PIECE_CELL_DEG
+    xs = np.arange(int((minx + 180) // root), int((maxx + 180) // root) + 1)
+    ys = np.arange(int((miny + 90) // root), int((maxy + 90) // root) + 1)
+    cells = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+    leaves = []
+    for level in range(BOUNDARY_GRID_LEVELS + 1):
+        size = root / 2**level
+        west = cells[:, 0] * size - 180
+        south = cells[:, 1] * size - 90
+        boxes = shapely.box(west - margin, south - margin, west + size + margin, south + size + margin)
+        inside = shapely.contains_properly(boundary, boxes)
+        outside = shapely.disjoint(boundary, boxes)
+        edge = ~inside & ~outside
+        states = [(inside, "inside"), (outside, "outside")]
+        if level == BOUNDARY_GRID_LEVELS:
+            states.append((edge, "edge"))
+        for mask, state in states:
+            leaves.extend((level, int(x), int(y), state) for x, y in cells[mask])
+        children = cells[edge] * 2
+        cells = np.concatenate([children + offset for offset in ((0, 0), (1, 0), (0, 1), (1, 1))])
+    return leaves
+
+
+def prepare_boundary(code: str, boundaries_dir: str, engine: str = BOUNDARY_PREP_ENGINE) -> str | None:
     """Buffer + simplify one raw boundary and write its metadata sidecar.
 
-    Produces {code}.prepared.geojson (single unioned feature) and {code}.meta.json
-    (bbox + geometry). Thread-safe. Returns the code on failure, None on success.
+    Produces {code}.prepared.geojson (bare geometry, for gol),
+    {code}.osmium.geojson (Feature wrapper, for osmium),
+    {code}.pieces.geojson (subdivided form, for DuckDB; one Feature with a
+    bbox per piece), {code}.grid.csv (quadtree cell classes, for DuckDB; see
+    _boundary_grid) and {code}.meta.json (bbox + geometry). The geometry is
+    clamped, measured and serialized once as packed arrays, then the same
+    JSON text is embedded in the whole-boundary files. engine selects the
+    in-process Shapely pipeline or the ogr2ogr container; both write the same
+    files. Thread- and process-safe. Returns the code on failure, None on
+    success.
     """
     raw_path = f"{boundaries_dir}/{code}.raw.geojson"
     prepared_path = f"{boundaries_dir}/{code}.prepared.geojson"
+    osmium_path = f"{boundaries_dir}/{code}.osmium.geojson"
+    pieces_path = f"{boundaries_dir}/{code}.pieces.geojson"
+    grid_path = f"{boundaries_dir}/{code}.grid.csv"
     meta_path = f"{boundaries_dir}/{code}.meta.json"
 
-    if os.path.exists(meta_path):
+    if all(os.path.exists(path) for path in (meta_path, osmium_path, pieces_path, grid_path)):
         return None
 
     try:
-        # Pre-simplify each input geometry BEFORE union/buffer: buffering the
-        # full-resolution coastline is what exhausts memory, not the union.
-        # Plain ST_Simplify (Douglas-Peucker), not ST_SimplifyPreserveTopology:
-        # the topology-preserving variant needs >1h of CPU on the ~25M-vertex
-        # europe boundary while DP takes seconds. DP may self-intersect, so
-        # ST_Buffer(.., 0) repairs each geometry before the union.
-        sql = (
-            f"SELECT ST_SimplifyPreserveTopology(ST_Buffer(ST_Union("
-            f"ST_Buffer(ST_Simplify(geometry, {BOUNDARY_PRESIMPLIFY_DEG}), 0)), "
-            f"{BOUNDARY_BUFFER_DEG}), {BOUNDARY_SIMPLIFY_DEG}) AS geometry FROM boundary"
-        )
-        args = shlex.join([
-            "ogr2ogr", "-f", "GeoJSON", prepared_path, raw_path,
-            "-dialect", "sqlite", "-sql", sql,
-        ])
-        run_in_container(args, image=GDAL_FULL_IMAGE, env={"OGR_GEOJSON_MAX_OBJ_SIZE": "0"},
-                         mem_limit=BOUNDARY_PREP_MEM_LIMIT)
-
-        with open(prepared_path, "r", encoding="utf-8") as fh:
-            prepared = json.load(fh)
-        features = prepared.get("features") or []
-        geometry = features[0].get("geometry") if features else None
+        if engine == "shapely":
+            geometry = _prepare_geometry_shapely(raw_path)
+        elif engine == "ogr2ogr":
+            geometry = _prepare_geometry_ogr2ogr(raw_path, prepared_path)
+        else:
+            raise ValueError(f"Unknown boundary preparation engine: {engine}")
         if geometry is None:
             print(f"[{code}] Boundary simplification produced no geometry, skipping")
             return code
-        geometry = _clamp_geometry_to_world(geometry)
+        # Buffered boundaries that touch the antimeridian or a pole can extend
+        # up to BOUNDARY_BUFFER_DEG beyond the world envelope, which osmium
+        # rejects. No valid OSM location can occupy that overflow, so clamping
+        # it does not change extract membership.
+        geometry = geometry.clamp_to_world()
+        geometry_json = geometry.to_json()
 
         # gol's --area parser only accepts a bare GeoJSON geometry object; a
         # Feature/FeatureCollection wrapper fails with "area: Expected string".
-        tmp_path = f"{prepared_path}.tmp"
-        with open(tmp_path, "w", encoding="utf-8") as fh:
-            json.dump(geometry, fh)
-        os.rename(tmp_path, prepared_path)
-
-        minx, miny, maxx, maxy = _geometry_bbox(geometry)
-        with open(meta_path, "w", encoding="utf-8") as fh:
-            json.dump({"bbox": [minx, miny, maxx, maxy], "geometry": geometry}, fh)
+        # osmium, on the other hand, requires a Feature or FeatureCollection.
+        pieces = ", ".join(
+            f'{{"type": "Feature", "bbox": {json.dumps(list(bounds))}, "properties": {{}}, "geometry": {piece}}}'
+            for bounds, piece in _subdivide_geometry(geometry_json)
+        )
+        bbox = json.dumps(list(geometry.bbox()))
+        # meta last: it marks the boundary as prepared.
+        for path, text in (
+            (prepared_path, geometry_json),
+            (osmium_path, f'{{"type": "Feature", "properties": {{}}, "geometry": {geometry_json}}}'),
+            (pieces_path, f'{{"type": "FeatureCollection", "features": [{pieces}]}}'),
+            (grid_path, "level,x,y,state\n" + "".join(
+                f"{level},{x},{y},{state}\n" for level, x, y, state in _boundary_grid(geometry_json)
+            )),
+            (meta_path, f'{{"bbox": {bbox}, "geometry": {geometry_json}}}'),
+        ):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fh:
+                fh.write(text)
+            os.rename(tmp_path, path)
         return None
     except Exception as e:
         print(f"[{code}] Boundary preparation failed: {e}")
         return code
 
 
+def prepare_boundaries(
+    codes: list[str],
+    boundaries_dir: str,
+    engine: str = BOUNDARY_PREP_ENGINE,
+    workers: int = BOUNDARY_PREP_WORKERS,
+    cache_dir: str | None = None,
+) -> set[str]:
+    """Prepare many boundaries in parallel; return the set of failed codes.
+
+    With cache_dir, boundaries whose raw geometry and preparation parameters
+    were seen before are linked from the persistent cache instantly; only the
+    misses are prepared, then stored. Hit/miss/eviction counts are logged and
+    the cache is trimmed to BOUNDARY_CACHE_MAX_BYTES.
+    """
+    if cache_dir is None:
+        return _run_boundary_engine(codes, boundaries_dir, engine, workers)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    keys = {code: _boundary_cache_key(code, boundaries_dir, engine) for code in codes}
+    misses = [
+        code for code in codes
+        if not _boundary_cache_fetch(keys[code], code, boundaries_dir, cache_dir)
+    ]
+    failures = _run_boundary_engine(misses, boundaries_dir, engine, workers)
+    for code in misses:
+        if code not in failures:
+            _boundary_cache_store(keys[code], code, boundaries_dir, cache_dir)
+    evicted = _evict_boundary_cache(cache_dir, BOUNDARY_CACHE_MAX_BYTES)
+    print(
+        f"Boundary cache: {len(codes) - len(misses)} hit(s), {len(misses)} miss(es), "
+        f"{evicted} evicted"
+    )
+    return failures
+
+
+def _run_boundary_engine(codes: list[str], boundaries_dir: str, engine: str, workers: int) -> set[str]:
+    """Prepare codes with one engine; return the set of failed codes.
+
+    The Shapely engine runs in process pools (GEOS holds the GIL for most
+    operations). The largest raw boundary (europe) gets a worker of its own
+    with the whole BOUNDARY_PREP_MEM_LIMIT, the budget a single GDAL container
+    gets; the other workers handle the remaining codes, largest first, each
+    capped at a workers-th of it. The ogr2ogr engine keeps one container per
+    code.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+    if engine == "ogr2ogr":
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return {
+                code for code in executor.map(
+                    lambda code: context.copy().run(prepare_boundary, code, boundaries_dir, engine=engine),
+                    codes,
+                )
+                if code is not None
+            }
+
+    import multiprocessing
+
+    pending = sorted(
+        codes,
+        key=lambda code: os.path.getsize(f"{boundaries_dir}/{code}.raw.geojson"),
+        reverse=True,
+    )
+    failures: set[str] = set()
+    if not pending:
+        return failures
+    limit = _parse_mem_limit(BOUNDARY_PREP_MEM_LIMIT)
+    # spawn, not fork: the task process runs heartbeat and log threads, and a
+    # forked child can deadlock on a lock one of them held.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=context, initializer=_limit_process_memory, initargs=(limit,),
+    ) as largest, ProcessPoolExecutor(
+        max_workers=max(workers - 1, 1), mp_context=context,
+        initializer=_limit_process_memory, initargs=(limit // workers,),
+    ) as executor:
+        futures = {largest.submit(prepare_boundary, pending[0], boundaries_dir, engine): pending[0]}
+        futures.update({
+            executor.submit(prepare_boundary, code, boundaries_dir, engine): code
+            for code in pending[1:]
+        })
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                if future.result() is not None:
+                    failures.add(code)
+            except Exception as e:
+                # A worker killed outright breaks the pool: every code still
+                # queued fails with it and is reported like any other failure.
+                print(f"[{code}] Boundary preparation failed: {e}")
+                failures.add(code)
+    return failures
+
+
+# Every osmium cut of a subset PBF (from a parent, from the planet, in a
+# multi-extract pass or when refreshing a stored PBF) uses these options.
+# complete_ways composes: cutting a subset from a parent extract whose
+# boundary covers it yields the same objects as cutting it from the planet,
+# so a subset's content never depends on where it was cut from.
+OSMIUM_EXTRACT_OPTIONS = ("--strategy", "complete_ways", "--set-bounds", "--overwrite")
+
+
+def extract_subset_pbf(code: str, source_pbf: str, pbf_path: str, boundaries_dir: str, step: str) -> None:
+    """Cut the PBF of code from source_pbf with osmium complete_ways."""
+    # Written by prepare_boundary next to the bare geometry gol reads, so
+    # both extractors use exactly the same prepared geometry.
+    run_in_container(
+        [
+            "extract",
+            *OSMIUM_EXTRACT_OPTIONS,
+            "--polygon", f"{boundaries_dir}/{code}.osmium.geojson",
+            "--output", pbf_path,
+            source_pbf,
+        ],
+        image=OSMIUM_IMAGE,
+        mem_limit=OSMIUM_MEM_LIMIT,
+        shell=False,
+        code=code,
+        step=step,
+    )
+
+
+def extract_subsets_multi(level_dirs: dict[str, str], boundaries_dir: str, snapshot_pbf: str) -> set[str]:
+    """Extract many subset PBFs from snapshot_pbf in as few osmium passes as possible.
+
+    osmium reads and decodes the planet once per pass and writes every
+    extract listed in a multi-extract config (up to
+    OSMIUM_MULTI_EXTRACT_MAX_CODES), instead of once per subset.
+    level_dirs maps each code to the level directory of its subset, so one
+    pass can serve several levels. Each complete {code}-latest.osm.pbf gets
+    an .extracted marker naming the snapshot it was cut from, and
+    build_subset_files then only runs gol build/save on it. Codes already built or uploaded are left out. If a
+    pass fails, none of its codes is marked, and each falls back to its own
+    extraction in build_subset_files. Returns the set of codes that were not
+    extracted.
+    """
+    codes = [
+        code for code, level_dir in level_dirs.items()
+        if not os.path.exists(f"{level_dir}/{code}.done")
+        and not os.path.exists(f"{level_dir}/{code}/.built")
+    ]
+    failed: set[str] = set()
+    for i in range(0, len(codes), OSMIUM_MULTI_EXTRACT_MAX_CODES):
+        chunk = codes[i:i + OSMIUM_MULTI_EXTRACT_MAX_CODES]
+        if not _extract_multi_pass(chunk, level_dirs, boundaries_dir, snapshot_pbf):
+            failed.update(chunk)
+    return failed
+
+
+def _extract_multi_pass(codes: list[str], level_dirs: dict[str, str], boundaries_dir: str, snapshot_pbf: str) -> bool:
+    extracts = []
+    for code in codes:
+        subset_dir = f"{level_dirs[code]}/{code}"
+        os.makedirs(subset_dir, exist_ok=True)
+        marker_path = f"{subset_dir}/.extracted"
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        extracts.append({
+            "output": f"{subset_dir}/{code}-latest.osm.pbf",
+            "output_format": "pbf",
+            "polygon": {"file_name": f"{boundaries_dir}/{code}.osmium.geojson", "file_type": "geojson"},
+        })
+    config_path = f"{level_dirs[codes[0]]}/.multi-extract.json"
+    with open(config_path, "w", encoding="utf-8") as fh:
+        json.dump({"extracts": extracts}, fh)
+
+    try:
+        print(f"osmium multi-extract (complete_ways) -> {len(codes)} pbf(s): {codes}")
+        run_in_container(
+            [
+                "extract",
+                "--config", config_path,
+                *OSMIUM_EXTRACT_OPTIONS,
+                snapshot_pbf,
+            ],
+            image=OSMIUM_IMAGE,
+            mem_limit=OSMIUM_MULTI_EXTRACT_MEM_LIMIT,
+            shell=False,
+            step="osmium multi-extract",
+        )
+    except Exception as e:
+        from docker.errors import ContainerError
+
+        if isinstance(e, ContainerError):
+            stderr = e.stderr.decode() if isinstance(e.stderr, bytes) else (e.stderr or "")
+            print(f"Multi-extract failed (exit {e.exit_status}), falling back to per-code extraction:\n{stderr.strip()}")
+        else:
+            print(f"Multi-extract failed, falling back to per-code extraction: {e}")
+        return False
+    finally:
+        os.remove(config_path)
+
+    for code in codes:
+        subset_dir = f"{level_dirs[code]}/{code}"
+        print(f"[{code}] multi-extract pbf: {os.path.getsize(f'{subset_dir}/{code}-latest.osm.pbf'):,} bytes")
+        with open(f"{subset_dir}/.extracted", "w", encoding="utf-8") as fh:
+            fh.write(_snapshot_identity(snapshot_pbf))
+    return True
+
+
+def _snapshot_identity(snapshot_path: str) -> str:
+    # Hardlinked snapshots of the same shared planet file share this identity;
+    # a replaced shared file (next planet run) gets a new inode.
+    st = os.stat(snapshot_path)
+    return f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def reset_parent_store(parents_dir: str, snapshot_path: str) -> None:
+    """Empty a parent PBF store and tag it with the planet snapshot it serves."""
+    shutil.rmtree(parents_dir, ignore_errors=True)
+    os.makedirs(parents_dir)
+    with open(f"{parents_dir}/.snapshot", "w", encoding="utf-8") as fh:
+        fh.write(_snapshot_identity(snapshot_path))
+
+
+def snapshot_parent_store(source_dir: str, parents_dir: str, snapshot_path: str) -> int:
+    """Hardlink a parent store into parents_dir if it matches snapshot_path.
+
+    Parents cut from another planet snapshot would mix two days of data into
+    one subset, so a mismatching store is ignored (every subset then falls
+    back to the planet). The hardlinks keep this run's parents alive even if
+    the next continents/countries run resets the source store mid-flight.
+    Returns the number of parent PBFs linked.
+    """
+    os.makedirs(parents_dir, exist_ok=True)
+    if not _marker_matches(f"{source_dir}/.snapshot", _snapshot_identity(snapshot_path)):
+        print(f"No parent PBFs for this planet snapshot in {source_dir}")
+        return 0
+    linked = 0
+    for entry in sorted(os.listdir(source_dir)):
+        if not entry.endswith("-latest.osm.pbf"):
+            continue
+        code = entry[: -len("-latest.osm.pbf")]
+        try:
+            # Boundary first: a parent only counts once its PBF is present.
+            _link_or_copy(f"{source_dir}/{code}.prepared.geojson", f"{parents_dir}/{code}.prepared.geojson")
+            _link_or_copy(f"{source_dir}/{entry}", f"{parents_dir}/{entry}")
+            linked += 1
+        except FileNotFoundError:
+            continue
+    print(f"Linked {linked} parent PBF(s) from {source_dir}")
+    return linked
+
+
+def retain_parent(code: str, level_dir: str, boundaries_dir: str, parents_dir: str) -> None:
+    """Keep a built subset PBF (and its boundary) for deriving child subsets."""
+    os.makedirs(parents_dir, exist_ok=True)
+    _link_or_copy(f"{boundaries_dir}/{code}.prepared.geojson", f"{parents_dir}/{code}.prepared.geojson")
+    _link_or_copy(f"{level_dir}/{code}/{code}-latest.osm.pbf", f"{parents_dir}/{code}-latest.osm.pbf")
+
+
+@functools.lru_cache(maxsize=512)
+def _load_boundary_shape(path: str, mtime_ns: int):
+    import shapely
+
+    with open(path, "r", encoding="utf-8") as fh:
+        return shapely.from_geojson(fh.read())
+
+
+def _covers(boundary_path: str, child) -> bool:
+    import shapely
+
+    boundary = _load_boundary_shape(boundary_path, os.stat(boundary_path).st_mtime_ns)
+    minx, miny, maxx, maxy = child.bounds
+    pminx, pminy, pmaxx, pmaxy = boundary.bounds
+    if pminx > minx or pminy > miny or pmaxx < maxx or pmaxy < maxy:
+        return False
+    return shapely.covers(boundary, child)
+
+
+def _child_shape(code: str, boundaries_dir: str):
+    path = f"{boundaries_dir}/{code}.prepared.geojson"
+    return _load_boundary_shape(path, os.stat(path).st_mtime_ns)
+
+
+def parent_boundaries(parents_dir: str) -> dict[str, str]:
+    """Map every parent with a PBF in parents_dir to its prepared boundary."""
+    if not os.path.isdir(parents_dir):
+        return {}
+    return {
+        entry[: -len("-latest.osm.pbf")]: f"{parents_dir}/{entry[: -len('-latest.osm.pbf')]}.prepared.geojson"
+        for entry in sorted(os.listdir(parents_dir))
+        if entry.endswith("-latest.osm.pbf")
+    }
+
+
+def select_parent(code: str, boundaries_dir: str, parents_dir: str) -> str | None:
+    """Return the smallest parent PBF whose boundary covers code's boundary.
+
+    A parent extract holds every object intersecting the parent boundary,
+    with complete ways, so re-extracting a covered child from it yields the
+    same objects as extracting the child from the planet. Coverage is tested
+    on the prepared (buffered) boundaries and must be exact: a child poking
+    out of its parent (FR's overseas territories vs europe, some coastal
+    regions after simplification) falls back to the planet. "Smallest" is by
+    PBF size, i.e. the cheapest input to read.
+    """
+    child = _child_shape(code, boundaries_dir)
+    candidates = []
+    for parent, boundary_path in parent_boundaries(parents_dir).items():
+        if parent == code:
+            continue
+        try:
+            if _covers(boundary_path, child):
+                candidates.append((os.path.getsize(f"{parents_dir}/{parent}-latest.osm.pbf"), parent))
+        except FileNotFoundError:
+            continue
+    return min(candidates)[1] if candidates else None
+
+
+def uncovered_subsets(codes: list[str], boundaries_dir: str, boundaries: dict[str, str]) -> list[str]:
+    """Return the codes that no boundary in boundaries (parent -> path) covers.
+
+    These are the subsets select_parent leaves to the planet once those
+    parents are built: a run cuts them in its multi-extract pass over the
+    planet (extract_subsets_multi) rather than once each.
+    """
+    uncovered = []
+    for code in codes:
+        try:
+            child = _child_shape(code, boundaries_dir)
+        except FileNotFoundError:
+            continue
+        covered = False
+        for parent, boundary_path in boundaries.items():
+            if parent == code:
+                continue
+            try:
+                covered = _covers(boundary_path, child)
+            except FileNotFoundError:
+                continue
+            if covered:
+                break
+        if not covered:
+            uncovered.append(code)
+    return uncovered
+
+
+@dataclass(frozen=True)
+class SubsetRefresh:
+    """How previous subset PBFs are brought up to this run's planet snapshot.
+
+    sequence is the replication sequence of the planet snapshot. A stored PBF
+    at start_sequence is refreshed with the change set: changed_ids_path lists
+    every object the diffs created, modified or deleted, context_path holds
+    what a subset may need of the new planet around them (see
+    prepare_subset_refresh). Without a change set, only stored PBFs already
+    at sequence are reused. Subsets built in full are stored either way.
+    """
+
+    previous_dir: str
+    sequence: int
+    start_sequence: int | None = None
+    changed_ids_path: str | None = None
+    context_path: str | None = None
+
+
+def _boundary_digest(code: str, boundaries_dir: str) -> str:
+    with open(f"{boundaries_dir}/{code}.osmium.geojson", "rb") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def prepare_subset_refresh(snapshot_pbf: str, previous_dir: str, work_dir: str) -> SubsetRefresh | None:
+    """Prepare the change set refreshing the stored subset PBFs to snapshot_pbf.
+
+    The stored PBFs mostly date from the previous run: the diffs from their
+    most common sequence up to the snapshot's are fetched, and the context of
+    the changed objects, everything a complete_ways extract can newly take in
+    around them, is read from the snapshot: the ways and relations above
+    them, and the nodes of the ways (osm_replication.collect_changes).
+
+    Returns None when the replication sequence of the snapshot is unknown,
+    and no change set when nothing is stored, the diffs span more than
+    SUBSET_REFRESH_MAX_HOURS or cannot be processed.
+    """
+    from workflows.utils import osm_replication
+
+    try:
+        sequence = osm_replication.replication_sequence(snapshot_pbf)
+    except Exception as e:
+        print(f"Reading the replication sequence of {snapshot_pbf} failed: {e}")
+        sequence = None
+    if sequence is None:
+        print(f"No replication sequence in {snapshot_pbf}, subsets are extracted in full")
+        return None
+    stored: dict[int, int] = {}
+    if os.path.isdir(previous_dir):
+        for entry in os.listdir(previous_dir):
+            if not entry.endswith(".json"):
+                continue
+            try:
+                with open(f"{previous_dir}/{entry}", encoding="utf-8") as fh:
+                    entry_sequence = json.load(fh)["sequence"]
+            except (ValueError, KeyError):
+                continue
+            if entry_sequence < sequence:
+                stored[entry_sequence] = stored.get(entry_sequence, 0) + 1
+    if not stored:
+        print(f"No stored subset PBF behind sequence {sequence}")
+        return SubsetRefresh(previous_dir, sequence)
+    start = max(stored, key=lambda s: (stored[s], s))
+    if sequence - start > SUBSET_REFRESH_MAX_HOURS:
+        print(f"Stored subset PBFs are {sequence - start} diffs behind, subsets are extracted in full")
+        return SubsetRefresh(previous_dir, sequence)
+
+    context_path = f"{work_dir}/context.osm.pbf"
+    paths = {}
+    try:
+        paths = osm_replication.collect_changes(snapshot_pbf, start, sequence, work_dir)
+        run_in_container(
+            ["merge", "--overwrite", "--output", context_path, paths["related"], paths["members"]],
+            image=OSMIUM_IMAGE,
+            mem_limit=OSMIUM_MEM_LIMIT,
+            shell=False,
+            step="osmium merge",
+        )
+    except Exception as e:
+        print(f"Change set {start}..{sequence} failed, subsets are extracted in full: {e}")
+        return SubsetRefresh(previous_dir, sequence)
+    finally:
+        for key in ("members", "members_ids", "related", "related_ids"):
+            if key in paths and os.path.exists(paths[key]):
+                os.remove(paths[key])
+
+    print(f"Change set {start}..{sequence}: context {os.path.getsize(context_path):,} bytes")
+    return SubsetRefresh(previous_dir, sequence, start, paths["changed_ids"], context_path)
+
+
+def previous_subset(code: str, boundaries_dir: str, refresh: SubsetRefresh) -> dict | None:
+    """The stored entry of code (see SUBSET_PREVIOUS_DIR) if refresh can bring it up to date."""
+    try:
+        with open(f"{refresh.previous_dir}/{code}.json", encoding="utf-8") as fh:
+            entry = json.load(fh)
+        digest = _boundary_digest(code, boundaries_dir)
+    except (FileNotFoundError, ValueError):
+        return None
+    if entry.get("boundary") != digest or entry.get("incremental", 0) >= SUBSET_REFRESH_MAX_INCREMENTAL:
+        return None
+    if entry.get("extract") != list(OSMIUM_EXTRACT_OPTIONS):
+        return None
+    if entry.get("sequence") != refresh.sequence and (
+        refresh.context_path is None or entry.get("sequence") != refresh.start_sequence
+    ):
+        return None
+    if not os.path.exists(f"{refresh.previous_dir}/{code}-latest.osm.pbf"):
+        return None
+    return entry
+
+
+def refresh_subset_pbf(
+    code: str, entry: dict, pbf_path: str, boundaries_dir: str, refresh: SubsetRefresh, tmp_dir: str,
+) -> bool:
+    """Bring the stored PBF of code up to refresh.sequence at pbf_path.
+
+    The changed objects are removed from the stored PBF, the context of the
+    change set (their current versions and what surrounds them) is merged
+    in, and the result is cut again by extract_subset_pbf, like a full
+    extract: objects leaving the boundary drop out, objects entering it (a
+    way one of whose nodes moved inside, the relations of either) come in
+    complete. Both paths being the same complete_ways cut, an unchanged
+    refresh means an unchanged full extract.
+    Returns whether the content changed; if not, pbf_path is a link to the
+    stored PBF.
+    """
+    from docker.errors import ContainerError
+
+    previous_path = f"{refresh.previous_dir}/{code}-latest.osm.pbf"
+    if entry["sequence"] == refresh.sequence:
+        _link_or_copy(previous_path, pbf_path)
+        return False
+
+    kept_path = f"{tmp_dir}/{code}-kept.osm.pbf"
+    merged_path = f"{tmp_dir}/{code}-merged.osm.pbf"
+    for args, step in (
+        (["removeid", "--overwrite", "--id-file", refresh.changed_ids_path, "--output", kept_path, previous_path],
+         "osmium removeid"),
+        (["merge", "--overwrite", "--output", merged_path, kept_path, refresh.context_path], "osmium merge"),
+    ):
+        run_in_container(args, image=OSMIUM_IMAGE, mem_limit=OSMIUM_MEM_LIMIT, shell=False, code=code, step=step)
+    extract_subset_pbf(code, merged_path, pbf_path, boundaries_dir, "osmium extract refresh")
+    os.remove(kept_path)
+    os.remove(merged_path)
+
+    try:
+        run_in_container(
+            ["diff", "--quiet", previous_path, pbf_path],
+            image=OSMIUM_IMAGE,
+            mem_limit=OSMIUM_MEM_LIMIT,
+            shell=False,
+            code=code,
+            step="osmium diff",
+        )
+    except ContainerError as e:
+        # osmium diff exits with 1 when the files differ, 2 on errors.
+        if e.exit_status != 1:
+            raise
+        return True
+    _link_or_copy(previous_path, pbf_path)
+    return False
+
+
+def stage_previous_subset(code: str, level_dir: str, previous_dir: str) -> None:
+    """Link a new subset PBF into the previous store, until commit_previous_subset."""
+    os.makedirs(previous_dir, exist_ok=True)
+    _link_or_copy(f"{level_dir}/{code}/{code}-latest.osm.pbf", f"{previous_dir}/{code}-next.osm.pbf")
+
+
+def commit_previous_subset(
+    code: str, boundaries_dir: str, refresh: SubsetRefresh, incremental: bool, staged: bool = True,
+) -> None:
+    """Store the subset of code as published at refresh.sequence.
+
+    Called once every output of code is uploaded, so the store never runs
+    ahead of what was published: the PBF staged by stage_previous_subset
+    replaces the stored one, or with staged=False (unchanged content) the
+    stored PBF stays. An incremental refresh counts towards
+    SUBSET_REFRESH_MAX_INCREMENTAL.
+    """
+    entry_path = f"{refresh.previous_dir}/{code}.json"
+    count = 0
+    if incremental:
+        with open(entry_path, encoding="utf-8") as fh:
+            count = json.load(fh).get("incremental", 0) + 1
+    if staged:
+        staged_path = f"{refresh.previous_dir}/{code}-next.osm.pbf"
+        if not os.path.exists(staged_path):
+            print(f"[{code}] No staged pbf, the previous one is not updated")
+            return
+        os.rename(staged_path, f"{refresh.previous_dir}/{code}-latest.osm.pbf")
+    with open(f"{entry_path}.tmp", "w", encoding="utf-8") as fh:
+        json.dump({
+            "sequence": refresh.sequence,
+            "boundary": _boundary_digest(code, boundaries_dir),
+            "incremental": count,
+            "extract": list(OSMIUM_EXTRACT_OPTIONS),
+        }, fh)
+    os.rename(f"{entry_path}.tmp", entry_path)
+
+
+class StageLimits:
+    """Concurrency limit per pipeline stage, shared by the threads of a batch.
+
+    A stage without a limit runs unbounded.
+    """
+
+    def __init__(self, limits: dict[str, int]):
+        self._slots = {stage: threading.BoundedSemaphore(limit) for stage, limit in limits.items()}
+
+    @contextlib.contextmanager
+    def slot(self, stage: str) -> Iterator[None]:
+        semaphore = self._slots.get(stage)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+
 def build_subset_files(
     code: str,
     level_dir: str,
@@ -298,23 +2189,69 @@ def build_subset_files(
     snapshot_gol: str,
     snapshot_pbf: str | None = None,
     refilter_gol_pbf: bool = False,
+    parents_dir: str | None = None,
+    stages: StageLimits | None = None,
+    on_finalized: Callable[[str, str], None] | None = None,
+    refresh: SubsetRefresh | None = None,
 ) -> tuple[str, str] | None:
     """Extract PBF -> gol build (GOL) -> gol save (GOB) for one subset.
 
+    With refresh, a stored previous PBF of the subset that refresh can bring
+    up to date (see previous_subset) is refreshed instead of extracted (see
+    refresh_subset_pbf); when its content did not change, nothing is built.
+
+    With parents_dir (hierarchical mode), the PBF is cut with osmium
+    complete_ways from the smallest parent PBF in parents_dir that covers the
+    boundary (see select_parent), or from snapshot_pbf (required) when no
+    parent does: both cuts are the same complete_ways extract, so the
+    subset does not depend on which parents were built before it.
+
     Uses osmium's bounded-memory complete_ways extraction when snapshot_pbf is
-    provided; otherwise uses gol query against snapshot_gol. When
+    provided (or the PBF extract_subsets_multi already wrote for this code);
+    otherwise uses gol query against snapshot_gol. When
     refilter_gol_pbf is true, osmium spatially re-filters gol's PBF before the
     build, removing global members pulled in by recursive relation closure.
 
+    Each of the three stages ("extract", "gol build", "gol save") waits for
+    a slot of stages when given. on_finalized(code, fmt) is called as each
+    output is complete: "pbf" once the extract is known to be non-empty,
+    then "gol" and "gob". A rebuild forgets earlier uploads of those three
+    (see upload_subset_file).
+
     Thread-safe. Returns None on success, ("skipped", code) when the boundary
-    matches no features, ("failed", code) on error.
+    matches no features, ("unchanged", code) when the refreshed PBF equals
+    the stored one (left at its usual path), ("failed", code) on error.
     """
+    if parents_dir is not None and snapshot_pbf is None:
+        raise ValueError("Hierarchical extraction needs snapshot_pbf to cut uncovered subsets from")
+    if refresh is not None and snapshot_pbf is None:
+        raise ValueError("Refreshed subsets are cut with osmium, so full builds need snapshot_pbf")
+    stages = stages or StageLimits({})
     subset_dir = f"{level_dir}/{code}"
     pbf_path = f"{subset_dir}/{code}-latest.osm.pbf"
     gol_path = f"{subset_dir}/{code}-latest.osm.gol"
     gob_path = f"{subset_dir}/{code}-latest.osm.gob"
     marker_path = f"{subset_dir}/.built"
-    marker_value = "built-refiltered" if refilter_gol_pbf else "built"
+    # A multi-extract PBF of another planet snapshot (a WORK_DIR left by an
+    # earlier run) is extracted again.
+    pre_extracted = snapshot_pbf is not None and _marker_matches(
+        f"{subset_dir}/.extracted", _snapshot_identity(snapshot_pbf),
+    )
+    previous = None
+    if refresh is not None and not pre_extracted:
+        previous = previous_subset(code, boundaries_dir, refresh)
+    parent = None
+    if parents_dir is not None and previous is None and not pre_extracted:
+        try:
+            parent = select_parent(code, boundaries_dir, parents_dir)
+        except Exception as e:
+            print(f"[{code}] Parent selection failed, falling back to the planet: {e}")
+    if previous is not None:
+        marker_value = "built-incremental"
+    elif parent is not None:
+        marker_value = "built-hierarchical"
+    else:
+        marker_value = "built-refiltered" if refilter_gol_pbf else "built"
     # Osmium infers the input format from the filename, so temporary PBFs must
     # retain a recognized .osm.pbf suffix.
     query_pbf_path = f"{subset_dir}/{code}-gol-query.tmp.osm.pbf"
@@ -329,102 +2266,85 @@ def build_subset_files(
     try:
         os.makedirs(subset_dir, exist_ok=True)
         for stale in (
-            pbf_path,
+            None if pre_extracted else pbf_path,
+            None if pre_extracted else f"{subset_dir}/.extracted",
             query_pbf_path,
             gol_path,
             f"{gol_path}.tmp",
             gob_path,
             f"{gob_path}.tmp",
             f"{gob_path}.tmp.tmp",
+            *(_upload_marker(level_dir, code, fmt) for fmt in ("pbf", "gol", "gob")),
         ):
-            if os.path.exists(stale):
+            if stale is not None and os.path.exists(stale):
                 os.remove(stale)
         tmp_dir = f"{subset_dir}/.tmp"
         os.makedirs(tmp_dir, exist_ok=True)
 
-        osmium_boundary_path = f"{subset_dir}/{code}.osmium.geojson"
-        if snapshot_pbf is not None or refilter_gol_pbf:
-            # gol needs a bare GeoJSON geometry, while osmium requires a
-            # Feature or FeatureCollection. Build the wrapper from the metadata
-            # sidecar so both extractors use exactly the same prepared geometry.
-            with open(f"{boundaries_dir}/{code}.meta.json", "r", encoding="utf-8") as fh:
-                geometry = json.load(fh)["geometry"]
-            with open(osmium_boundary_path, "w", encoding="utf-8") as fh:
-                json.dump({
-                    "type": "Feature",
-                    "properties": {},
-                    "geometry": geometry,
-                }, fh)
-
-        if snapshot_pbf is None:
-            print(f"[{code}] gol query -> pbf")
-            query_output_path = query_pbf_path if refilter_gol_pbf else pbf_path
-            query = shlex.join([
-                "gol", "query", snapshot_gol, "*",
-                "--area", f"{boundaries_dir}/{code}.prepared.geojson",
-                "-f", "pbf",
-            ])
-            run_in_container(f"{query} > {shlex.quote(query_output_path)}", mem_limit=GOL_MEM_LIMIT)
-
-            if os.path.getsize(query_output_path) < EMPTY_PBF_THRESHOLD_BYTES:
-                print(f"[{code}] Empty extract ({os.path.getsize(query_output_path)} bytes), skipping")
-                shutil.rmtree(subset_dir, ignore_errors=True)
-                return ("skipped", code)
-
-            if refilter_gol_pbf:
-                print(f"[{code}] osmium complete_ways post-filter -> pbf")
-                run_in_container(
-                    [
-                        "extract",
-                        "--strategy", "complete_ways",
-                        "--polygon", osmium_boundary_path,
-                        "--set-bounds",
-                        "--overwrite",
-                        "--output", pbf_path,
-                        query_pbf_path,
-                    ],
-                    image=OSMIUM_IMAGE,
-                    mem_limit=OSMIUM_MEM_LIMIT,
-                    shell=False,
+        with stages.slot("extract"):
+            if previous is not None:
+                print(f"[{code}] osmium refresh of the previous pbf ({previous['sequence']} -> {refresh.sequence})")
+                if not refresh_subset_pbf(code, previous, pbf_path, boundaries_dir, refresh, tmp_dir):
+                    print(f"[{code}] Unchanged since the previous pbf, skipping")
+                    return ("unchanged", code)
+            elif parent is not None:
+                print(f"[{code}] osmium extract (complete_ways) from parent {parent} -> pbf")
+                extract_subset_pbf(
+                    code, f"{parents_dir}/{parent}-latest.osm.pbf", pbf_path, boundaries_dir, "osmium extract parent",
                 )
-                print(
-                    f"[{code}] post-filtered PBF: "
-                    f"{os.path.getsize(query_pbf_path):,} -> {os.path.getsize(pbf_path):,} bytes"
+            elif snapshot_pbf is None:
+                print(f"[{code}] gol query -> pbf")
+                query_output_path = query_pbf_path if refilter_gol_pbf else pbf_path
+                query = shlex.join([
+                    "gol", "query", snapshot_gol, "*",
+                    "--area", f"{boundaries_dir}/{code}.prepared.geojson",
+                    "-f", "pbf",
+                ])
+                run_in_container(
+                    f"{query} > {shlex.quote(query_output_path)}", mem_limit=GOL_MEM_LIMIT, code=code, step="gol query",
                 )
-                os.remove(query_pbf_path)
-        else:
-            print(f"[{code}] osmium extract (complete_ways) -> pbf")
-            run_in_container(
-                [
-                    "extract",
-                    "--strategy", "complete_ways",
-                    "--polygon", osmium_boundary_path,
-                    "--set-bounds",
-                    "--overwrite",
-                    "--output", pbf_path,
-                    snapshot_pbf,
-                ],
-                image=OSMIUM_IMAGE,
-                mem_limit=OSMIUM_MEM_LIMIT,
-                shell=False,
-            )
+
+                if os.path.getsize(query_output_path) < EMPTY_PBF_THRESHOLD_BYTES:
+                    print(f"[{code}] Empty extract ({os.path.getsize(query_output_path)} bytes), skipping")
+                    shutil.rmtree(subset_dir, ignore_errors=True)
+                    return ("skipped", code)
+
+                if refilter_gol_pbf:
+                    print(f"[{code}] osmium complete_ways post-filter -> pbf")
+                    extract_subset_pbf(code, query_pbf_path, pbf_path, boundaries_dir, "osmium post-filter")
+                    print(
+                        f"[{code}] post-filtered PBF: "
+                        f"{os.path.getsize(query_pbf_path):,} -> {os.path.getsize(pbf_path):,} bytes"
+                    )
+                    os.remove(query_pbf_path)
+            elif pre_extracted:
+                print(f"[{code}] Using the multi-extract pbf")
+            else:
+                print(f"[{code}] osmium extract (complete_ways) -> pbf")
+                extract_subset_pbf(code, snapshot_pbf, pbf_path, boundaries_dir, "osmium extract")
 
         if os.path.getsize(pbf_path) < EMPTY_PBF_THRESHOLD_BYTES:
             print(f"[{code}] Empty extract ({os.path.getsize(pbf_path)} bytes), skipping")
             shutil.rmtree(subset_dir, ignore_errors=True)
             return ("skipped", code)
+        on_finalized = on_finalized or (lambda _code, _fmt: None)
+        on_finalized(code, "pbf")
 
-        print(f"[{code}] gol build")
-        build = shlex.join(["gol", "build", "--yes", gol_path, pbf_path])
-        run_in_container(build, env={"TMPDIR": tmp_dir}, mem_limit=GOL_MEM_LIMIT)
+        with stages.slot("gol build"):
+            print(f"[{code}] gol build")
+            build = shlex.join(["gol", "build", "--yes", gol_path, pbf_path])
+            run_in_container(build, env={"TMPDIR": tmp_dir}, mem_limit=GOL_MEM_LIMIT, code=code, step="gol build")
+        on_finalized(code, "gol")
 
-        print(f"[{code}] gol save")
-        save = shlex.join(["gol", "save", gol_path, gob_path])
-        run_in_container(save, mem_limit=GOL_MEM_LIMIT)
+        with stages.slot("gol save"):
+            print(f"[{code}] gol save")
+            save = shlex.join(["gol", "save", gol_path, gob_path])
+            run_in_container(save, mem_limit=GOL_MEM_LIMIT, code=code, step="gol save")
 
         shutil.rmtree(tmp_dir, ignore_errors=True)
         with open(marker_path, "w", encoding="utf-8") as fh:
             fh.write(marker_value)
+        on_finalized(code, "gob")
         return None
     except Exception as e:
         from docker.errors import ContainerError
@@ -437,113 +2357,727 @@ def build_subset_files(
         return ("failed", code)
 
 
-def parquet_copy_sql(code: str, output_path: str, boundaries_dir: str, snapshot_parquet: str) -> str:
-    """Return the DuckDB COPY statement extracting one subset GeoParquet.
-
-    Same schema as the planet file (osm_type, osm_id, tags, bbox, geometry);
-    the bbox prefilter drives row-group pruning (the planet file is
-    bbox-sorted), ST_Intersects against the simplified boundary decides
-    membership. Insertion order is preserved so subsets stay bbox-sorted.
-    """
+def _parquet_boundary(code: str, boundaries_dir: str) -> tuple[list[float], str, list[str]]:
+    """Return the boundary bbox, its VALUES row and its pieces' VALUES rows."""
     with open(f"{boundaries_dir}/{code}.meta.json", "r", encoding="utf-8") as fh:
         meta = json.load(fh)
-    minx, miny, maxx, maxy = meta["bbox"]
-    geometry_json = json.dumps(meta["geometry"]).replace("'", "''")
+    with open(f"{boundaries_dir}/{code}.pieces.geojson", "r", encoding="utf-8") as fh:
+        features = json.load(fh)["features"]
+
+    def values_row(bbox: list[float], geometry: dict) -> str:
+        minx, miny, maxx, maxy = bbox
+        geometry_json = json.dumps(geometry).replace("'", "''")
+        return f"({_sql_quote(code)}, {minx}, {miny}, {maxx}, {maxy}, ST_GeomFromGeoJSON('{geometry_json}'))"
+
+    pieces = [values_row(feature["bbox"], feature["geometry"]) for feature in features]
+    return meta["bbox"], values_row(meta["bbox"], meta["geometry"]), pieces
 
+
+def _sql_quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+# Rows of the level 0 grid; a cell's integer key is x * _GRID_ROWS + y.
+_GRID_ROWS = round(180 / BOUNDARY_PIECE_CELL_DEG)
+# Cell keys that are not level 0 cells: the row spans several level 0 cells
+# (tested against the whole boundary), lies in an inside leaf (accepted) or
+# in an outside leaf (rejected: no piece carries that key).
+_CELL_SPANNING, _CELL_INSIDE, _CELL_OUTSIDE = -1, -2, -3
+
+
+def _pieces_table_sql(codes: list[str], boundaries: list[str], pieces: list[str], boundaries_dir: str) -> str:
+    """Return statements building subset_pieces and subset_grid.
+
+    Every piece gets one row per level 0 cell its (margin-grown) bbox
+    overlaps. Each whole boundary gets one row under _CELL_SPANNING, and one
+    catch-all row under _CELL_INSIDE that accepts without a geometry test.
+    subset_grid holds the inside and outside quadtree leaves of each code.
+    """
+    cell = BOUNDARY_PIECE_CELL_DEG
+    margin = BOUNDARY_GRID_MARGIN_DEG
+    piece_values = ",\n    ".join(pieces)
+    boundary_values = ",\n    ".join(boundaries)
+    grids = "\nUNION ALL\n".join(
+        f"SELECT {_sql_quote(code)} AS code, * FROM read_csv({_sql_quote(f'{boundaries_dir}/{code}.grid.csv')}, "
+        f"columns = {{'level': 'INTEGER', 'x': 'BIGINT', 'y': 'BIGINT', 'state': 'VARCHAR'}}, header = true)"
+        for code in codes
+    )
+    accept_all = ",\n    ".join(
+        f"({_sql_quote(code)}, -180, -90, 180, 90, NULL, {_CELL_INSIDE})" for code in codes
+    )
     return f"""
-COPY (
-    SELECT osm_type, osm_id, tags, bbox, geometry
-    FROM read_parquet('{snapshot_parquet}')
-    WHERE bbox.xmax >= {minx} AND bbox.xmin <= {maxx}
-      AND bbox.ymax >= {miny} AND bbox.ymin <= {maxy}
-      AND ST_Intersects(ST_GeomFromGeoJSON('{geometry_json}'), geometry)
-) TO '{output_path}' (
-    FORMAT PARQUET,
-    CODEC 'zstd',
-    COMPRESSION_LEVEL 6,
-    PARQUET_VERSION v2
+CREATE OR REPLACE TEMP TABLE subset_piece_values (code VARCHAR, xmin DOUBLE, ymin DOUBLE, xmax DOUBLE, ymax DOUBLE, piece GEOMETRY);
+INSERT INTO subset_piece_values VALUES
+    {piece_values};
+CREATE OR REPLACE TEMP TABLE subset_pieces AS
+SELECT v.code, v.xmin - {margin} AS xmin, v.ymin - {margin} AS ymin,
+       v.xmax + {margin} AS xmax, v.ymax + {margin} AS ymax, v.piece,
+       cx.x * {_GRID_ROWS} + cy.y AS cell
+FROM subset_piece_values v,
+     range(floor((v.xmin - {margin} + 180) / {cell})::BIGINT, floor((v.xmax + {margin} + 180) / {cell})::BIGINT + 1) cx(x),
+     range(floor((v.ymin - {margin} + 90) / {cell})::BIGINT, floor((v.ymax + {margin} + 90) / {cell})::BIGINT + 1) cy(y);
+INSERT INTO subset_pieces
+SELECT *, {_CELL_SPANNING} FROM (VALUES
+    {boundary_values}
 );
+INSERT INTO subset_pieces VALUES
+    {accept_all};
+DROP TABLE subset_piece_values;
+CREATE OR REPLACE TEMP TABLE subset_grid AS
+SELECT * FROM ({grids})
+WHERE state <> 'edge';
 """
 
 
-def run_parquet_batch(codes: list[str], level_dir: str, boundaries_dir: str, snapshot_parquet: str, work_dir: str) -> set[str]:
-    """Extract subset GeoParquet files for a batch of codes in one DuckDB session.
+def _planet_cells_sql() -> str:
+    """Return the select-list computing a planet row's grid cell keys.
 
-    Codes are processed one COPY at a time so a single failure doesn't kill the
-    batch. Returns the set of failed codes.
+    x{level}/y{level} locate the row's bbox at every quadtree level, NULL
+    where it spans several cells; cell is the level 0 key or _CELL_SPANNING.
     """
-    failed: set[str] = set()
-    for code in codes:
-        parquet_path = f"{level_dir}/{code}/{code}-latest.osm.parquet"
-        tmp_path = f"{parquet_path}.tmp"
-        # Safe existence check: the final path only ever appears via the
-        # rename below, so it can never be a truncated partial file.
-        if os.path.exists(parquet_path):
-            print(f"[{code}] Parquet already extracted, skipping")
-            continue
-        sql_path = f"{level_dir}/{code}/extract.sql"
+    columns = []
+    for level in range(BOUNDARY_GRID_LEVELS + 1):
+        scale = 2**level / BOUNDARY_PIECE_CELL_DEG
+        x_min, x_max = f"floor((bbox.xmin + 180) * {scale})", f"floor((bbox.xmax + 180) * {scale})"
+        y_min, y_max = f"floor((bbox.ymin + 90) * {scale})", f"floor((bbox.ymax + 90) * {scale})"
+        fits = f"{x_min} = {x_max} AND {y_min} = {y_max}"
+        columns.append(f"CASE WHEN {fits} THEN {x_min}::BIGINT END AS x{level}")
+        columns.append(f"CASE WHEN {fits} THEN {y_min}::BIGINT END AS y{level}")
+    columns.append(f"coalesce(x0 * {_GRID_ROWS} + y0, {_CELL_SPANNING}) AS cell")
+    return ",\n        ".join(columns)
+
+
+def _subset_members_sql(candidates: str, code: str | None = None) -> str:
+    """Return a query keeping the candidate rows that belong to their subset.
+
+    candidates must produce the _planet_cells_sql columns; code is the SQL
+    literal of the subset code of every candidate, or None when candidates
+    carry theirs in a code column.
+    The grid joins find the inside/outside leaf a row falls in, if any (at
+    most one leaf lies on the chain of cells containing the row's bbox).
+    The semi join then keeps one copy of each member: rows of inside leaves
+    match the catch-all row, rows of outside leaves match nothing, and the
+    rest are tested with ST_Intersects against the pieces of their level 0
+    cell (or the whole boundary) whose bbox they overlap.
+    """
+    def code_of(alias: str) -> str:
+        return code if code is not None else f"{alias}.code"
+
+    levels = range(BOUNDARY_GRID_LEVELS + 1)
+    grid_joins = "\n    ".join(
+        f"LEFT JOIN subset_grid g{level} ON g{level}.code = {code_of('c')} AND g{level}.level = {level} "
+        f"AND g{level}.x = c.x{level} AND g{level}.y = c.y{level}"
+        for level in levels
+    )
+    states = ", ".join(f"g{level}.state" for level in levels)
+    return f"""(
+    SELECT c.*, CASE coalesce({states})
+               WHEN 'inside' THEN {_CELL_INSIDE}
+               WHEN 'outside' THEN {_CELL_OUTSIDE}
+               ELSE c.cell
+           END AS match_cell
+    FROM ({candidates}) c
+    {grid_joins}
+) p
+SEMI JOIN subset_pieces s
+  ON s.code = {code_of('p')}
+ AND s.cell = p.match_cell
+ AND p.bbox.xmax >= s.xmin AND p.bbox.xmin <= s.xmax
+ AND p.bbox.ymax >= s.ymin AND p.bbox.ymin <= s.ymax
+ AND (s.cell = {_CELL_INSIDE} OR ST_Intersects(s.piece, p.geometry))"""
+
+
+def parquet_copy_sql(code: str, output_path: str, boundaries_dir: str, snapshot_parquet: str) -> str:
+    """Return the DuckDB statements extracting one subset GeoParquet.
+
+    Same schema and GeoParquet metadata as the planet file (osm_type,
+    osm_id, tags, bbox, geometry); the bbox prefilter drives row-group
+    pruning (the planet file is spatially sorted), the quadtree grid settles
+    rows deep inside or outside the boundary, and ST_Intersects against the
+    pieces of the simplified boundary decides the rest (see
+    _subset_members_sql). The semi join does not preserve order, so rows are
+    sorted back by planet row number and subsets keep the planet's row order.
+    """
+    (minx, miny, maxx, maxy), boundary, pieces = _parquet_boundary(code, boundaries_dir)
+    candidates = f"""
+        SELECT file_row_number AS planet_row, osm_type, osm_id, tags, bbox, geometry,
+        {_planet_cells_sql()}
+        FROM read_parquet('{snapshot_parquet}', file_row_number = true)
+        WHERE bbox.xmax >= {minx} AND bbox.xmin <= {maxx}
+          AND bbox.ymax >= {miny} AND bbox.ymin <= {maxy}
+    """
+
+    return f"""{_pieces_table_sql([code], [boundary], pieces, boundaries_dir)}
+COPY (
+    SELECT osm_type, osm_id, tags, bbox, ST_AsWKB(geometry) AS geometry
+    FROM {_subset_members_sql(candidates, _sql_quote(code))}
+    ORDER BY planet_row
+) TO '{output_path}' {parquet_copy_options()};
+"""
+
+
+def parquet_batch_sql(outputs: dict[str, str], boundaries_dir: str, snapshot_parquet: str) -> str:
+    """Return DuckDB statements extracting several subsets in one planet scan.
+
+    All boundaries of the batch go into one table and the planet file is
+    joined against it once, so row groups shared by neighbouring subsets are
+    read and decompressed once instead of once per code. The OR of the
+    per-code bbox predicates keeps row-group pruning for the regions no code
+    touches. Membership is decided by the grid and the boundary pieces, as
+    in parquet_copy_sql. Matches are staged in a temporary table (spilling to
+    temp_directory) together with their planet row number, and each subset
+    is then written in planet order with the same schema as
+    parquet_copy_sql. outputs maps each code to its output path.
+    """
+    bboxes = []
+    boundaries = []
+    pieces = []
+    prefilters = []
+    for code, _output_path in outputs.items():
+        (minx, miny, maxx, maxy), boundary, code_pieces = _parquet_boundary(code, boundaries_dir)
+        bboxes.append(f"({_sql_quote(code)}, {minx}, {miny}, {maxx}, {maxy})")
+        boundaries.append(boundary)
+        pieces.extend(code_pieces)
+        prefilters.append(
+            f"(bbox.xmax >= {minx} AND bbox.xmin <= {maxx} AND bbox.ymax >= {miny} AND bbox.ymin <= {maxy})"
+        )
+    values = ",\n    ".join(bboxes)
+    prefilter = "\n       OR ".join(prefilters)
+    candidates = """
+        SELECT b.code, planet.*
+        FROM planet
+        JOIN subset_boundaries b
+          ON planet.bbox.xmax >= b.xmin AND planet.bbox.xmin <= b.xmax
+         AND planet.bbox.ymax >= b.ymin AND planet.bbox.ymin <= b.ymax
+    """
+
+    copies = "\n".join(
+        f"""COPY (
+    SELECT osm_type, osm_id, tags, bbox, ST_AsWKB(geometry) AS geometry
+    FROM subset_matches
+    WHERE code = {_sql_quote(code)}
+    ORDER BY planet_row
+) TO '{output_path}' {parquet_copy_options()};"""
+        for code, output_path in outputs.items()
+    )
+
+    return f"""
+CREATE OR REPLACE TEMP TABLE subset_boundaries (code VARCHAR, xmin DOUBLE, ymin DOUBLE, xmax DOUBLE, ymax DOUBLE);
+INSERT INTO subset_boundaries VALUES
+    {values};
+{_pieces_table_sql(list(outputs), boundaries, pieces, boundaries_dir)}
+CREATE OR REPLACE TEMP TABLE subset_matches AS
+WITH planet AS (
+    SELECT file_row_number AS planet_row, osm_type, osm_id, tags, bbox, geometry,
+    {_planet_cells_sql()}
+    FROM read_parquet('{snapshot_parquet}', file_row_number = true)
+    WHERE {prefilter}
+)
+SELECT p.code, p.planet_row, p.osm_type, p.osm_id, p.tags, p.bbox, p.geometry
+FROM {_subset_members_sql(candidates)};
+
+{copies}
+"""
+
+
+class DuckDBWorker:
+    """One long-lived DuckDB CLI session in one container, fed jobs over a FIFO.
+
+    A fresh container per code paid container start, CLI launch, spatial
+    INSTALL/LOAD and a planet footer read thousands of times per run. The
+    worker runs `duckdb -bail` reading from a named pipe and is handed
+    `.read <job.sql>` lines, so the extension, the parquet metadata cache and
+    the buffer pool are shared by every job of the session. Each job ends by
+    writing a status file; the caller polls for it, or for the container's
+    exit. -bail makes any error end the session, which is how failures stay
+    isolated per job: the failed job is reported, and the next job starts a
+    new session. Use as a context manager; the container is always removed.
+    Container telemetry is recorded per session (step "duckdb session",
+    labelled with label).
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, work_dir: str, session_dir: str, label: str | None = None):
+        self.work_dir = work_dir
+        self.session_dir = session_dir
+        self.label = label
+        self._container = None
+        self._sampler: _ContainerSampler | None = None
+        self._fd: int | None = None
+        self._jobs = 0
+
+    def __enter__(self) -> DuckDBWorker:
+        # Status files left by an interrupted session would pass for results.
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+        os.makedirs(self.session_dir)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop()
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+
+    def _start(self) -> None:
+        import errno
+        import time
+
+        fifo_path = f"{self.session_dir}/jobs.fifo"
+        if os.path.exists(fifo_path):
+            os.remove(fifo_path)
+        os.mkfifo(fifo_path)
+        # The container user differs from the worker's; the pipe only ever
+        # carries .read lines pointing at files under session_dir.
+        os.chmod(fifo_path, 0o666)
+        setup_path = f"{self.session_dir}/setup.sql"
         # extension_directory must be set BEFORE INSTALL: the container user
         # has no writable HOME, and the cache avoids ~3,000 re-downloads.
-        with open(sql_path, "w", encoding="utf-8") as fh:
+        with open(setup_path, "w", encoding="utf-8") as fh:
             fh.write(f"""
-SET extension_directory='{work_dir}/.duckdb-extensions';
-SET temp_directory='{work_dir}/.duckdb-temp';
+SET extension_directory='{self.work_dir}/.duckdb-extensions';
+SET temp_directory='{self.work_dir}/.duckdb-temp';
 INSTALL 'spatial'; LOAD 'spatial';
 SET memory_limit='{PARQUET_DUCKDB_MEMORY_LIMIT}';
 SET threads={PARQUET_DUCKDB_THREADS};
-{parquet_copy_sql(code, tmp_path, boundaries_dir, snapshot_parquet)}
+SET parquet_metadata_cache=true;
 """)
+        self._container = start_container(
+            f"{self.work_dir}/duckdb -bail -init {shlex.quote(setup_path)} < {shlex.quote(fifo_path)}",
+            env={"HOME": self.work_dir},
+            mem_limit=PARQUET_CONTAINER_MEM_LIMIT,
+        )
+        self._sampler = _ContainerSampler(
+            self._container, ContainerTelemetry(image=OPENPLANETDATA_IMAGE, code=self.label, step="duckdb session"),
+        )
+        # Opening the write end without a reader fails with ENXIO; wait for
+        # the CLI's shell redirect to open the read end.
+        while True:
+            try:
+                self._fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                return
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if not self._alive():
+                raise RuntimeError(f"DuckDB worker exited during startup:\n{self._logs()}")
+            time.sleep(self.POLL_INTERVAL)
+
+    def _stop(self) -> None:
+        if self._fd is not None:
+            # EOF on the pipe ends the CLI session cleanly.
+            os.close(self._fd)
+            self._fd = None
+        if self._container is not None:
+            status = None
+            try:
+                status = self._container.wait(timeout=60)["StatusCode"]
+            except Exception:
+                pass
+            self._sampler.finish(status)
+            self._container.remove(force=True)
+            self._container = None
+
+    def _alive(self) -> bool:
+        self._container.reload()
+        return self._container.status in ("created", "running")
+
+    def _logs(self, tail: int = 50) -> str:
+        return self._container.logs(stdout=True, stderr=True, tail=tail).decode(errors="replace").strip()
+
+    def run(self, label: str, sql: str) -> bool:
+        """Run sql as one job; return False (after logging why) on failure."""
+        import time
+
+        self._jobs += 1
+        job_path = f"{self.session_dir}/{self._jobs}.sql"
+        status_path = f"{self.session_dir}/{self._jobs}.ok"
+        with open(job_path, "w", encoding="utf-8") as fh:
+            fh.write(sql)
+            fh.write(f"\nCOPY (SELECT 1 AS ok) TO '{status_path}' (FORMAT CSV);\n")
         try:
-            print(f"[{code}] duckdb parquet extract")
-            run_in_container(
-                f"{work_dir}/duckdb -f {shlex.quote(sql_path)}",
-                env={"HOME": work_dir},
-                mem_limit=PARQUET_CONTAINER_MEM_LIMIT,
-            )
-            os.rename(tmp_path, parquet_path)
-            os.remove(sql_path)
+            if self._container is None:
+                self._start()
+            os.write(self._fd, f".read '{job_path}'\n".encode())
+            while not os.path.exists(status_path):
+                if not self._alive():
+                    print(f"[{label}] Parquet extraction failed:\n{self._logs()}")
+                    self._stop()
+                    return False
+                time.sleep(self.POLL_INTERVAL)
+            return True
         except Exception as e:
-            from docker.errors import ContainerError
+            print(f"[{label}] Parquet extraction failed: {e}")
+            self._stop()
+            return False
+        finally:
+            os.remove(job_path)
+
 
-            if isinstance(e, ContainerError):
-                stderr = e.stderr.decode() if isinstance(e.stderr, bytes) else (e.stderr or "")
-                print(f"[{code}] Parquet extraction failed (exit {e.exit_status}):\n{stderr.strip()}")
+def _run_parquet_single_scan(worker: DuckDBWorker, codes: list[str], level_dir: str, boundaries_dir: str, snapshot_parquet: str) -> bool:
+    """Extract all codes with parquet_batch_sql; return False on any failure.
+
+    A failure leaves no way to tell complete outputs from partial ones, so
+    every temporary output is discarded and the caller retries code by code.
+    """
+    outputs = {code: f"{level_dir}/{code}/{code}-latest.osm.parquet.tmp" for code in codes}
+    print(f"duckdb single-scan parquet extract for {len(codes)} code(s): {codes}")
+    if worker.run("batch", parquet_batch_sql(outputs, boundaries_dir, snapshot_parquet)):
+        for code, tmp_path in outputs.items():
+            os.rename(tmp_path, f"{level_dir}/{code}/{code}-latest.osm.parquet")
+        return True
+    for tmp_path in outputs.values():
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return False
+
+
+def run_parquet_batch(
+    codes: list[str],
+    level_dir: str,
+    boundaries_dir: str,
+    snapshot_parquet: str,
+    work_dir: str,
+    single_scan: bool = True,
+) -> set[str]:
+    """Extract subset GeoParquet files for a batch of codes.
+
+    All extraction jobs of the batch share one DuckDBWorker session. With
+    single_scan and more than one pending code, all codes are extracted in
+    one pass over the planet file (see parquet_batch_sql). Otherwise, or if
+    that pass fails, codes are processed one COPY job at a time so a single
+    failure doesn't kill the batch. Returns the set of failed codes.
+    """
+    failed: set[str] = set()
+    pending = []
+    for code in codes:
+        # Safe existence check: the final path only ever appears via a
+        # rename, so it can never be a truncated partial file.
+        if os.path.exists(f"{level_dir}/{code}/{code}-latest.osm.parquet"):
+            print(f"[{code}] Parquet already extracted, skipping")
+        else:
+            pending.append(code)
+    if not pending:
+        return failed
+
+    # Batches are disjoint, so their first code names a private session.
+    with DuckDBWorker(work_dir, f"{level_dir}/.duckdb-worker-{pending[0]}", label=pending[0]) as worker:
+        if single_scan and len(pending) > 1:
+            if _run_parquet_single_scan(worker, pending, level_dir, boundaries_dir, snapshot_parquet):
+                return failed
+            print("Single-scan extraction failed, falling back to one COPY per code")
+
+        for code in pending:
+            parquet_path = f"{level_dir}/{code}/{code}-latest.osm.parquet"
+            tmp_path = f"{parquet_path}.tmp"
+            print(f"[{code}] duckdb parquet extract")
+            if worker.run(code, parquet_copy_sql(code, tmp_path, boundaries_dir, snapshot_parquet)):
+                os.rename(tmp_path, parquet_path)
             else:
-                print(f"[{code}] Parquet extraction failed: {e}")
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-            failed.add(code)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                failed.add(code)
     return failed
 
 
-def upload_subset(code: str, name: str, level: str, level_dir: str, hook) -> str | None:
-    """Upload the four subset files for one code using a pre-created R2IndexHook.
+def _upload_marker(level_dir: str, code: str, fmt: str) -> str:
+    return f"{level_dir}/{code}/.uploaded-{fmt}"
+
+
+def is_subset_file_uploaded(code: str, fmt: str, level_dir: str) -> bool:
+    """Whether upload_subset_file confirmed this output of the current build."""
+    return os.path.exists(_upload_marker(level_dir, code, fmt))
+
 
-    Must run on the main Airflow task thread (the hook needs the task context).
-    Returns the code on failure, None on success.
+def upload_subset_file(code: str, fmt: str, name: str, level: str, level_dir: str, hook) -> None:
+    """Upload one subset file (a SUBSET_FORMATS key) using a pre-created R2IndexHook.
+
+    The hook needs the Airflow task context: off the task thread, call this
+    inside a copy of that thread's context (contextvars.copy_context()), with
+    a hook created on the calling thread and used by no other.
+    Once the upload is confirmed, an .uploaded-{fmt} marker next to the file
+    lets it be deleted and a retry skip it. Raises on failure.
     """
-    subset_dir = f"{level_dir}/{code}"
+    _fmt, suffix, subfolder, version, media_type, tags = next(f for f in SUBSET_FORMATS if f[0] == fmt)
+    hook.upload(
+        bucket=R2_BUCKET,
+        category="openstreetmap",
+        destination_filename=f"{code}-latest.{suffix}",
+        destination_path=f"osm/{level}/{code}/{subfolder}",
+        destination_version=version,
+        entity=f"{code.lower()}-{subfolder}",
+        extension=suffix.rsplit(".", 1)[-1],
+        media_type=media_type,
+        name=name,
+        source=f"{level_dir}/{code}/{code}-latest.{suffix}",
+        subcategory=level,
+        tags=sorted(tags + [level, code.lower()]),
+    )
+    with open(_upload_marker(level_dir, code, fmt), "w", encoding="utf-8") as fh:
+        fh.write(fmt)
+
+
+def _boundary_area_km2(geometry: dict) -> float:
+    """Geodesic area of a boundary (scripts/compute_area.py).
+
+    Without pyproj, falls back to a planar area scaled by the cosine of the
+    centroid latitude, which is plenty for a cost estimate.
+    """
+    try:
+        from scripts.compute_area import geometry_area_km2
+
+        area = geometry_area_km2(geometry)
+        if area is not None:
+            return area
+    except ImportError:
+        pass
+    import math
+
+    import shapely
+
+    shape = shapely.from_geojson(json.dumps(geometry))
+    return shape.area * _KM_PER_DEG**2 * math.cos(math.radians(shape.centroid.y))
+
+
+def _read_subset_timings(path: str | None = None) -> list[dict]:
+    records = []
+    try:
+        with open(path or SUBSET_TIMINGS_PATH, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A run killed mid-append leaves at most one torn line.
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _prior_cost(area_km2: float, vertices: int) -> float:
+    return (
+        SUBSET_COST_OVERHEAD_SECONDS
+        + area_km2 * SUBSET_COST_SECONDS_PER_KM2
+        + vertices * SUBSET_COST_SECONDS_PER_VERTEX
+    )
+
+
+def _prior_peak_rss(area_km2: float) -> float:
+    return BUILD_PEAK_RSS_BASE_BYTES + area_km2 * BUILD_PEAK_RSS_BYTES_PER_KM2
+
+
+def estimate_subset_costs(codes: list[str], level: str, boundaries_dir: str) -> dict[str, dict]:
+    """Predict the wall time and build peak memory of each code.
+
+    A code with timing history (same level) is predicted from the median of
+    its last SUBSET_TIMINGS_HISTORY runs. Any other code gets the prior cost
+    of its prepared boundary (area via scripts/compute_area.py, vertex count)
+    scaled by the level's calibration: the median actual/prior ratio of its
+    recent records. Peak memory works the same way, but conservatively: the
+    largest recent peak, or the prior scaled by the 90th percentile ratio,
+    times BUILD_PEAK_RSS_SAFETY. Returns {code: {"predicted", "peak_rss",
+    "area_km2", "vertices"}}; the features travel with the batch so the
+    timings can be recorded against them.
+    """
+    history: dict[str, list[float]] = {}
+    peak_history: dict[str, list[int]] = {}
+    ratios = []
+    peak_ratios = []
+    for record in _read_subset_timings():
+        if record.get("level") != level:
+            continue
+        history.setdefault(record["code"], []).append(record["seconds"])
+        prior = _prior_cost(record["area_km2"], record["vertices"])
+        ratios.append(record["seconds"] / prior)
+        if record.get("peak_rss"):
+            peak_history.setdefault(record["code"], []).append(record["peak_rss"])
+            peak_ratios.append(record["peak_rss"] / _prior_peak_rss(record["area_km2"]))
+    calibration = statistics.median(ratios[-SUBSET_TIMINGS_CALIBRATION:]) if ratios else 1.0
+    peak_ratios = peak_ratios[-SUBSET_TIMINGS_CALIBRATION:]
+    peak_calibration = (
+        statistics.quantiles(peak_ratios, n=10, method="inclusive")[-1] if len(peak_ratios) > 1 else 1.0
+    )
+
+    estimates = {}
+    for code in codes:
+        with open(f"{boundaries_dir}/{code}.meta.json", encoding="utf-8") as fh:
+            geometry = json.load(fh)["geometry"]
+        area_km2 = round(_boundary_area_km2(geometry), 2)
+        vertices = len(PackedGeometry.from_geojson(geometry).coords)
+        if code in history:
+            predicted = statistics.median(history[code][-SUBSET_TIMINGS_HISTORY:])
+        else:
+            predicted = _prior_cost(area_km2, vertices) * calibration
+        if code in peak_history:
+            peak_rss = max(peak_history[code][-SUBSET_TIMINGS_HISTORY:])
+        else:
+            peak_rss = _prior_peak_rss(area_km2) * peak_calibration
+        estimates[code] = {
+            "predicted": round(predicted, 1),
+            "peak_rss": int(max(peak_rss * BUILD_PEAK_RSS_SAFETY, BUILD_PEAK_RSS_BASE_BYTES)),
+            "area_km2": area_km2,
+            "vertices": vertices,
+        }
+    with_history = sum(code in history for code in codes)
+    print(
+        f"Cost model ({level}): {with_history}/{len(codes)} code(s) with history, "
+        f"calibration {calibration:.2f}, {sum(e['predicted'] for e in estimates.values()) / 3600:.1f} h total"
+    )
+    return estimates
+
+
+def batch_wall_seconds(costs: list[float], workers: int) -> float:
+    """Predicted wall time of a batch whose codes build on workers in parallel.
+
+    The summed per-code time spread over the workers, but never less than
+    the longest code, which no amount of workers shortens.
+    """
+    return max(sum(costs) / max(workers, 1), max(costs, default=0.0))
+
+
+def pack_subset_batches(
+    estimates: dict[str, dict], budget_seconds: float, max_codes: int, workers: int = 1,
+) -> list[list[str]]:
+    """Pack codes into batches of about budget_seconds predicted wall time.
+
+    A batch builds up to workers codes in parallel (process_subset_batch's
+    build_workers), so its wall time is batch_wall_seconds of its codes'
+    predictions, not their sum. First-fit decreasing: codes are placed
+    largest first into the first batch with room left, so a code predicted
+    above the budget gets a batch of its own and the micro-states fill the
+    gaps. max_codes bounds the number of boundaries one batch's single-scan
+    SQL carries.
+    """
+    batches: list[list[str]] = []
+    costs: list[list[float]] = []
+    for code in sorted(estimates, key=lambda c: estimates[c]["predicted"], reverse=True):
+        cost = estimates[code]["predicted"]
+        for i, batch_costs in enumerate(costs):
+            if batch_wall_seconds([*batch_costs, cost], workers) <= budget_seconds and len(batches[i]) < max_codes:
+                batches[i].append(code)
+                batch_costs.append(cost)
+                break
+        else:
+            batches.append([code])
+            costs.append([cost])
+    return batches
+
+
+def record_subset_timings(records: list[dict], path: str | None = None) -> None:
+    """Append timing records to the shared history in a single write."""
+    if not records:
+        return
+    path = path or SUBSET_TIMINGS_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def report_subset_timings(levels: list[str], snapshot_path: str) -> None:
+    """Print predicted versus actual durations of this run's batches.
+
+    Records are matched to the run by the planet snapshot identity; a code
+    processed more than once (task retry) counts with its last record.
+    """
+    snapshot = _snapshot_identity(snapshot_path)
+    latest = {}
+    for record in _read_subset_timings():
+        if record.get("snapshot") == snapshot and record.get("level") in levels:
+            latest[(record["level"], record["code"])] = record
+    if not latest:
+        print("No subset timings recorded for this run")
+        return
+
+    batches: dict[tuple[str, str], list[dict]] = {}
+    for record in latest.values():
+        batches.setdefault((record["level"], record["batch"]), []).append(record)
+    print(f"{'batch':<32} {'codes':>5} {'predicted':>10} {'actual':>10} {'error':>7}")
+    for (level, batch), records in sorted(batches.items()):
+        predicted = sum(r["predicted"] for r in records)
+        actual = sum(r["seconds"] for r in records)
+        error = (actual - predicted) / predicted if predicted else 0.0
+        print(f"{level + '/' + batch:<32} {len(records):>5} {predicted:>9.0f}s {actual:>9.0f}s {error:>+7.0%}")
+
+    records = list(latest.values())
+    predicted = sum(r["predicted"] for r in records)
+    actual = sum(r["seconds"] for r in records)
+    errors = [abs(r["seconds"] - r["predicted"]) / r["predicted"] for r in records if r["predicted"]]
+    print(
+        f"Total: {len(records)} subset(s), predicted {predicted / 3600:.2f} h, actual {actual / 3600:.2f} h, "
+        f"median absolute error {statistics.median(errors) if errors else 0.0:.0%}"
+    )
+    worst = sorted(records, key=lambda r: abs(r["seconds"] - r["predicted"]), reverse=True)[:5]
+    for r in worst:
+        print(f"  {r['level']}/{r['code']}: predicted {r['predicted']:.0f}s, actual {r['seconds']:.0f}s ({r['steps']})")
+
+
+def host_memory() -> tuple[int, int]:
+    """Return (total, available) memory in bytes.
+
+    From /proc/meminfo, tightened by the cgroup v2 limit of this process if
+    it has one.
+    """
+    meminfo = {}
+    with open("/proc/meminfo", encoding="utf-8") as fh:
+        for line in fh:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    total, available = meminfo["MemTotal"], meminfo["MemAvailable"]
     try:
-        for _fmt, suffix, subfolder, version, media_type, tags in SUBSET_FORMATS:
-            extension = suffix.rsplit(".", 1)[-1]
-            hook.upload(
-                bucket=R2_BUCKET,
-                category="openstreetmap",
-                destination_filename=f"{code}-latest.{suffix}",
-                destination_path=f"osm/{level}/{code}/{subfolder}",
-                destination_version=version,
-                entity=f"{code.lower()}-{subfolder}",
-                extension=extension,
-                media_type=media_type,
-                name=name,
-                source=f"{subset_dir}/{code}-latest.{suffix}",
-                subcategory=level,
-                tags=sorted(tags + [level, code.lower()]),
+        with open("/sys/fs/cgroup/memory.max", encoding="utf-8") as fh:
+            limit = fh.read().strip()
+        with open("/sys/fs/cgroup/memory.current", encoding="utf-8") as fh:
+            current = int(fh.read())
+        if limit != "max" and int(limit) < total:
+            total, available = int(limit), min(available, int(limit) - current)
+    except (FileNotFoundError, ValueError):
+        pass
+    return total, available
+
+
+class MemoryAdmission:
+    """Admit parallel builds (and parquet sessions) while their predicted peak memory fits the host.
+
+    A build is admitted when its prediction fits both what is not yet
+    committed to running builds (total minus BUILD_MEMORY_RESERVE_BYTES minus
+    the predictions of admitted builds, which may not have reached their
+    peak yet) and what the host has available right now minus the reserve
+    (other workloads). With nothing running, a build is always admitted, so
+    one predicted above the whole budget still runs - alone, since nothing
+    else fits next to it. Waiting builds re-check every POLL_INTERVAL seconds
+    and whenever a build finishes.
+    """
+
+    POLL_INTERVAL = 10
+
+    def __init__(self, reserve: int = BUILD_MEMORY_RESERVE_BYTES):
+        self.reserve = reserve
+        self._condition = threading.Condition()
+        self._committed = 0
+        self._running = 0
+
+    def _fits(self, peak_rss: int) -> bool:
+        if self._running == 0:
+            return True
+        total, available = host_memory()
+        return peak_rss <= min(total - self.reserve - self._committed, available - self.reserve)
+
+    @contextlib.contextmanager
+    def admit(self, label: str, peak_rss: int) -> Iterator[None]:
+        with self._condition:
+            while not self._fits(peak_rss):
+                self._condition.wait(self.POLL_INTERVAL)
+            self._committed += peak_rss
+            self._running += 1
+            print(
+                f"[{label}] Admitted ({peak_rss / 1024**3:.1f} GiB predicted, "
+                f"{self._running} running, {self._committed / 1024**3:.1f} GiB committed)"
             )
-        return None
-    except Exception as e:
-        print(f"[{code}] Upload failed: {e}")
-        return code
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._committed -= peak_rss
+                self._running -= 1
+                self._condition.notify_all()
 
 
 def process_subset_batch(
@@ -559,22 +3093,60 @@ def process_subset_batch(
     build_workers: int = 2,
     snapshot_pbf: str | None = None,
     refilter_gol_pbf: bool = False,
+    parents_dir: str | None = None,
+    retain_dir: str | None = None,
+    estimates: dict[str, dict] | None = None,
+    hook_factory: Callable[[], Any] | None = None,
+    stage_limits: dict[str, int] | None = None,
+    refresh: SubsetRefresh | None = None,
 ) -> None:
     """Full pipeline for one batch: build PBF/GOL/GOB, extract parquet, upload.
 
     When snapshot_pbf is provided, PBF extraction uses osmium instead of gol;
-    callers should reserve this bounded-memory path for planet-scale batches.
-    refilter_gol_pbf removes recursive relation closure from gol-produced PBFs.
-    Raises AirflowException when any code fails; skipped codes (empty extracts)
-    are reported but do not fail the batch. Uploaded subset outputs are removed
-    to bound disk usage; a {code}.done marker records success.
+    callers should reserve this bounded-memory path for planet-scale batches
+    and hierarchical ones. refilter_gol_pbf removes recursive relation
+    closure from gol-produced PBFs. parents_dir enables hierarchical
+    extraction from already-built parents, snapshot_pbf being the fallback
+    of codes no parent covers (see build_subset_files); retain_dir keeps each
+    uploaded PBF there as a parent for a later level. A PBF that cannot be
+    retained only leaves its children to the planet.
+    refresh refreshes stored previous PBFs instead of extracting them (see
+    build_subset_files): a code whose content did not change is neither
+    built nor uploaded again. Every code uploaded in full or unchanged is
+    then stored for the next run (commit_previous_subset).
+
+    The stages overlap, each code advancing as soon as its own dependencies
+    are done: up to build_workers builds run in parallel (admitted by
+    MemoryAdmission on their predicted peak memory, the BUILD_PEAK_RSS_*
+    prior when no estimates are given, largest first), their extract, gol
+    build and gol save steps limited per stage (stage_limits, default
+    SUBSET_STAGE_LIMITS). Once every PBF extract is done, the codes whose
+    PBF turned out non-empty get their GeoParquet from one single-scan
+    DuckDB session (see run_parquet_batch), while GOL builds and saves
+    still run. A code's artifacts (PBF, GOL, GOB, GeoParquet) are only
+    uploaded once all four are complete, so a code that fails publishes
+    none of them. Upload workers (the "upload" limit) run in copies of the
+    calling thread's context, and each artifact is deleted once its upload
+    is confirmed and the build no longer reads it. A failed upload can still leave R2
+    with some of a code's formats from this snapshot and the others from
+    an earlier one, until the retry uploads the rest.
+
+    With estimates (see estimate_subset_costs), per-step timings and the
+    build peak memory of every uploaded or skipped code are appended to
+    SUBSET_TIMINGS_PATH. Every upload worker creates its own hook with
+    hook_factory (an R2IndexHook on r2index_conn_id unless one is given)
+    and shares it with no other thread.
+    Raises AirflowException when any code fails; skipped codes (empty
+    extracts) and unchanged ones are reported but do not fail the batch. A
+    {code}.done marker records success, after which the subset directory is
+    removed.
     """
     from concurrent.futures import ThreadPoolExecutor
 
     from airflow.exceptions import AirflowException
-    from elaunira.airflow.providers.r2index.hooks import R2IndexHook
 
     done_marker_value = "uploaded-refiltered" if refilter_gol_pbf else "uploaded"
+    batch_name = codes[0]
     codes = [
         code for code in codes
         if not _marker_matches(f"{level_dir}/{code}.done", done_marker_value)
@@ -583,38 +3155,208 @@ def process_subset_batch(
         print("All codes in batch already uploaded")
         return
 
-    with ThreadPoolExecutor(max_workers=build_workers) as executor:
-        build_results = list(executor.map(
-            lambda code: build_subset_files(
-                code,
-                level_dir,
-                boundaries_dir,
-                snapshot_gol,
-                snapshot_pbf=snapshot_pbf,
-                refilter_gol_pbf=refilter_gol_pbf,
-            ),
-            codes,
-        ))
-
-    results = [r for r in build_results if r is not None]
-    failed = {code for status, code in results if status == "failed"}
-    skipped = {code for status, code in results if status == "skipped"}
-    if skipped:
-        print(f"Skipped {len(skipped)} empty extract(s): {sorted(skipped)}")
+    limits = {**SUBSET_STAGE_LIMITS, **(stage_limits or {})}
+    stages = StageLimits({stage: limit for stage, limit in limits.items() if stage != "upload"})
+    steps: dict[str, dict[str, float]] = {code: {} for code in codes}
+    peaks: dict[str, int] = {}
+    admission = MemoryAdmission()
+    # Every worker runs inside a copy of the calling thread's context, so the
+    # hooks upload workers create see the task context as they would on this
+    # thread (each creates its own and shares it with none), and every
+    # container logs its telemetry where the caller's do.
+    task_context = contextvars.copy_context()
+    if hook_factory is None:
+        from elaunira.airflow.providers.r2index.hooks import R2IndexHook
+
+        hook_factory = functools.partial(R2IndexHook, r2index_conn_id=r2index_conn_id)
+    uploader_hooks = threading.local()
+
+    # Progress of every code, guarded by progress: build results as builds
+    # finish, codes ready for parquet (extracted non-empty) and through it,
+    # and what still holds each finalized artifact on disk.
+    progress = threading.Condition()
+    built: dict[str, tuple[str, str] | None] = {}
+    extracted: list[str] = []
+    parquet_started: set[str] = set()
+    finalized: set[tuple[str, str]] = set()
+    holds: dict[tuple[str, str], set[str]] = {}
+
+    def peak_rss(code: str) -> int:
+        if estimates and code in estimates:
+            return estimates[code]["peak_rss"]
+        return BUILD_PEAK_RSS_BASE_BYTES
+
+    def release(code: str, fmt: str, holder: str) -> None:
+        with progress:
+            holders = holds[(code, fmt)]
+            holders.discard(holder)
+            if holders:
+                return
+        suffix = next(f[1] for f in SUBSET_FORMATS if f[0] == fmt)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(f"{level_dir}/{code}/{code}-latest.{suffix}")
+
+    def retain(code: str) -> None:
+        try:
+            retain_parent(code, level_dir, boundaries_dir, retain_dir)
+        except Exception as e:
+            print(f"[{code}] Not retained as a parent, its children fall back to the planet: {e}")
 
-    parquet_codes = [c for c in codes if c not in failed and c not in skipped]
-    failed |= run_parquet_batch(parquet_codes, level_dir, boundaries_dir, snapshot_parquet, work_dir)
+    def upload(code: str, fmt: str) -> None:
+        start = time.monotonic()
+        try:
+            if not hasattr(uploader_hooks, "hook"):
+                uploader_hooks.hook = hook_factory()
+            upload_subset_file(code, fmt, names.get(code, code), level, level_dir, uploader_hooks.hook)
+            # Retained and staged before its deletion; the stores link the file.
+            if fmt == "pbf" and retain_dir is not None:
+                retain(code)
+            if fmt == "pbf" and refresh is not None:
+                stage_previous_subset(code, level_dir, refresh.previous_dir)
+        except Exception as e:
+            print(f"[{code}] Upload of {fmt} failed: {e}")
+            return
+        finally:
+            with progress:
+                steps[code]["upload"] = steps[code].get("upload", 0.0) + time.monotonic() - start
+        release(code, fmt, "upload")
+
+    def on_finalized(code: str, fmt: str) -> None:
+        """Let go of the artifact fmt was built from; upload the code once all are complete."""
+        with progress:
+            if (code, fmt) in finalized:
+                return
+            finalized.add((code, fmt))
+            holds[(code, fmt)] = {"upload", "build"} if fmt in SUBSET_ARTIFACT_SOURCES.values() else {"upload"}
+            if fmt == "pbf" and code not in extracted:
+                extracted.append(code)
+            complete = all((code, other) in finalized for other, *_ in SUBSET_FORMATS)
+            progress.notify_all()
+        if fmt in SUBSET_ARTIFACT_SOURCES:
+            release(code, SUBSET_ARTIFACT_SOURCES[fmt], "build")
+        if not complete:
+            return
+        for other, *_ in SUBSET_FORMATS:
+            if is_subset_file_uploaded(code, other, level_dir):
+                release(code, other, "upload")
+            else:
+                uploaders.submit(task_context.copy().run, upload, code, other)
+
+    def build(code: str) -> None:
+        result = ("failed", code)
+        try:
+            with admission.admit(code, peak_rss(code)), track_container_memory() as memory:
+                start = time.monotonic()
+                result = build_subset_files(
+                    code,
+                    level_dir,
+                    boundaries_dir,
+                    snapshot_gol,
+                    snapshot_pbf=snapshot_pbf,
+                    refilter_gol_pbf=refilter_gol_pbf,
+                    parents_dir=parents_dir,
+                    stages=stages,
+                    on_finalized=on_finalized,
+                    refresh=refresh,
+                )
+                steps[code]["build"] = time.monotonic() - start
+            peaks[code] = memory.peak
+        except Exception as e:
+            print(f"[{code}] Build failed: {e}")
+        finally:
+            with progress:
+                built[code] = result
+                progress.notify_all()
+        # Already built by an earlier attempt: every output is final.
+        if result is None:
+            for fmt in ("pbf", "gol", "gob"):
+                on_finalized(code, fmt)
+
+    def extracting() -> bool:
+        """Whether a code may still reach the parquet stage."""
+        return any(code not in extracted and code not in built for code in codes)
+
+    def parquet() -> None:
+        try:
+            # One planet scan per batch: it waits for every code that can
+            # still join it.
+            with progress:
+                progress.wait_for(lambda: not extracting())
+                ready = list(extracted)
+            pending = [code for code in ready if not is_subset_file_uploaded(code, "geoparquet", level_dir)]
+            failed_parquet: set[str] = set()
+            if pending:
+                with admission.admit(f"parquet {pending[0]}", PARQUET_SESSION_PEAK_RSS_BYTES):
+                    start = time.monotonic()
+                    failed_parquet = run_parquet_batch(pending, level_dir, boundaries_dir, snapshot_parquet, work_dir)
+                    # One scan serves the whole batch: its time is shared out
+                    # by predicted cost.
+                    seconds = time.monotonic() - start
+                shares = {code: (estimates or {}).get(code, {}).get("predicted", 1.0) for code in pending}
+                for code in pending:
+                    steps[code]["parquet"] = seconds * shares[code] / (sum(shares.values()) or 1.0)
+            for code in ready:
+                if code not in failed_parquet:
+                    on_finalized(code, "geoparquet")
+        except Exception as e:
+            print(f"Parquet extraction failed: {e}")
+
+    # Largest first: a huge build starts while nothing else runs, and the
+    # small ones fill the memory left around the others. The pools shut down
+    # in reverse order: the parquet scan runs once every extract is done, the
+    # builds finish, and the uploaders drain what both finalized.
+    by_peak = sorted(codes, key=peak_rss, reverse=True)
+    with ThreadPoolExecutor(max_workers=max(1, limits.get("upload", 1))) as uploaders, \
+            ThreadPoolExecutor(max_workers=build_workers) as builders, \
+            ThreadPoolExecutor(max_workers=1) as parquet_pool:
+        parquet_pool.submit(task_context.copy().run, parquet)
+        for code in by_peak:
+            builders.submit(task_context.copy().run, build, code)
 
-    hook = R2IndexHook(r2index_conn_id=r2index_conn_id)
     for code in codes:
-        if code in failed or code in skipped:
+        is_unchanged = built[code] == ("unchanged", code)
+        if is_unchanged:
+            # Its published files are current: only the stores move on.
+            if retain_dir is not None:
+                retain(code)
+        elif built[code] is not None or not all(
+            is_subset_file_uploaded(code, fmt, level_dir) for fmt, *_ in SUBSET_FORMATS
+        ):
             continue
-        if upload_subset(code, names.get(code, code), level, level_dir, hook) is None:
-            with open(f"{level_dir}/{code}.done", "w", encoding="utf-8") as fh:
-                fh.write(done_marker_value)
-            shutil.rmtree(f"{level_dir}/{code}", ignore_errors=True)
-        else:
-            failed.add(code)
+        if refresh is not None:
+            incremental = is_unchanged or _marker_matches(f"{level_dir}/{code}/.built", "built-incremental")
+            commit_previous_subset(code, boundaries_dir, refresh, incremental, staged=not is_unchanged)
+        with open(f"{level_dir}/{code}.done", "w", encoding="utf-8") as fh:
+            fh.write(done_marker_value)
+        shutil.rmtree(f"{level_dir}/{code}", ignore_errors=True)
+
+    results = [built[code] for code in codes if built[code] is not None]
+    failed = {code for status, code in results if status == "failed"}
+    skipped = {code for status, code in results if status == "skipped"}
+    if skipped:
+        print(f"Skipped {len(skipped)} empty extract(s): {sorted(skipped)}")
+    unchanged = {code for status, code in results if status == "unchanged"}
+    if unchanged:
+        print(f"{len(unchanged)} subset(s) unchanged since their previous PBF: {sorted(unchanged)}")
+    failed |= {code for code in codes if built[code] is None and not os.path.exists(f"{level_dir}/{code}.done")}
+
+    if estimates:
+        snapshot = _snapshot_identity(snapshot_gol)
+        record_subset_timings([
+            {
+                "snapshot": snapshot,
+                "level": level,
+                "batch": batch_name,
+                "code": code,
+                **estimates[code],
+                "predicted_peak_rss": estimates[code]["peak_rss"],
+                "peak_rss": peaks.get(code, 0),
+                "seconds": round(sum(steps[code].values()), 1),
+                "steps": {step: round(seconds, 1) for step, seconds in steps[code].items()},
+            }
+            for code in codes
+            if code not in failed and code not in unchanged and code in estimates
+        ])
 
     if failed:
         raise AirflowException(f"{len(failed)}/{len(codes)} subset(s) failed: {sorted(failed)}")